@@ -23,12 +23,27 @@ echo
 
 cd server/
 
-# start Celery worker in the bg
-celery -A server.celery_app --workdir=. worker --loglevel=DEBUG &
-celery_worker_pid=$!
-echo "Celery worker started with PID: $celery_worker_pid"
+celery_worker_pids=""
+# with TASK_EXECUTOR=embedded tasks run inside server.py and neither Redis nor workers are needed
+if [ "$TASK_EXECUTOR" != "embedded" ]; then
+  # start Celery workers in the bg: the main worker serves the default queue and project
+  # start/finalize steps, the others serve git clones, pip installs and model downloads
+  celery -A server.celery_app --workdir=. worker --loglevel=DEBUG -Q celery,provision_finalize -n main@%h &
+  celery_worker_pids="$!"
+  celery -A server.celery_app --workdir=. worker --loglevel=DEBUG -Q provision_git -c "${PROVISIONING_GIT_CONCURRENCY:-2}" -n git@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+  celery -A server.celery_app --workdir=. worker --loglevel=DEBUG -Q provision_pip -c "${PROVISIONING_PIP_CONCURRENCY:-2}" -n pip@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+  celery -A server.celery_app --workdir=. worker --loglevel=DEBUG -Q provision_download -c "${PROVISIONING_DOWNLOAD_CONCURRENCY:-2}" -n download@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+  echo "Celery workers started with PIDs: $celery_worker_pids"
+fi
 
+# serve the API with waitress instead of Flask's development server
+export SERVER_MODE="${SERVER_MODE:-production}"
 python server.py
 
-# kill Celery worker when server.py is done
-kill $celery_worker_pid
\ No newline at end of file
+# kill Celery workers when server.py is done
+if [ -n "$celery_worker_pids" ]; then
+  kill $celery_worker_pids
+fi
\ No newline at end of file
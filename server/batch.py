@@ -0,0 +1,744 @@
+import asyncio
+import copy
+import csv
+import io
+import itertools
+import json
+import os
+import time
+import uuid
+import logging
+import aiohttp
+import requests
+from launcher_db import get_launcher_db, register_schema
+from prompt_cache import compute_prompt_cache_key, copy_cached_outputs, get_cached_result, is_prompt_cache_enabled, store_prompt_result
+from replicas import choose_replica, get_running_replicas
+from settings import (
+    BATCH_JOB_CONCURRENCY,
+    BATCH_JOB_MAX_ITEMS,
+    BATCH_JOB_PROMPT_TIMEOUT_SECS,
+    PROJECTS_DIR,
+)
+from utils import write_json_atomic
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Пакетные задания: перебор параметров workflow проекта без UI. Задание - workflow (workflow_json из
+# launcher.json проекта или промпт в формате API ComfyUI) и спецификация перебора (seeds, prompts, строки
+# CSV), которая раскрывается в декартово произведение параметров. Промпты отправляются работающим
+# экземплярам проекта (см. replicas.choose_replica) не более concurrency одновременно, завершение
+# отслеживается по WebSocket ComfyUI (с опросом /history на случай обрыва), результаты скачиваются
+# в <проект>/batch_jobs/<id задания>/ вместе с manifest.json. Задание выполняется задачей исполнителя.
+# Элементы, результат которых уже есть в кеше промптов (см. prompt_cache), берутся из кеша, если в
+# спецификации не указано "cache": false.
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLING = "cancelling"
+JOB_CANCELLED = "cancelled"
+JOB_ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING, JOB_CANCELLING)
+
+ITEM_PENDING = "pending"
+ITEM_SUBMITTED = "submitted"
+ITEM_COMPLETED = "completed"
+ITEM_FAILED = "failed"
+ITEM_CANCELLED = "cancelled"
+
+# Если WebSocket молчит, завершение промпта проверяется по /history с этим интервалом
+HISTORY_POLL_SECS = 5
+REQUEST_TIMEOUT_SECS = 30
+# Типы входов, которые в UI ComfyUI - виджеты (значения лежат в widgets_values узла)
+WIDGET_INPUT_TYPES = ("INT", "FLOAT", "STRING", "BOOLEAN", "COMBO")
+# Узлы только для UI: в промпт не попадают
+VIRTUAL_NODE_TYPES = ("Note", "MarkdownNote", "PrimitiveNode", "Reroute")
+NODE_MODE_MUTED = 2
+NODE_MODE_BYPASSED = 4
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+        id TEXT PRIMARY KEY,
+        project_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        spec TEXT NOT NULL,
+        prompt TEXT NOT NULL,
+        targets TEXT NOT NULL,
+        concurrency INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        result_dir TEXT NOT NULL,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS batch_jobs_project_id ON batch_jobs (project_id)",
+    """
+    CREATE TABLE IF NOT EXISTS batch_job_items (
+        job_id TEXT NOT NULL,
+        item_index INTEGER NOT NULL,
+        params TEXT NOT NULL,
+        state TEXT NOT NULL,
+        prompt_id TEXT,
+        replica INTEGER,
+        outputs TEXT,
+        error TEXT,
+        started_at REAL,
+        finished_at REAL,
+        PRIMARY KEY (job_id, item_index)
+    )
+    """,
+)
+
+
+class BatchJobError(Exception):
+    pass
+
+
+def _get_json(port, path):
+    response = requests.get(f"http://127.0.0.1:{port}{path}", timeout=REQUEST_TIMEOUT_SECS)
+    response.raise_for_status()
+    return response.json()
+
+
+def workflow_to_prompt(workflow, object_info):
+    """
+    Промпт в формате API из workflow в формате UI (как его сохраняет ComfyUI), по описаниям узлов
+    object_info. Значения виджетов сопоставляются входам узла в порядке их объявления, как это делает UI.
+    """
+    nodes = {node["id"]: node for node in workflow.get("nodes", [])}
+    links = {link[0]: link for link in workflow.get("links", [])}
+
+    def resolve_link(link_id):
+        """[id узла, выход] источника связи в обход Reroute и отключенных узлов; None - источника нет"""
+        while link_id is not None and link_id in links:
+            from_node = nodes.get(links[link_id][1])
+            from_slot = links[link_id][2]
+            if from_node is None or from_node.get("mode") == NODE_MODE_MUTED or from_node["type"] == "PrimitiveNode":
+                # Значение PrimitiveNode хранится и в виджете узла, к которому он подключен
+                return None
+            if from_node["type"] == "Reroute" or from_node.get("mode") == NODE_MODE_BYPASSED:
+                # Пропущенный узел передает дальше свой вход того же типа
+                output_type = from_node["outputs"][from_slot].get("type")
+                link_id = next(
+                    (
+                        node_input.get("link")
+                        for node_input in from_node.get("inputs", [])
+                        if from_node["type"] == "Reroute" or node_input.get("type") == output_type
+                    ),
+                    None,
+                )
+                continue
+            return [str(from_node["id"]), from_slot]
+        return None
+
+    prompt = {}
+    for node in nodes.values():
+        if node["type"] in VIRTUAL_NODE_TYPES or node.get("mode") in (NODE_MODE_MUTED, NODE_MODE_BYPASSED):
+            continue
+        definition = object_info.get(node["type"])
+        if definition is None:
+            raise BatchJobError(f"Unknown node type {node['type']}, is its custom node installed?")
+
+        node_links = {node_input["name"]: node_input.get("link") for node_input in node.get("inputs", [])}
+        widgets_values = node.get("widgets_values") or []
+        position = 0
+        inputs = {}
+        for section in ("required", "optional"):
+            for name, spec in (definition.get("input", {}).get(section) or {}).items():
+                input_type = spec[0]
+                options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+                is_widget = (isinstance(input_type, list) or input_type in WIDGET_INPUT_TYPES) and not options.get(
+                    "forceInput"
+                )
+                has_value = False
+                if is_widget:
+                    if isinstance(widgets_values, dict):
+                        has_value, value = name in widgets_values, widgets_values.get(name)
+                    elif position < len(widgets_values):
+                        has_value, value = True, widgets_values[position]
+                        position += 1
+                        # Служебные виджеты UI занимают свое место в widgets_values
+                        if input_type == "INT" and (options.get("control_after_generate") or name in ("seed", "noise_seed")):
+                            position += 1
+                        if options.get("image_upload"):
+                            position += 1
+                source = resolve_link(node_links.get(name))
+                if source is not None:
+                    inputs[name] = source
+                elif has_value:
+                    inputs[name] = value
+        prompt[str(node["id"])] = {"class_type": node["type"], "inputs": inputs}
+    return prompt
+
+
+def _parse_target(target):
+    node_id, _, input_name = str(target).partition(".")
+    if not input_name:
+        raise BatchJobError(f"Invalid target {target}, expected <node id>.<input name>")
+    return node_id, input_name
+
+
+def find_targets(prompt, targets=None):
+    """
+    Входы промпта для параметров перебора: {имя параметра: ["<id узла>.<вход>", ...]}. По умолчанию seed -
+    все входы seed/noise_seed, prompt - текст узлов, подключенных к входам positive сэмплеров.
+    """
+    targets = {name: list(values) for name, values in (targets or {}).items()}
+    if "seed" not in targets:
+        targets["seed"] = [
+            f"{node_id}.{name}"
+            for node_id, node in prompt.items()
+            for name, value in node["inputs"].items()
+            if name in ("seed", "noise_seed") and isinstance(value, int)
+        ]
+    if "prompt" not in targets:
+        targets["prompt"] = sorted(
+            {
+                f"{value[0]}.text"
+                for node in prompt.values()
+                for name, value in node["inputs"].items()
+                if name == "positive"
+                and isinstance(value, list)
+                and isinstance(prompt.get(value[0], {}).get("inputs", {}).get("text"), str)
+            }
+        )
+    for values in targets.values():
+        for target in values:
+            node_id, input_name = _parse_target(target)
+            if node_id not in prompt:
+                raise BatchJobError(f"Target {target} refers to a missing node")
+    return targets
+
+
+def expand_sweep(sweep):
+    """Параметры промптов задания: декартово произведение seeds, prompts и строк csv"""
+    axes = []
+    seeds = sweep.get("seeds")
+    if isinstance(seeds, dict):
+        start = int(seeds.get("start", 0))
+        seeds = range(start, start + int(seeds.get("count", 1)))
+    if seeds:
+        axes.append([{"seed": int(seed)} for seed in seeds])
+    if sweep.get("prompts"):
+        axes.append([{"prompt": str(prompt)} for prompt in sweep["prompts"]])
+    if sweep.get("csv"):
+        rows = [
+            {name.strip(): value for name, value in row.items() if name and value not in (None, "")}
+            for row in csv.DictReader(io.StringIO(sweep["csv"]))
+        ]
+        if rows:
+            axes.append(rows)
+    if not axes:
+        raise BatchJobError("Sweep is empty: pass seeds, prompts or csv")
+
+    count = 1
+    for axis in axes:
+        count *= len(axis)
+    if count > BATCH_JOB_MAX_ITEMS:
+        raise BatchJobError(f"Sweep expands to {count} prompts, the limit is {BATCH_JOB_MAX_ITEMS}")
+    return [{k: v for params in combination for k, v in params.items()} for combination in itertools.product(*axes)]
+
+
+def _coerce(value, current):
+    """Значение параметра (строки CSV приходят текстом) к типу текущего значения входа"""
+    if isinstance(value, str) and isinstance(current, (bool, int, float)):
+        if isinstance(current, bool):
+            return value.strip().lower() in ("1", "true", "yes")
+        return type(current)(float(value)) if isinstance(current, int) else float(value)
+    return value
+
+
+def apply_params(prompt, targets, params):
+    prompt = copy.deepcopy(prompt)
+    for name, value in params.items():
+        # Столбцы CSV вида <id узла>.<вход> задают вход напрямую
+        for target in targets.get(name) or ([name] if "." in name else []):
+            node_id, input_name = _parse_target(target)
+            node_inputs = prompt[node_id]["inputs"]
+            node_inputs[input_name] = _coerce(value, node_inputs.get(input_name))
+    return prompt
+
+
+def _load_workflow_prompt(project_folder_path, workflow):
+    if isinstance(workflow, dict) and "nodes" not in workflow:
+        # Уже промпт в формате API: {id узла: {"class_type": ..., "inputs": ...}}
+        return workflow
+    if workflow in (None, "launcher"):
+        launcher_json_path = os.path.join(project_folder_path, "launcher.json")
+        if not os.path.exists(launcher_json_path):
+            raise BatchJobError("Project has no launcher.json, pass an API-format prompt as workflow")
+        with open(launcher_json_path) as f:
+            workflow = json.load(f)["workflow_json"]
+    if not isinstance(workflow, dict):
+        raise BatchJobError("workflow must be \"launcher\", a workflow or an API-format prompt")
+
+    replicas = get_running_replicas(project_folder_path)
+    if not replicas:
+        raise BatchJobError("Project is not running")
+    try:
+        object_info = _get_json(replicas[0][1], "/object_info")
+    except (requests.RequestException, ValueError) as e:
+        raise BatchJobError(f"Failed to get node definitions from ComfyUI: {e}")
+    return workflow_to_prompt(workflow, object_info)
+
+
+def create_batch_job(project_id, spec):
+    """Проверяет спецификацию, раскрывает перебор и сохраняет задание; возвращает id задания"""
+    project_folder_path = os.path.join(PROJECTS_DIR, project_id)
+    prompt = _load_workflow_prompt(project_folder_path, spec.get("workflow"))
+    targets = find_targets(prompt, spec.get("targets"))
+    items = expand_sweep(spec.get("sweep") or {})
+    for name in items[0]:
+        if not targets.get(name) and "." not in name:
+            raise BatchJobError(f"Don't know which inputs {name} sets, pass targets.{name}")
+    apply_params(prompt, targets, items[0])
+    concurrency = int(spec.get("concurrency") or BATCH_JOB_CONCURRENCY)
+    if concurrency < 1:
+        raise BatchJobError("concurrency must be a positive integer")
+
+    job_id = str(uuid.uuid4())
+    stored_spec = {key: value for key, value in spec.items() if key != "workflow"}
+    with get_launcher_db(write=True) as conn:
+        conn.execute(
+            """
+            INSERT INTO batch_jobs (id, project_id, state, spec, prompt, targets, concurrency, total, result_dir, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                job_id,
+                project_id,
+                JOB_QUEUED,
+                json.dumps(stored_spec),
+                json.dumps(prompt),
+                json.dumps(targets),
+                concurrency,
+                len(items),
+                os.path.join(project_folder_path, "batch_jobs", job_id),
+                time.time(),
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO batch_job_items (job_id, item_index, params, state) VALUES (?, ?, ?, ?)",
+            [(job_id, index, json.dumps(params), ITEM_PENDING) for index, params in enumerate(items)],
+        )
+    return job_id
+
+
+def _job_to_json(row, counts):
+    return {
+        "id": row["id"],
+        "project_id": row["project_id"],
+        "state": row["state"],
+        "spec": json.loads(row["spec"]),
+        "concurrency": row["concurrency"],
+        "total": row["total"],
+        "completed": counts.get(ITEM_COMPLETED, 0),
+        "failed": counts.get(ITEM_FAILED, 0),
+        "cancelled": counts.get(ITEM_CANCELLED, 0),
+        "in_progress": counts.get(ITEM_SUBMITTED, 0),
+        "result_dir": row["result_dir"],
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+
+
+def _get_item_counts(conn, job_id):
+    rows = conn.execute(
+        "SELECT state, COUNT(*) AS count FROM batch_job_items WHERE job_id = ? GROUP BY state", (job_id,)
+    ).fetchall()
+    return {row["state"]: row["count"] for row in rows}
+
+
+def get_batch_job(job_id, with_items=False):
+    with get_launcher_db() as conn:
+        row = conn.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = _job_to_json(row, _get_item_counts(conn, job_id))
+        if with_items:
+            job["items"] = [
+                {
+                    "index": item["item_index"],
+                    "params": json.loads(item["params"]),
+                    "state": item["state"],
+                    "prompt_id": item["prompt_id"],
+                    "replica": item["replica"],
+                    "outputs": json.loads(item["outputs"]) if item["outputs"] else [],
+                    "error": item["error"],
+                }
+                for item in conn.execute(
+                    "SELECT * FROM batch_job_items WHERE job_id = ? ORDER BY item_index", (job_id,)
+                ).fetchall()
+            ]
+    return job
+
+
+def list_batch_jobs(project_id):
+    with get_launcher_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM batch_jobs WHERE project_id = ? ORDER BY created_at DESC", (project_id,)
+        ).fetchall()
+        return [_job_to_json(row, _get_item_counts(conn, row["id"])) for row in rows]
+
+
+def cancel_batch_job(job_id):
+    """Просит задание остановиться: новые промпты не отправляются, ожидающие в очереди ComfyUI удаляются"""
+    with get_launcher_db(write=True) as conn:
+        row = conn.execute("SELECT state FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["state"] not in JOB_ACTIVE_STATES:
+            return False
+        if row["state"] == JOB_QUEUED:
+            # Задача еще не начала выполняться: отменяем сразу
+            conn.execute(
+                "UPDATE batch_jobs SET state = ?, finished_at = ? WHERE id = ?", (JOB_CANCELLED, time.time(), job_id)
+            )
+            conn.execute(
+                "UPDATE batch_job_items SET state = ? WHERE job_id = ? AND state = ?",
+                (ITEM_CANCELLED, job_id, ITEM_PENDING),
+            )
+        else:
+            conn.execute("UPDATE batch_jobs SET state = ? WHERE id = ?", (JOB_CANCELLING, job_id))
+    return True
+
+
+def cancel_project_batch_jobs(project_id):
+    """Отменяет активные задания проекта (перед его удалением)"""
+    with get_launcher_db() as conn:
+        rows = conn.execute(
+            f"SELECT id FROM batch_jobs WHERE project_id = ? AND state IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)})",
+            (project_id, *JOB_ACTIVE_STATES),
+        ).fetchall()
+    for row in rows:
+        cancel_batch_job(row["id"])
+
+
+def delete_project_batch_jobs(project_id):
+    # Выполняющиеся задания видят пропажу своей записи как отмену (см. _JobRunner.is_cancelled)
+    with get_launcher_db(write=True) as conn:
+        conn.execute(
+            "DELETE FROM batch_job_items WHERE job_id IN (SELECT id FROM batch_jobs WHERE project_id = ?)",
+            (project_id,),
+        )
+        conn.execute("DELETE FROM batch_jobs WHERE project_id = ?", (project_id,))
+
+
+def _update_item(job_id, index, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with get_launcher_db(write=True) as conn:
+        conn.execute(
+            f"UPDATE batch_job_items SET {assignments} WHERE job_id = ? AND item_index = ?",
+            [*fields.values(), job_id, index],
+        )
+
+
+def _get_job_state(job_id):
+    with get_launcher_db() as conn:
+        row = conn.execute("SELECT state FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+    return row["state"] if row else None
+
+
+class _PromptTracker:
+    """Завершение промптов по сообщениям WebSocket ComfyUI (по одному соединению на экземпляр)"""
+
+    def __init__(self, session, client_id):
+        self.session = session
+        self.client_id = client_id
+        # prompt_id -> future с None (выполнен) или текстом ошибки
+        self._results = {}
+        self._listeners = {}
+
+    def _get_result(self, prompt_id):
+        if prompt_id not in self._results:
+            self._results[prompt_id] = asyncio.get_running_loop().create_future()
+        return self._results[prompt_id]
+
+    def _finish(self, prompt_id, error=None):
+        result = self._get_result(prompt_id)
+        if not result.done():
+            result.set_result(error)
+
+    def watch(self, port):
+        if port not in self._listeners or self._listeners[port].done():
+            self._listeners[port] = asyncio.create_task(self._listen(port))
+
+    async def _listen(self, port):
+        try:
+            async with self.session.ws_connect(f"http://127.0.0.1:{port}/ws?clientId={self.client_id}") as ws:
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    event = json.loads(message.data)
+                    data = event.get("data") or {}
+                    prompt_id = data.get("prompt_id")
+                    if not prompt_id:
+                        continue
+                    if event.get("type") == "execution_success" or (
+                        event.get("type") == "executing" and data.get("node") is None
+                    ):
+                        self._finish(prompt_id)
+                    elif event.get("type") == "execution_error":
+                        self._finish(prompt_id, data.get("exception_message") or "Execution error")
+                    elif event.get("type") == "execution_interrupted":
+                        self._finish(prompt_id, "Execution was interrupted")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Lost ComfyUI websocket on port {port}, falling back to polling: {e}")
+
+    async def _poll_history(self, port, prompt_id):
+        async with self.session.get(f"http://127.0.0.1:{port}/history/{prompt_id}") as response:
+            entry = (await response.json()).get(prompt_id)
+        if entry is None:
+            return
+        status = entry.get("status") or {}
+        if status.get("status_str") == "error":
+            self._finish(prompt_id, "Execution error")
+        elif status.get("completed", True):
+            self._finish(prompt_id)
+
+    async def wait(self, port, prompt_id, should_stop):
+        """None, когда промпт выполнен, иначе причина неудачи"""
+        result = self._get_result(prompt_id)
+        deadline = time.time() + BATCH_JOB_PROMPT_TIMEOUT_SECS
+        while not result.done():
+            if time.time() > deadline:
+                return f"Prompt did not finish within {BATCH_JOB_PROMPT_TIMEOUT_SECS}s"
+            if await asyncio.to_thread(should_stop):
+                return "Job was cancelled"
+            try:
+                await asyncio.wait_for(asyncio.shield(result), HISTORY_POLL_SECS)
+            except asyncio.TimeoutError:
+                self.watch(port)
+                try:
+                    await self._poll_history(port, prompt_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    pass
+        return result.result()
+
+    async def close(self):
+        for listener in self._listeners.values():
+            listener.cancel()
+        await asyncio.gather(*self._listeners.values(), return_exceptions=True)
+
+
+class _JobRunner:
+    def __init__(self, job_id):
+        with get_launcher_db() as conn:
+            row = conn.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+            self.items = conn.execute(
+                "SELECT item_index, params FROM batch_job_items WHERE job_id = ? AND state IN (?, ?) ORDER BY item_index",
+                (job_id, ITEM_PENDING, ITEM_SUBMITTED),
+            ).fetchall()
+        self.job_id = job_id
+        self.project_folder_path = os.path.join(PROJECTS_DIR, row["project_id"])
+        self.prompt = json.loads(row["prompt"])
+        self.targets = json.loads(row["targets"])
+        self.concurrency = row["concurrency"]
+        self.result_dir = row["result_dir"]
+        self.project_id = row["project_id"]
+        self.use_cache = json.loads(row["spec"]).get("cache", True) is not False and is_prompt_cache_enabled()
+        # prompt_id -> порт экземпляра, в очереди которого промпт еще может ждать
+        self.queued = {}
+
+    def is_cancelled(self):
+        return _get_job_state(self.job_id) in (JOB_CANCELLING, JOB_CANCELLED, None)
+
+    async def _download_outputs(self, session, port, prompt_id, index):
+        async with session.get(f"http://127.0.0.1:{port}/history/{prompt_id}") as response:
+            entry = (await response.json()).get(prompt_id) or {}
+        outputs = []
+        for node_id, node_outputs in (entry.get("outputs") or {}).items():
+            for kind, files in node_outputs.items():
+                for file in files if isinstance(files, list) else []:
+                    if not isinstance(file, dict) or "filename" not in file:
+                        continue
+                    file_name = f"{index:05d}_{node_id}_{os.path.basename(file['filename'])}"
+                    params = {
+                        "filename": file["filename"],
+                        "subfolder": file.get("subfolder", ""),
+                        "type": file.get("type", "output"),
+                    }
+                    async with session.get(f"http://127.0.0.1:{port}/view", params=params) as response:
+                        response.raise_for_status()
+                        with open(os.path.join(self.result_dir, file_name), "wb") as f:
+                            async for chunk in response.content.iter_chunked(1024 * 1024):
+                                f.write(chunk)
+                    outputs.append({"node_id": node_id, "kind": kind, "file": file_name, "source": params})
+        return outputs
+
+    async def _run_item(self, session, tracker, semaphore, item):
+        index, params = item["item_index"], json.loads(item["params"])
+        async with semaphore:
+            if await asyncio.to_thread(self.is_cancelled):
+                return
+            prompt = apply_params(self.prompt, self.targets, params)
+            cache_key = None
+            if self.use_cache:
+                cache_key = await asyncio.to_thread(compute_prompt_cache_key, self.project_folder_path, prompt)
+                cached = await asyncio.to_thread(get_cached_result, cache_key)
+                if cached is not None:
+                    try:
+                        outputs = await asyncio.to_thread(copy_cached_outputs, cached, self.result_dir, f"{index:05d}_")
+                    except OSError as e:
+                        logger.warning(f"Failed to copy cached outputs of batch job {self.job_id} item {index}: {e}")
+                    else:
+                        await asyncio.to_thread(
+                            _update_item,
+                            self.job_id,
+                            index,
+                            state=ITEM_COMPLETED,
+                            prompt_id=cached["prompt_id"],
+                            outputs=json.dumps(outputs),
+                            started_at=time.time(),
+                            finished_at=time.time(),
+                        )
+                        return
+            chosen = await asyncio.to_thread(choose_replica, self.project_folder_path)
+            if chosen is None:
+                await asyncio.to_thread(
+                    _update_item, self.job_id, index, state=ITEM_FAILED, error="Project is not running"
+                )
+                return
+            replica, port = chosen
+            tracker.watch(port)
+            started_at = time.time()
+            try:
+                async with session.post(
+                    f"http://127.0.0.1:{port}/prompt",
+                    json={"prompt": prompt, "client_id": tracker.client_id},
+                ) as response:
+                    data = await response.json()
+                if "prompt_id" not in data:
+                    # ComfyUI не принял промпт: ошибка проверки графа
+                    error = data.get("error")
+                    raise BatchJobError(error.get("message") if isinstance(error, dict) else error or data)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, BatchJobError) as e:
+                await asyncio.to_thread(
+                    _update_item, self.job_id, index, state=ITEM_FAILED, error=f"Failed to submit prompt: {e}"
+                )
+                return
+            prompt_id = data["prompt_id"]
+            self.queued[prompt_id] = port
+            await asyncio.to_thread(
+                _update_item,
+                self.job_id,
+                index,
+                state=ITEM_SUBMITTED,
+                prompt_id=prompt_id,
+                replica=replica,
+                started_at=started_at,
+            )
+
+            error = await tracker.wait(port, prompt_id, self.is_cancelled)
+            outputs = []
+            if error is None:
+                self.queued.pop(prompt_id, None)
+                try:
+                    outputs = await self._download_outputs(session, port, prompt_id, index)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, OSError) as e:
+                    error = f"Failed to download outputs: {e}"
+            if error is None and cache_key:
+                await asyncio.to_thread(store_prompt_result, cache_key, self.project_id, prompt_id, outputs, self.result_dir)
+            if error is None:
+                state = ITEM_COMPLETED
+            else:
+                state = ITEM_CANCELLED if await asyncio.to_thread(self.is_cancelled) else ITEM_FAILED
+            await asyncio.to_thread(
+                _update_item,
+                self.job_id,
+                index,
+                state=state,
+                outputs=json.dumps(outputs),
+                error=error,
+                finished_at=time.time(),
+            )
+
+    async def _delete_queued(self, session):
+        """Убирает из очередей ComfyUI промпты задания, которые еще не начали выполняться"""
+        by_port = {}
+        for prompt_id, port in self.queued.items():
+            by_port.setdefault(port, []).append(prompt_id)
+        for port, prompt_ids in by_port.items():
+            try:
+                async with session.post(f"http://127.0.0.1:{port}/queue", json={"delete": prompt_ids}):
+                    pass
+            except aiohttp.ClientError:
+                pass
+
+    async def run(self):
+        os.makedirs(self.result_dir, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT_SECS, sock_read=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            tracker = _PromptTracker(session, f"batch-{self.job_id}")
+            try:
+                await asyncio.gather(*(self._run_item(session, tracker, semaphore, item) for item in self.items))
+            finally:
+                if self.is_cancelled():
+                    await self._delete_queued(session)
+                await tracker.close()
+
+
+def _write_manifest(job_id):
+    job = get_batch_job(job_id, with_items=True)
+    if job is None or not os.path.isdir(job["result_dir"]):
+        return
+    job["manifest_written_at"] = time.time()
+    write_json_atomic(os.path.join(job["result_dir"], "manifest.json"), job)
+
+
+def run_batch_job(job_id):
+    """Выполняет задание (вызывается задачей исполнителя)"""
+    with get_launcher_db(write=True) as conn:
+        row = conn.execute("SELECT state FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["state"] != JOB_QUEUED:
+            return
+        conn.execute("UPDATE batch_jobs SET state = ?, started_at = ? WHERE id = ?", (JOB_RUNNING, time.time(), job_id))
+
+    logger.info(f"Running batch job {job_id}")
+    error = None
+    try:
+        asyncio.run(_JobRunner(job_id).run())
+    except Exception as e:
+        logger.error(f"Batch job {job_id} failed: {e}", exc_info=True)
+        error = str(e)
+
+    _finish_batch_job(job_id, error)
+
+
+def _finish_batch_job(job_id, error=None):
+    with get_launcher_db(write=True) as conn:
+        row = conn.execute("SELECT state FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            # Проект удален вместе с заданием
+            logger.info(f"Batch job {job_id} was deleted")
+            return
+        cancelled = row["state"] == JOB_CANCELLING
+        conn.execute(
+            "UPDATE batch_job_items SET state = ? WHERE job_id = ? AND state IN (?, ?)",
+            (ITEM_CANCELLED if cancelled else ITEM_FAILED, job_id, ITEM_PENDING, ITEM_SUBMITTED),
+        )
+        counts = _get_item_counts(conn, job_id)
+        if cancelled:
+            state = JOB_CANCELLED
+        elif error or not counts.get(ITEM_COMPLETED):
+            state = JOB_FAILED
+        else:
+            state = JOB_COMPLETED
+        conn.execute(
+            "UPDATE batch_jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?",
+            (state, error, time.time(), job_id),
+        )
+    _write_manifest(job_id)
+    logger.info(f"Batch job {job_id} {state}: {counts}")
+
+
+def fail_interrupted_batch_job(job_id):
+    """Задание, выполнение которого прервала остановка лаунчера: его промпты уже отправлены, повторять его нельзя"""
+    if _get_job_state(job_id) in (JOB_RUNNING, JOB_CANCELLING):
+        _finish_batch_job(job_id, "Interrupted by a launcher restart")
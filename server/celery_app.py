@@ -1,6 +1,7 @@
 from celery import Celery
 from kombu import Queue
 import os
+from settings import PROVISIONING_CONCURRENCY, PROVISIONING_QUEUES
 
 # Настройка путей для Redis
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
@@ -12,7 +13,11 @@ app = Celery('server',
 
 # Явно регистрируем задачу
 app.conf.task_routes = {
-    'tasks.create_comfyui_project': {'queue': 'celery'}
+    'tasks.create_comfyui_project': {'queue': 'celery'},
+    'tasks.refill_warm_pool_task': {'queue': 'celery'},
+    # Шаги раздельной установки получают очередь при постановке (см. enqueue_project_provisioning)
+    'tasks.start_project_provisioning': {'queue': PROVISIONING_QUEUES['finalize']},
+    'tasks.complete_project_provisioning': {'queue': PROVISIONING_QUEUES['finalize']},
 }
 
 app.conf.update(
@@ -21,17 +26,19 @@ app.conf.update(
     result_serializer='json',
     timezone='Europe/Istanbul',
     enable_utc=True,
-    task_queues=(Queue('celery'),),
+    # Воркер без -Q обслуживает все очереди, с -Q - только свой вид работы
+    task_queues=(Queue('celery'),) + tuple(Queue(queue) for queue in PROVISIONING_QUEUES.values()),
     task_default_queue='celery',
     broker_connection_retry_on_startup=True,
     broker_connection_max_retries=10,
     broker_connection_timeout=30,
+    # Несколько установок идут параллельно в потоках одного воркера;
+    # сеть, pip и диск ограничиваются отдельными бюджетами (см. PROVISIONING_BUDGETS)
     worker_prefetch_multiplier=1,
-    worker_max_tasks_per_child=1,
     worker_pool_restarts=True,
-    worker_pool='solo',
+    worker_pool='threads',
+    worker_concurrency=PROVISIONING_CONCURRENCY,
     task_track_started=True,
-    task_time_limit=3600,
     redis_max_connections=20,
     redis_socket_timeout=30,
     redis_socket_connect_timeout=30,
@@ -4,18 +4,40 @@ echo "ComfyUI Launcher is starting..."
 echo
 echo
 
-# start Celery worker in the bg
-celery -A server.celery_app --workdir=. worker --loglevel=INFO &
-celery_worker_pid=$!
+celery_worker_pids=""
+proxy_pid=""
+# with TASK_EXECUTOR=embedded tasks run inside server.py and neither Redis nor workers are needed
+if [ "$TASK_EXECUTOR" != "embedded" ]; then
+  # start Celery workers in the bg: the main worker serves the default queue and project
+  # start/finalize steps, the others serve git clones, pip installs and model downloads
+  celery -A server.celery_app --workdir=. worker --loglevel=INFO -Q celery,provision_finalize -n main@%h &
+  celery_worker_pids="$!"
+  celery -A server.celery_app --workdir=. worker --loglevel=INFO -Q provision_git -c "${PROVISIONING_GIT_CONCURRENCY:-2}" -n git@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+  celery -A server.celery_app --workdir=. worker --loglevel=INFO -Q provision_pip -c "${PROVISIONING_PIP_CONCURRENCY:-2}" -n pip@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+  celery -A server.celery_app --workdir=. worker --loglevel=INFO -Q provision_download -c "${PROVISIONING_DOWNLOAD_CONCURRENCY:-2}" -n download@%h &
+  celery_worker_pids="$celery_worker_pids $!"
+fi
 
-# if the environment variable PROXY_MODE is set to "true", start nginx
+# if the environment variable PROXY_MODE is set to "true", start the reverse proxy
+# (launcher at /, ComfyUI of each project at /comfy/<project id>/)
 if [ "$PROXY_MODE" = "true" ]; then
-    echo "Starting Nginx reverse proxy (PROXY_MODE=true)..."
-    cat /etc/nginx/nginx.conf.template | envcat -f j2 '*' > /etc/nginx/nginx.conf
-    nginx -g "daemon off;" &
+    echo "Starting reverse proxy (PROXY_MODE=true)..."
+    python proxy.py &
+    proxy_pid="$!"
 fi
 
+# serve the API with waitress instead of Flask's development server
+export SERVER_MODE="${SERVER_MODE:-production}"
 python server.py
 
-# kill Celery worker when server.py is done
-kill $celery_worker_pid
\ No newline at end of file
+# kill Celery workers when server.py is done
+if [ -n "$celery_worker_pids" ]; then
+  kill $celery_worker_pids
+fi
+
+# stop the reverse proxy too
+if [ -n "$proxy_pid" ]; then
+  kill $proxy_pid
+fi
@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from settings import EVENTS_BUFFER_SIZE, EVENTS_CHANNEL, PROJECTS_DIR, REDIS_URL
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# События изменения состояния проектов для /api/events (Server-Sent Events).
+# Сервер API публикует свои изменения прямо в шину событий процесса; воркеры Celery - в канал Redis
+# EVENTS_CHANNEL, который сервер слушает и пересылает в свою шину. Шина хранит последние
+# EVENTS_BUFFER_SIZE событий, чтобы переподключившийся клиент получил пропущенное по Last-Event-ID.
+
+REDIS_RECONNECT_MAX_SECS = 30
+KEEPALIVE_SECS = 15
+
+
+class EventBus:
+    def __init__(self, buffer_size):
+        # id событий - "<экземпляр шины>-<номер>": после перезапуска сервера старые id не подходят
+        self.instance_id = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=buffer_size)
+        self._seq = 0
+        self._condition = threading.Condition()
+
+    def publish(self, event_type, data):
+        with self._condition:
+            self._seq += 1
+            self._events.append((self._seq, event_type, data))
+            self._condition.notify_all()
+            return self.format_event_id(self._seq)
+
+    def format_event_id(self, seq):
+        return f"{self.instance_id}-{seq}"
+
+    def parse_event_id(self, event_id):
+        """Номер события из Last-Event-ID, либо None, если id выдан другим экземпляром шины"""
+        instance_id, _, seq = (event_id or "").rpartition("-")
+        if instance_id != self.instance_id or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def get_events_after(self, seq):
+        """
+        События после seq. Возвращает (события, полные ли они): если часть событий уже вытеснена
+        из буфера, клиенту нужно заново запросить список проектов.
+        """
+        with self._condition:
+            events = [event for event in self._events if event[0] > seq]
+            oldest_seq = self._events[0][0] if self._events else self._seq + 1
+            complete = seq >= oldest_seq - 1
+            return events, complete
+
+    def get_last_seq(self):
+        with self._condition:
+            return self._seq
+
+    def wait_for_events(self, seq, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq > seq, timeout=timeout)
+        return self.get_events_after(seq)
+
+
+event_bus = EventBus(EVENTS_BUFFER_SIZE)
+
+
+def _get_project_id(project_folder_path):
+    project_folder_path = os.path.abspath(project_folder_path)
+    if os.path.dirname(project_folder_path) != os.path.abspath(PROJECTS_DIR):
+        # Сборки теплого пула и общих окружений - не проекты
+        return None
+    return os.path.basename(project_folder_path)
+
+
+def publish_state_change(project_folder_path, data):
+    """Listener для on_launcher_state_change в процессе сервера"""
+    project_id = _get_project_id(project_folder_path)
+    if project_id:
+        event_bus.publish("project_state", {"id": project_id, "delta": data})
+
+
+def publish_project_deleted(project_id):
+    event_bus.publish("project_deleted", {"id": project_id})
+
+
+_redis_client = None
+
+
+def _get_redis_client():
+    global _redis_client
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+def _publish_to_redis(event_type, data):
+    try:
+        _get_redis_client().publish(EVENTS_CHANNEL, json.dumps({"type": event_type, "data": data}))
+    except Exception as e:
+        logger.warning(f"Failed to publish {event_type} event: {e}")
+
+
+def publish_state_change_to_redis(project_folder_path, data):
+    """
+    Listener для on_launcher_state_change в процессах воркеров
+    """
+    project_id = _get_project_id(project_folder_path)
+    if project_id:
+        _publish_to_redis("project_state", {"id": project_id, "delta": data})
+
+
+def _relay_redis_events():
+    import redis
+    retry_secs = 1
+    while True:
+        try:
+            pubsub = redis.Redis.from_url(REDIS_URL).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(EVENTS_CHANNEL)
+            retry_secs = 1
+            for message in pubsub.listen():
+                event = json.loads(message["data"])
+                event_bus.publish(event["type"], event["data"])
+        except Exception as e:
+            logger.warning(f"Events relay from Redis failed, retrying in {retry_secs}s: {e}")
+            time.sleep(retry_secs)
+            retry_secs = min(retry_secs * 2, REDIS_RECONNECT_MAX_SECS)
+
+
+def start_redis_events_relay():
+    threading.Thread(target=_relay_redis_events, name="events-redis-relay", daemon=True).start()
+
+
+def format_sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(last_event_id=None):
+    """Генератор SSE: пропущенные события (или reset, если их уже нет), затем новые по мере появления"""
+    seq = event_bus.parse_event_id(last_event_id) if last_event_id else None
+    if seq is None:
+        seq = event_bus.get_last_seq()
+        if last_event_id:
+            # Клиент был подключен к другому экземпляру сервера
+            yield format_sse(event_bus.format_event_id(seq), "reset", {})
+    else:
+        _, complete = event_bus.get_events_after(seq)
+        if not complete:
+            seq = event_bus.get_last_seq()
+            yield format_sse(event_bus.format_event_id(seq), "reset", {})
+
+    yield "retry: 3000\n\n"
+    while True:
+        events, complete = event_bus.wait_for_events(seq, KEEPALIVE_SECS)
+        if not complete:
+            seq = event_bus.get_last_seq()
+            yield format_sse(event_bus.format_event_id(seq), "reset", {})
+            continue
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event_seq, event_type, data in events:
+            yield format_sse(event_bus.format_event_id(event_seq), event_type, data)
+            seq = event_seq
@@ -0,0 +1,262 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from celery import current_app, current_task
+from launcher_db import get_launcher_db, register_schema
+from settings import EMBEDDED_JOBS_DB_PATH, PROVISIONING_CONCURRENCY, TASK_EXECUTOR
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Выполнение задач без брокера: с TASK_EXECUTOR=embedded задачи Celery (те же функции shared_task)
+# выполняются в пуле потоков процесса лаунчера. Очередь хранится в SQLite (EMBEDDED_JOBS_DB_PATH),
+# поэтому задачи, не дошедшие до выполнения к моменту остановки лаунчера, выполняются при следующем запуске.
+# Прерванная на середине задача продолжается, только если для нее задан обработчик set_recovery_handler,
+# иначе помечается упавшей. Там же хранится прогресс задач (вместо result backend Celery).
+# Отмена задач Celery отмечается в общей базе лаунчера: воркеры с пулом потоков не могут прервать
+# выполняющуюся задачу, поэтому она, как и во встроенном исполнителе, останавливается на raise_if_revoked.
+
+JOB_PENDING = "PENDING"
+JOB_STARTED = "STARTED"
+JOB_SUCCESS = "SUCCESS"
+JOB_FAILURE = "FAILURE"
+JOB_REVOKED = "REVOKED"
+
+# Отметки об отмене задач Celery хранятся столько секунд
+REVOKED_TASKS_TTL_SECS = 7 * 24 * 3600
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS revoked_tasks (
+        task_id TEXT PRIMARY KEY,
+        revoked_at REAL NOT NULL
+    )
+    """,
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+_current_job = threading.local()
+# Имя задачи -> handler(args, kwargs): (args, kwargs) для продолжения прерванной задачи или None
+_recovery_handlers = {}
+
+
+class JobRevokedError(Exception):
+    pass
+
+
+def is_embedded_executor():
+    return TASK_EXECUTOR == "embedded"
+
+
+@contextmanager
+def get_jobs_db():
+    conn = sqlite3.connect(EMBEDDED_JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_jobs_db():
+    with get_jobs_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                task_name TEXT NOT NULL,
+                args TEXT NOT NULL,
+                kwargs TEXT NOT NULL,
+                state TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS task_meta (
+                task_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=PROVISIONING_CONCURRENCY, thread_name_prefix="embedded-task")
+        return _pool
+
+
+def _set_job_state(job_id, state, from_state, **fields):
+    """Меняет состояние задачи, только если оно все еще from_state (не отменена); True, если изменено"""
+    assignments = ", ".join(["state = ?"] + [f"{name} = ?" for name in fields])
+    with get_jobs_db() as conn:
+        cursor = conn.execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ? AND state = ?", [state, *fields.values(), job_id, from_state]
+        )
+    return cursor.rowcount > 0
+
+
+def get_job(job_id):
+    with get_jobs_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _run_job(job_id):
+    job = get_job(job_id)
+    if not job or not _set_job_state(job_id, JOB_STARTED, JOB_PENDING, started_at=time.time()):
+        logger.info(f"Skipping revoked job {job_id}")
+        return
+
+    task = current_app.tasks[job["task_name"]]
+    _current_job.id = job_id
+    try:
+        task(*json.loads(job["args"]), **json.loads(job["kwargs"]))
+        # Отмененная задача, не дошедшая до проверки raise_if_revoked, остается REVOKED
+        _set_job_state(job_id, JOB_SUCCESS, JOB_STARTED, finished_at=time.time())
+    except JobRevokedError:
+        logger.info(f"Job {job_id} was revoked")
+    except Exception as e:
+        logger.error(f"Job {job_id} ({job['task_name']}) failed: {e}", exc_info=True)
+        _set_job_state(job_id, JOB_FAILURE, JOB_STARTED, error=str(e), finished_at=time.time())
+    finally:
+        _current_job.id = None
+
+
+def submit_task(task, *args, **kwargs):
+    """Ставит задачу в очередь текущего исполнителя и возвращает ее id"""
+    if not is_embedded_executor():
+        return task.apply_async(args=args, kwargs=kwargs).id
+
+    job_id = str(uuid.uuid4())
+    with get_jobs_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, task_name, args, kwargs, state, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, task.name, json.dumps(args), json.dumps(kwargs), JOB_PENDING, time.time()),
+        )
+    _get_pool().submit(_run_job, job_id)
+    return job_id
+
+
+def set_recovery_handler(task, handler):
+    """
+    Как продолжить задачу task, прерванную остановкой лаунчера: handler(args, kwargs) возвращает
+    (args, kwargs) для повторного запуска или None, если задачу продолжить нельзя (тогда она помечается упавшей).
+    """
+    _recovery_handlers[task.name] = handler
+
+
+def _recover_job(job):
+    """Готовит прерванную на середине задачу к повторному запуску; False, если задача помечена упавшей"""
+    handler = _recovery_handlers.get(job["task_name"])
+    recovered = None
+    if handler is not None:
+        try:
+            recovered = handler(json.loads(job["args"]), json.loads(job["kwargs"]))
+        except Exception as e:
+            logger.error(f"Failed to recover job {job['id']} ({job['task_name']}): {e}", exc_info=True)
+    if recovered is None:
+        logger.warning(f"Job {job['id']} ({job['task_name']}) was interrupted by a launcher restart, marking it failed")
+        _set_job_state(
+            job["id"], JOB_FAILURE, JOB_STARTED, error="Interrupted by a launcher restart", finished_at=time.time()
+        )
+        return False
+    args, kwargs = recovered
+    with get_jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET state = ?, args = ?, kwargs = ? WHERE id = ? AND state = ?",
+            (JOB_PENDING, json.dumps(args), json.dumps(kwargs), job["id"], JOB_STARTED),
+        )
+    return True
+
+
+def revoke_task(task_id):
+    """
+    Отменяет задачу. Ожидающая задача не запустится, выполняющаяся прервется на ближайшей
+    проверке raise_if_revoked (между шагами установки).
+    """
+    if not is_embedded_executor():
+        now = time.time()
+        with get_launcher_db(write=True) as conn:
+            conn.execute("DELETE FROM revoked_tasks WHERE revoked_at < ?", (now - REVOKED_TASKS_TTL_SECS,))
+            conn.execute("INSERT OR REPLACE INTO revoked_tasks (task_id, revoked_at) VALUES (?, ?)", (task_id, now))
+        # terminate действует только на воркеры с пулом процессов
+        current_app.control.revoke(task_id, terminate=True)
+        return
+    with get_jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET state = ?, finished_at = ? WHERE id = ? AND state IN (?, ?)",
+            (JOB_REVOKED, time.time(), task_id, JOB_PENDING, JOB_STARTED),
+        )
+
+
+def raise_if_revoked():
+    if not is_embedded_executor():
+        task_id = current_task.request.id if current_task else None
+        if task_id is None:
+            return
+        with get_launcher_db() as conn:
+            revoked = conn.execute("SELECT 1 FROM revoked_tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if revoked:
+            raise JobRevokedError(f"Task {task_id} was revoked")
+        return
+
+    job_id = getattr(_current_job, "id", None)
+    if job_id is None:
+        return
+    job = get_job(job_id)
+    if job and job["state"] == JOB_REVOKED:
+        raise JobRevokedError(f"Job {job_id} was revoked")
+
+
+def store_task_meta(task_id, meta, state):
+    with get_jobs_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO task_meta (task_id, state, meta, updated_at) VALUES (?, ?, ?, ?)",
+            (task_id, state, json.dumps(meta), time.time()),
+        )
+
+
+def load_task_meta(task_id):
+    """(состояние, meta) задачи; для неизвестной задачи - PENDING, как у Celery"""
+    with get_jobs_db() as conn:
+        row = conn.execute("SELECT state, meta FROM task_meta WHERE task_id = ?", (task_id,)).fetchone()
+    if not row:
+        return JOB_PENDING, None
+    return row["state"], json.loads(row["meta"])
+
+
+def start_embedded_executor():
+    """Запускает встроенный исполнитель и продолжает задачи, прерванные остановкой лаунчера"""
+    init_jobs_db()
+    with get_jobs_db() as conn:
+        unfinished_jobs = [
+            dict(row)
+            for row in conn.execute(
+                "SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY created_at", (JOB_PENDING, JOB_STARTED)
+            )
+        ]
+    for job in unfinished_jobs:
+        if job["state"] == JOB_STARTED and not _recover_job(job):
+            continue
+        logger.info(f"Resuming unfinished job {job['id']}")
+        _get_pool().submit(_run_job, job["id"])
+    logger.info(f"Embedded task executor started with {PROVISIONING_CONCURRENCY} workers")
@@ -0,0 +1,108 @@
+import functools
+import os
+import platform
+import re
+import shutil
+import subprocess
+import logging
+from settings import TORCH_VARIANT
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TORCH_INDEX_BASE_URL = "https://download.pytorch.org/whl"
+
+# Вариант torch -> index url для pip (None - обычный PyPI)
+TORCH_VARIANTS = {
+    "cpu": f"{TORCH_INDEX_BASE_URL}/cpu",
+    "cu118": f"{TORCH_INDEX_BASE_URL}/cu118",
+    "cu121": f"{TORCH_INDEX_BASE_URL}/cu121",
+    "cu124": f"{TORCH_INDEX_BASE_URL}/cu124",
+    "rocm5.7": f"{TORCH_INDEX_BASE_URL}/rocm5.7",
+    "rocm6.0": f"{TORCH_INDEX_BASE_URL}/rocm6.0",
+    # На macOS сборки с MPS лежат на PyPI
+    "mps": None,
+}
+
+# Вариант для NVIDIA, если версию CUDA драйвера определить не удалось
+DEFAULT_CUDA_TORCH_VARIANT = "cu121"
+
+# Вариант, который ставился во все проекты до появления выбора сборки torch
+LEGACY_TORCH_VARIANT = "cu121"
+
+# (минимальная версия CUDA драйвера, вариант), от новых к старым
+CUDA_TORCH_VARIANTS = [((12, 4), "cu124"), ((12, 1), "cu121"), ((11, 8), "cu118")]
+
+ROCM_TORCH_VARIANTS = [((6, 0), "rocm6.0"), ((5, 7), "rocm5.7")]
+
+
+def _parse_version(version_str):
+    match = re.match(r"(\d+)\.(\d+)", version_str or "")
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def _pick_variant(version, variants):
+    for min_version, variant in variants:
+        if version >= min_version:
+            return variant
+    return None
+
+
+def _probe_nvidia():
+    nvidia_smi = shutil.which("nvidia-smi")
+    if not nvidia_smi:
+        return None
+    try:
+        output = subprocess.check_output([nvidia_smi], universal_newlines=True, timeout=10)
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.warning(f"nvidia-smi failed: {e}")
+        return None
+    match = re.search(r"CUDA Version:\s*([\d.]+)", output)
+    cuda_version = _parse_version(match.group(1)) if match else None
+    if not cuda_version:
+        return DEFAULT_CUDA_TORCH_VARIANT
+    # Драйвер старее самой старой поддерживаемой сборки - работаем на CPU
+    return _pick_variant(cuda_version, CUDA_TORCH_VARIANTS) or "cpu"
+
+
+def _probe_rocm():
+    rocm_version_path = "/opt/rocm/.info/version"
+    if os.path.exists(rocm_version_path):
+        with open(rocm_version_path, "r") as f:
+            rocm_version = _parse_version(f.read())
+        if rocm_version:
+            return _pick_variant(rocm_version, ROCM_TORCH_VARIANTS)
+    if shutil.which("rocminfo"):
+        return ROCM_TORCH_VARIANTS[0][1]
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def detect_torch_variant():
+    """Определяет подходящую сборку torch для этой машины (результат кешируется на процесс)"""
+    if platform.system() == "Darwin":
+        variant = "mps" if platform.machine() == "arm64" else "cpu"
+    else:
+        variant = _probe_nvidia() or _probe_rocm() or "cpu"
+    logger.info(f"Detected torch variant: {variant}")
+    return variant
+
+
+def resolve_torch_variant(requested_variant=None):
+    """
+    Вариант torch для проекта: явно запрошенный для проекта, иначе TORCH_VARIANT из настроек,
+    а при "auto" - определенный по оборудованию
+    """
+    variant = requested_variant or TORCH_VARIANT
+    if variant == "auto":
+        variant = detect_torch_variant()
+    if variant not in TORCH_VARIANTS:
+        raise ValueError(f"Unknown torch variant: {variant}. Supported: {', '.join(TORCH_VARIANTS)}")
+    return variant
+
+
+def get_torch_index_url(torch_variant):
+    return TORCH_VARIANTS[torch_variant]
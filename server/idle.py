@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+import logging
+import psutil
+import requests
+from launcher_db import get_launcher_db, register_schema
+from ports import get_owner_project_id
+from settings import IDLE_CHECK_INTERVAL_SECS, IDLE_TIMEOUT_SECS, PROJECTS_DIR
+from supervisor import stop_instance
+from utils import get_launcher_state, set_launcher_state_data
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Остановка простаивающих экземпляров ComfyUI. Экземпляр считается активным, пока у него есть промпты
+# в очереди, появляются новые записи в истории или новые соединения с его портом (прямые запросы).
+# Прокси PROXY_MODE держит пул keep-alive соединений и поэтому новых соединений не создает: он сам
+# отмечает время последнего запроса к проекту и открытых WebSocket в таблице proxy_activity. Если ни один экземпляр проекта (с репликами) не активен дольше IDLE_TIMEOUT_SECS, проект
+# останавливается и переходит в состояние idle: порт остается за проектом, и в PROXY_MODE первый запрос к /comfy/<id>/ снова
+# запускает его (см. /api/comfy/<port>/wake).
+
+PROBE_TIMEOUT_SECS = 2
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS proxy_activity (
+        project_id TEXT PRIMARY KEY,
+        last_request_at REAL NOT NULL
+    )
+    """,
+)
+
+
+def record_proxy_activity(project_ids, at=None):
+    """Отмечает запросы через прокси к проектам project_ids (вызывается прокси)"""
+    if not project_ids:
+        return
+    at = at if at is not None else time.time()
+    with get_launcher_db(write=True) as conn:
+        conn.executemany(
+            """
+            INSERT INTO proxy_activity (project_id, last_request_at) VALUES (?, ?)
+            ON CONFLICT (project_id) DO UPDATE SET last_request_at = MAX(last_request_at, excluded.last_request_at)
+            """,
+            [(project_id, at) for project_id in project_ids],
+        )
+
+
+def get_proxy_activity(project_id):
+    """Время последнего запроса к проекту через прокси или None"""
+    with get_launcher_db() as conn:
+        row = conn.execute(
+            "SELECT last_request_at FROM proxy_activity WHERE project_id = ?", (project_id,)
+        ).fetchone()
+    return row["last_request_at"] if row else None
+
+
+def _get_json(port, path):
+    try:
+        return requests.get(f"http://127.0.0.1:{port}{path}", timeout=PROBE_TIMEOUT_SECS).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def _get_client_connections(pid, port):
+    """Адреса клиентов, подключенных к порту экземпляра"""
+    try:
+        processes = [psutil.Process(pid)]
+        processes += processes[0].children(recursive=True)
+    except psutil.Error:
+        return frozenset()
+    connections = set()
+    for process in processes:
+        try:
+            for connection in process.connections(kind="tcp"):
+                if connection.status == psutil.CONN_ESTABLISHED and connection.laddr and connection.laddr.port == port:
+                    connections.add(tuple(connection.raddr))
+        except psutil.Error:
+            continue
+    return frozenset(connections)
+
+
+def get_activity_signature(pid, port):
+    """
+    Снимок активности экземпляра: (длина очереди, последний промпт в истории, соединения клиентов).
+    Любое изменение снимка или непустая очередь - активность.
+    """
+    queue = _get_json(port, "/prompt") or {}
+    history = _get_json(port, "/history?max_items=1") or {}
+    queue_remaining = (queue.get("exec_info") or {}).get("queue_remaining") or 0
+    return queue_remaining, tuple(history.keys()), _get_client_connections(pid, port)
+
+
+class IdleMonitor:
+    def __init__(self, timeout_secs, interval_secs):
+        self.timeout_secs = timeout_secs
+        self.interval_secs = interval_secs
+        # id проекта -> (pid экземпляров, снимки их активности, последний запрос через прокси, время последней активности)
+        self._activity = {}
+        self._thread = None
+
+    def check(self, instances):
+        """Одна проверка экземпляров [(id, pid, port)] в состоянии running; реплики проекта проверяются вместе"""
+        projects = {}
+        for instance_id, pid, port in instances:
+            projects.setdefault(get_owner_project_id(instance_id), []).append((instance_id, pid, port))
+
+        now = time.time()
+        checked_ids = set()
+        for project_id, project_instances in projects.items():
+            checked_ids.add(project_id)
+            pids = tuple(pid for _, pid, _ in project_instances)
+            signatures = tuple(get_activity_signature(pid, port) for _, pid, port in project_instances)
+            proxy_activity = get_proxy_activity(project_id)
+            previous = self._activity.get(project_id)
+            if (
+                previous is None
+                or previous[0] != pids
+                or previous[1] != signatures
+                or previous[2] != proxy_activity
+                or any(signature[0] > 0 for signature in signatures)
+            ):
+                self._activity[project_id] = (pids, signatures, proxy_activity, now)
+                continue
+            # Проект, основной экземпляр которого не запущен, не останавливается по простою реплик
+            pid = next((pid for instance_id, pid, _ in project_instances if instance_id == project_id), None)
+            idle_secs = now - previous[3]
+            if pid and idle_secs >= self.timeout_secs:
+                self.stop_idle_project(project_id, pid, idle_secs)
+                checked_ids.discard(project_id)
+
+        for project_id in set(self._activity) - checked_ids:
+            del self._activity[project_id]
+
+    def stop_idle_project(self, project_id, pid, idle_secs):
+        project_folder_path = os.path.join(PROJECTS_DIR, project_id)
+        launcher_state = get_launcher_state(project_folder_path)
+        if launcher_state.get("state") != "running" or launcher_state.get("pid") != pid:
+            return
+        logger.info(f"Stopping project {project_id} after {int(idle_secs)}s without activity")
+        stop_instance(project_folder_path)
+        # Порт не освобождается: по нему проект будет разбужен
+        set_launcher_state_data(
+            project_folder_path,
+            {
+                "state": "idle",
+                "status_message": f"Stopped after {int(idle_secs // 60)} min of inactivity",
+                "pid": None,
+                "idle_since": time.time(),
+            },
+        )
+
+    def _run(self, get_projects):
+        while True:
+            time.sleep(self.interval_secs)
+            try:
+                self.check(get_projects())
+            except Exception as e:
+                logger.error(f"Idle check failed: {e}", exc_info=True)
+
+    def start(self, get_projects):
+        """Запускает проверки, если задан IDLE_TIMEOUT_SECS; get_projects() возвращает [(id, pid, port)] экземпляров в состоянии running"""
+        if self.timeout_secs <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(get_projects,), name="idle-monitor", daemon=True)
+        self._thread.start()
+
+
+idle_monitor = IdleMonitor(IDLE_TIMEOUT_SECS, IDLE_CHECK_INTERVAL_SECS)
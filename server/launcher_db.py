@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from settings import LAUNCHER_DB_PATH
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Общая база лаунчера в SQLite (режим WAL): ее одновременно используют сервер API и воркеры Celery.
+# Модули регистрируют свои таблицы через register_schema, схема создается при первом подключении.
+
+_schema_statements = []
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def register_schema(*statements):
+    """Добавляет идемпотентные SQL-выражения (CREATE TABLE IF NOT EXISTS ...) к схеме базы"""
+    global _schema_ready
+    with _schema_lock:
+        _schema_statements.extend(statements)
+        _schema_ready = False
+
+
+def _connect():
+    conn = sqlite3.connect(LAUNCHER_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in _schema_statements:
+            conn.execute(statement)
+        _schema_ready = True
+
+
+@contextmanager
+def get_launcher_db(write=False):
+    """
+    Соединение с базой в транзакции. С write=True транзакция сразу берет блокировку записи
+    (BEGIN IMMEDIATE), так что чтение-и-изменение внутри нее атомарно для всех процессов.
+    """
+    conn = _connect()
+    try:
+        _ensure_schema(conn)
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+import logging
+from collections import deque
+import psutil
+import requests
+from settings import METRICS_HISTORY_SIZE, METRICS_SAMPLE_INTERVAL_SECS
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Метрики запущенных экземпляров ComfyUI: фоновый поток раз в METRICS_SAMPLE_INTERVAL_SECS снимает
+# CPU%, RSS/USS, открытые файлы, потоки и байты ввода-вывода по дереву процессов каждого экземпляра
+# и длину очереди ComfyUI (/prompt). Последние METRICS_HISTORY_SIZE замеров хранятся в памяти процесса,
+# поэтому замеры снимает и отдает только процесс сервера API, в котором запущен сборщик (сервер работает
+# в одном процессе, см. serving); в остальных процессах is_running() - False, и истории нет.
+# Сводка по хосту - загрузка CPU и памяти и проекты, занимающие больше всего памяти.
+
+QUEUE_PROBE_TIMEOUT_SECS = 1
+TOP_PROJECTS_COUNT = 5
+
+
+def get_queue_depth(port):
+    """Число промптов в очереди ComfyUI (включая выполняемый), либо None, если он не ответил"""
+    try:
+        response = requests.get(f"http://127.0.0.1:{port}/prompt", timeout=QUEUE_PROBE_TIMEOUT_SECS)
+        return response.json()["exec_info"]["queue_remaining"]
+    except (requests.RequestException, ValueError, KeyError, TypeError):
+        return None
+
+
+class MetricsSampler:
+    def __init__(self, history_size, interval_secs):
+        self.history_size = history_size
+        self.interval_secs = interval_secs
+        self._lock = threading.Lock()
+        self._samples = {}
+        # psutil.Process по pid: cpu_percent считается между двумя вызовами на одном объекте
+        self._processes = {}
+        # Загрузка CPU хоста за последний интервал замеров
+        self._host_cpu_percent = None
+        self._host_per_cpu_percent = None
+        self._thread = None
+
+    def _get_process(self, pid):
+        process = self._processes.get(pid)
+        if process is None or not process.is_running():
+            process = psutil.Process(pid)
+            process.cpu_percent(None)
+            self._processes[pid] = process
+        return process
+
+    def _sample_process_tree(self, pid):
+        root = self._get_process(pid)
+        processes = [root] + [self._get_process(child.pid) for child in root.children(recursive=True)]
+        sample = {
+            "cpu_percent": 0.0,
+            "rss_bytes": 0,
+            "uss_bytes": None,
+            "open_files": 0,
+            "threads": 0,
+            "io_read_bytes": None,
+            "io_write_bytes": None,
+            "processes": len(processes),
+        }
+        for process in processes:
+            try:
+                with process.oneshot():
+                    sample["cpu_percent"] += process.cpu_percent(None)
+                    sample["rss_bytes"] += process.memory_info().rss
+                    sample["threads"] += process.num_threads()
+                    sample["open_files"] += process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+                    try:
+                        # USS требует чтения smaps и прав на процесс
+                        sample["uss_bytes"] = (sample["uss_bytes"] or 0) + process.memory_full_info().uss
+                    except (psutil.AccessDenied, AttributeError):
+                        pass
+                    if hasattr(process, "io_counters"):
+                        io = process.io_counters()
+                        sample["io_read_bytes"] = (sample["io_read_bytes"] or 0) + io.read_bytes
+                        sample["io_write_bytes"] = (sample["io_write_bytes"] or 0) + io.write_bytes
+            except psutil.Error:
+                # Процесс завершился между замерами или недоступен
+                continue
+        return sample
+
+    def sample(self, projects):
+        """Один замер по проектам [(id, pid, port)]"""
+        now = time.time()
+        self._host_cpu_percent = psutil.cpu_percent(None)
+        self._host_per_cpu_percent = psutil.cpu_percent(None, percpu=True)
+        for project_id, pid, port in projects:
+            try:
+                sample = self._sample_process_tree(pid)
+            except psutil.Error:
+                continue
+            sample["timestamp"] = now
+            sample["queue_depth"] = get_queue_depth(port) if port else None
+            with self._lock:
+                if project_id not in self._samples:
+                    self._samples[project_id] = deque(maxlen=self.history_size)
+                self._samples[project_id].append(sample)
+
+        with self._lock:
+            # Остановленные проекты: история больше не нужна
+            for project_id in set(self._samples) - {project_id for project_id, _, _ in projects}:
+                del self._samples[project_id]
+        self._processes = {pid: p for pid, p in self._processes.items() if p.is_running()}
+
+    def get_samples(self, project_id, since=None):
+        with self._lock:
+            samples = list(self._samples.get(project_id, ()))
+        if since is not None:
+            samples = [sample for sample in samples if sample["timestamp"] > since]
+        return samples
+
+    def get_latest_samples(self):
+        with self._lock:
+            return {project_id: samples[-1] for project_id, samples in self._samples.items() if samples}
+
+    def get_host_summary(self):
+        memory = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        latest = self.get_latest_samples()
+        top_by_memory = sorted(latest.items(), key=lambda item: item[1]["rss_bytes"], reverse=True)
+        summary = {
+            "timestamp": time.time(),
+            "cpu_count": psutil.cpu_count(),
+            "cpu_percent": self._host_cpu_percent,
+            "per_cpu_percent": self._host_per_cpu_percent,
+            "load_average": list(os.getloadavg()) if hasattr(os, "getloadavg") else None,
+            "memory_total_bytes": memory.total,
+            "memory_available_bytes": memory.available,
+            "memory_percent": memory.percent,
+            "swap_percent": swap.percent,
+            "running_projects": len(latest),
+            "projects_cpu_percent": sum(sample["cpu_percent"] for sample in latest.values()),
+            "projects_rss_bytes": sum(sample["rss_bytes"] for sample in latest.values()),
+            "top_projects_by_memory": [
+                {"id": project_id, "rss_bytes": sample["rss_bytes"], "cpu_percent": sample["cpu_percent"]}
+                for project_id, sample in top_by_memory[:TOP_PROJECTS_COUNT]
+            ],
+        }
+        return summary
+
+    def _run(self, get_projects):
+        while True:
+            try:
+                self.sample(get_projects())
+            except Exception as e:
+                logger.error(f"Metrics sampling failed: {e}", exc_info=True)
+            time.sleep(self.interval_secs)
+
+    def is_running(self):
+        """Сборщик работает в этом процессе (после fork поток сборщика в дочернем процессе не существует)"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, get_projects):
+        """Запускает фоновые замеры; get_projects() возвращает [(id, pid, port)] запущенных проектов"""
+        if not self.is_running():
+            self._thread = threading.Thread(target=self._run, args=(get_projects,), name="metrics-sampler", daemon=True)
+            self._thread.start()
+
+
+metrics_sampler = MetricsSampler(METRICS_HISTORY_SIZE, METRICS_SAMPLE_INTERVAL_SECS)
@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+from launcher_db import get_launcher_db, register_schema
+from settings import PROJECT_MAX_PORT, PROJECT_MIN_PORT, PROJECTS_DIR
+from state_store import get_pinned_project_port
+from utils import is_port_in_use
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Аренда портов проектов в общей базе лаунчера. Свободные порты диапазона PROJECT_MIN_PORT..PROJECT_MAX_PORT
+# лежат в списке free_ports: выдача - взять первый, освобождение - вернуть. Порт, указанный при создании
+# проекта, закреплен за проектом. Порт, занятый сторонним процессом, помечается арендой
+# EXTERNAL_OWNER и возвращается в список после PORT_SQUATTER_RECHECK_SECS. Реплики проекта арендуют
+# порты под своими id вида <id проекта>#<номер реплики>.
+
+EXTERNAL_OWNER = "__external__"
+REPLICA_SEPARATOR = "#"
+PORT_SQUATTER_RECHECK_SECS = 60
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS port_leases (
+        port INTEGER PRIMARY KEY,
+        project_id TEXT NOT NULL,
+        pinned INTEGER NOT NULL DEFAULT 0,
+        leased_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS port_leases_project_id ON port_leases (project_id)",
+    "CREATE TABLE IF NOT EXISTS free_ports (port INTEGER PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS port_range (id INTEGER PRIMARY KEY CHECK (id = 1), min_port INTEGER, max_port INTEGER)",
+)
+
+
+class PortLeaseError(Exception):
+    pass
+
+
+def get_replica_owner_id(project_id, replica):
+    """Id, под которым реплика арендует порт и ядра; основной экземпляр (реплика 0) - под id проекта"""
+    return f"{project_id}{REPLICA_SEPARATOR}{replica}" if replica else project_id
+
+
+def get_owner_project_id(owner_id):
+    return owner_id.split(REPLICA_SEPARATOR, 1)[0]
+
+
+def get_pinned_port(project_id):
+    return get_pinned_project_port(os.path.join(PROJECTS_DIR, project_id))
+
+
+def _is_in_range(port):
+    return PROJECT_MIN_PORT <= port <= PROJECT_MAX_PORT
+
+
+def _sync_free_ports(conn):
+    """Пересобирает список свободных портов, если диапазон в настройках изменился"""
+    row = conn.execute("SELECT min_port, max_port FROM port_range WHERE id = 1").fetchone()
+    if row and (row["min_port"], row["max_port"]) == (PROJECT_MIN_PORT, PROJECT_MAX_PORT):
+        return
+    conn.execute("DELETE FROM free_ports")
+    conn.execute(
+        """
+        WITH RECURSIVE ports(port) AS (SELECT ? UNION ALL SELECT port + 1 FROM ports WHERE port < ?)
+        INSERT INTO free_ports (port) SELECT port FROM ports WHERE port NOT IN (SELECT port FROM port_leases)
+        """,
+        (PROJECT_MIN_PORT, PROJECT_MAX_PORT),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO port_range (id, min_port, max_port) VALUES (1, ?, ?)",
+        (PROJECT_MIN_PORT, PROJECT_MAX_PORT),
+    )
+
+
+def _free_port(conn, port):
+    conn.execute("DELETE FROM port_leases WHERE port = ?", (port,))
+    if _is_in_range(port):
+        conn.execute("INSERT OR IGNORE INTO free_ports (port) VALUES (?)", (port,))
+
+
+def _expire_external_leases(conn):
+    for row in conn.execute(
+        "SELECT port FROM port_leases WHERE project_id = ? AND leased_at < ?",
+        (EXTERNAL_OWNER, time.time() - PORT_SQUATTER_RECHECK_SECS),
+    ).fetchall():
+        _free_port(conn, row["port"])
+
+
+def _reclaim_orphaned_leases(conn):
+    """Освобождает порты проектов, папки которых удалены в обход API"""
+    reclaimed = 0
+    for row in conn.execute("SELECT port, project_id FROM port_leases WHERE project_id != ?", (EXTERNAL_OWNER,)).fetchall():
+        if not os.path.isdir(os.path.join(PROJECTS_DIR, get_owner_project_id(row["project_id"]))):
+            _free_port(conn, row["port"])
+            reclaimed += 1
+    return reclaimed
+
+
+def _lease(conn, port, project_id, pinned=False):
+    conn.execute("DELETE FROM free_ports WHERE port = ?", (port,))
+    conn.execute(
+        "INSERT OR REPLACE INTO port_leases (port, project_id, pinned, leased_at) VALUES (?, ?, ?, ?)",
+        (port, project_id, int(pinned), time.time()),
+    )
+
+
+def _lease_pinned_port(conn, project_id, pinned_port):
+    row = conn.execute("SELECT project_id FROM port_leases WHERE port = ?", (pinned_port,)).fetchone()
+    if (
+        row
+        and row["project_id"] not in (project_id, EXTERNAL_OWNER)
+        and os.path.isdir(os.path.join(PROJECTS_DIR, get_owner_project_id(row["project_id"])))
+    ):
+        raise PortLeaseError(f"Port {pinned_port} is leased by project {row['project_id']}")
+    for other in conn.execute(
+        "SELECT port FROM port_leases WHERE project_id = ? AND port != ?", (project_id, pinned_port)
+    ).fetchall():
+        _free_port(conn, other["port"])
+    _lease(conn, pinned_port, project_id, pinned=True)
+    return pinned_port
+
+
+def _lease_free_port(conn, project_id):
+    while True:
+        row = conn.execute("SELECT port FROM free_ports ORDER BY port LIMIT 1").fetchone()
+        if row is None and _reclaim_orphaned_leases(conn):
+            continue
+        if row is None:
+            raise PortLeaseError(f"No free port in range {PROJECT_MIN_PORT}-{PROJECT_MAX_PORT}")
+        port = row["port"]
+        if is_port_in_use(port):
+            logger.warning(f"Port {port} is used by another process, skipping it")
+            _lease(conn, port, EXTERNAL_OWNER)
+            continue
+        _lease(conn, port, project_id)
+        return port
+
+
+def acquire_project_port(project_id):
+    """Возвращает порт, арендованный проектом (выдавая новый, если аренды еще нет)"""
+    pinned_port = get_pinned_port(project_id)
+    with get_launcher_db(write=True) as conn:
+        _sync_free_ports(conn)
+        _expire_external_leases(conn)
+        if pinned_port:
+            return _lease_pinned_port(conn, project_id, pinned_port)
+        row = conn.execute("SELECT port FROM port_leases WHERE project_id = ?", (project_id,)).fetchone()
+        if row:
+            return row["port"]
+        port = _lease_free_port(conn, project_id)
+        logger.info(f"Leased port {port} to project {project_id}")
+        return port
+
+
+def release_project_port(project_id, keep_pinned=True):
+    """Освобождает порт проекта. Закрепленный порт остается за проектом до его удаления, если keep_pinned."""
+    with get_launcher_db(write=True) as conn:
+        _sync_free_ports(conn)
+        for row in conn.execute(
+            "SELECT port, pinned FROM port_leases WHERE project_id = ?", (project_id,)
+        ).fetchall():
+            if keep_pinned and row["pinned"]:
+                continue
+            _free_port(conn, row["port"])
+
+
+def get_project_port(project_id):
+    """Порт проекта без выдачи нового: закрепленный или арендованный, иначе None"""
+    pinned_port = get_pinned_port(project_id)
+    if pinned_port:
+        return pinned_port
+    with get_launcher_db() as conn:
+        row = conn.execute("SELECT port FROM port_leases WHERE project_id = ?", (project_id,)).fetchone()
+    return row["port"] if row else None
+
+
+def get_port_owner(port):
+    """Id проекта, за которым закреплен или арендован порт, иначе None"""
+    with get_launcher_db() as conn:
+        row = conn.execute(
+            "SELECT project_id FROM port_leases WHERE port = ? AND project_id != ?", (port, EXTERNAL_OWNER)
+        ).fetchone()
+    return get_owner_project_id(row["project_id"]) if row else None
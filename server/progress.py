@@ -0,0 +1,123 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from celery import current_app
+from executor import is_embedded_executor, load_task_meta, store_task_meta
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Подробный прогресс установки проекта публикуется в result backend Celery под постоянным id
+# provision-<id проекта>, общим для всех задач установки (включая цепочки по шагам), так что
+# API читает его по id проекта без обращения к файлам проекта. Со встроенным исполнителем
+# (TASK_EXECUTOR=embedded) прогресс хранится в его базе задач.
+
+PROGRESS_STATE = "PROGRESS"
+SUCCESS_STATE = "SUCCESS"
+# Не FAILURE: для него Celery ожидает в результате сериализованное исключение
+ERROR_STATE = "ERROR"
+
+# Не чаще одной записи в секунду на проект (кроме смены шага и завершения)
+PROGRESS_PUBLISH_INTERVAL_SECS = 1
+
+_current = threading.local()
+
+
+def get_progress_task_id(project_id):
+    return f"provision-{project_id}"
+
+
+def get_progress(project_id):
+    """(состояние, прогресс) установки проекта из result backend"""
+    if is_embedded_executor():
+        return load_task_meta(get_progress_task_id(project_id))
+    result = current_app.AsyncResult(get_progress_task_id(project_id))
+    info = result.info
+    return result.state, info if isinstance(info, dict) else None
+
+
+class ProvisioningProgress:
+    def __init__(self, project_id, resume=False):
+        self.task_id = get_progress_task_id(project_id)
+        self.meta = {
+            "project_id": project_id,
+            "step_index": None,
+            "step_count": None,
+            "stage": None,
+            "custom_node": None,
+            "file": None,
+            "files_done": 0,
+            "files_total": None,
+            "bytes_downloaded": 0,
+            "file_bytes_total": None,
+            "pip_packages_installed": 0,
+            "error": None,
+            "updated_at": None,
+        }
+        if resume:
+            # Следующая задача цепочки продолжает счетчики предыдущей
+            _, previous_meta = get_progress(project_id)
+            if previous_meta:
+                self.meta.update(previous_meta)
+            self.meta["error"] = None
+        self._lock = threading.Lock()
+        self._last_published_at = 0
+
+    def update(self, force=False, **fields):
+        with self._lock:
+            self.meta.update(fields)
+        self.publish(force=force)
+
+    def add(self, field, amount):
+        with self._lock:
+            self.meta[field] = (self.meta.get(field) or 0) + amount
+        self.publish()
+
+    def publish(self, state=PROGRESS_STATE, force=False):
+        now = time.time()
+        if not force and now - self._last_published_at < PROGRESS_PUBLISH_INTERVAL_SECS:
+            return
+        self._last_published_at = now
+        with self._lock:
+            self.meta["updated_at"] = now
+            meta = dict(self.meta)
+        try:
+            if is_embedded_executor():
+                store_task_meta(self.task_id, meta, state)
+            else:
+                current_app.backend.store_result(self.task_id, meta, state)
+        except Exception as e:
+            logger.warning(f"Failed to publish provisioning progress: {e}")
+
+    def finish(self):
+        self.publish(state=SUCCESS_STATE, force=True)
+
+    def fail(self, error):
+        with self._lock:
+            self.meta["error"] = str(error)
+        self.publish(state=ERROR_STATE, force=True)
+
+
+@contextmanager
+def tracking_progress(progress):
+    """Делает progress текущим для потока: report_progress/add_progress пишут в него"""
+    previous = getattr(_current, "progress", None)
+    _current.progress = progress
+    try:
+        yield progress
+    finally:
+        _current.progress = previous
+
+
+def report_progress(force=False, **fields):
+    progress = getattr(_current, "progress", None)
+    if progress is not None:
+        progress.update(force=force, **fields)
+
+
+def add_progress(field, amount):
+    progress = getattr(_current, "progress", None)
+    if progress is not None:
+        progress.add(field, amount)
@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import logging
+import requests
+from launcher_db import get_launcher_db, register_schema
+from settings import BATCH_JOB_PROMPT_TIMEOUT_SECS, PROMPT_CACHE_DIR, PROMPT_CACHE_MAX_MB
+from utils import compute_sha256_checksum, get_launcher_state, get_stage_fingerprints
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Кеш результатов промптов. Ключ - sha256 канонического JSON промпта в формате API ComfyUI, отпечатка
+# окружения проекта (отпечатки шагов установки, общий runtime, вариант torch, набор custom_nodes) и
+# sha256 входных файлов из comfyui/input и размеров/mtime файлов моделей из comfyui/models, на которые
+# ссылается промпт (замена чекпойнта или LoRA под тем же именем меняет ключ). Выходные файлы выполненного
+# промпта копируются в PROMPT_CACHE_DIR/<ключ>/, и тот же промпт (POST /api/projects/<id>/prompt или
+# элемент пакетного задания) сразу получает сохраненный результат без обращения к ComfyUI.
+# Размер кеша ограничен PROMPT_CACHE_MAX_MB, при переполнении удаляются давно не использованные записи.
+# Кеш отключается для запроса параметром "cache": false.
+
+# Метаданные UI, не влияющие на выполнение
+IGNORED_NODE_KEYS = ("_meta",)
+# Аннотация папки в значениях входов LoadImage и т.п.: "image.png [input]"
+INPUT_ANNOTATIONS = (" [input]", " [output]", " [temp]")
+KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+HISTORY_POLL_SECS = 2
+REQUEST_TIMEOUT_SECS = 30
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS prompt_cache (
+        key TEXT PRIMARY KEY,
+        project_id TEXT NOT NULL,
+        prompt_id TEXT,
+        outputs TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS prompt_cache_last_used_at ON prompt_cache (last_used_at)",
+    "CREATE INDEX IF NOT EXISTS prompt_cache_project_id ON prompt_cache (project_id)",
+)
+
+# (путь, размер, mtime) -> sha256 входного файла
+_input_digests = {}
+_input_digests_lock = threading.Lock()
+
+
+def is_prompt_cache_enabled():
+    return PROMPT_CACHE_MAX_MB > 0
+
+
+def canonicalize_prompt(prompt):
+    """Канонический JSON промпта: порядок ключей и метаданные узлов не влияют на ключ"""
+    nodes = {
+        str(node_id): {key: value for key, value in node.items() if key not in IGNORED_NODE_KEYS}
+        if isinstance(node, dict)
+        else node
+        for node_id, node in prompt.items()
+    }
+    return json.dumps(nodes, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def get_environment_fingerprint(project_folder_path):
+    launcher_state = get_launcher_state(project_folder_path)
+    custom_nodes_path = os.path.join(project_folder_path, "comfyui", "custom_nodes")
+    custom_nodes = sorted(os.listdir(custom_nodes_path)) if os.path.isdir(custom_nodes_path) else []
+    canonical = json.dumps(
+        [
+            get_stage_fingerprints(project_folder_path),
+            launcher_state.get("runtime"),
+            launcher_state.get("torch_variant"),
+            custom_nodes,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _get_input_digest(file_path):
+    stat_result = os.stat(file_path)
+    memo_key = (file_path, stat_result.st_size, stat_result.st_mtime_ns)
+    with _input_digests_lock:
+        digest = _input_digests.get(memo_key)
+    if digest is None:
+        digest = compute_sha256_checksum(file_path)
+        with _input_digests_lock:
+            _input_digests[memo_key] = digest
+    return digest
+
+
+def get_input_digests(project_folder_path, prompt):
+    """sha256 файлов comfyui/input, на которые ссылаются строковые входы промпта"""
+    input_dir = os.path.realpath(os.path.join(project_folder_path, "comfyui", "input"))
+    digests = {}
+    for node in prompt.values():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        for value in (inputs or {}).values():
+            if not isinstance(value, str) or not value:
+                continue
+            for annotation in INPUT_ANNOTATIONS:
+                if value.endswith(annotation):
+                    value = value[: -len(annotation)]
+            file_path = os.path.realpath(os.path.join(input_dir, value))
+            if not file_path.startswith(input_dir + os.sep) or not os.path.isfile(file_path):
+                continue
+            digests[value] = _get_input_digest(file_path)
+    return digests
+
+
+def get_model_signatures(project_folder_path, prompt):
+    """
+    Размер и mtime файлов comfyui/models/<папка>/, на которые ссылаются строковые входы промпта
+    (ckpt_name, lora_name и т.п.). Модели занимают гигабайты, поэтому sha256 не считается.
+    """
+    models_dir = os.path.join(project_folder_path, "comfyui", "models")
+    if not os.path.isdir(models_dir):
+        return {}
+    model_folders = sorted(
+        name for name in os.listdir(models_dir) if os.path.isdir(os.path.join(models_dir, name))
+    )
+    signatures = {}
+    for node in prompt.values():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        for value in (inputs or {}).values():
+            if not isinstance(value, str) or not value or value in signatures:
+                continue
+            for folder in model_folders:
+                folder_path = os.path.join(models_dir, folder)
+                # Файлы моделей могут быть симлинками на общее хранилище, поэтому путь проверяется без realpath
+                file_path = os.path.normpath(os.path.join(folder_path, value))
+                if not file_path.startswith(folder_path + os.sep) or not os.path.isfile(file_path):
+                    continue
+                stat_result = os.stat(file_path)
+                signatures.setdefault(value, []).append(
+                    [folder, stat_result.st_size, stat_result.st_mtime_ns]
+                )
+    return signatures
+
+
+def compute_prompt_cache_key(project_folder_path, prompt):
+    sha256 = hashlib.sha256()
+    sha256.update(canonicalize_prompt(prompt).encode("utf-8"))
+    sha256.update(get_environment_fingerprint(project_folder_path).encode("utf-8"))
+    sha256.update(json.dumps(get_input_digests(project_folder_path, prompt), sort_keys=True).encode("utf-8"))
+    sha256.update(json.dumps(get_model_signatures(project_folder_path, prompt), sort_keys=True).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def get_cache_entry_path(key):
+    return os.path.join(PROMPT_CACHE_DIR, key)
+
+
+def get_cached_result(key):
+    """Сохраненный результат {"key", "prompt_id", "outputs", "created_at"} или None; отмечает использование записи"""
+    if not is_prompt_cache_enabled():
+        return None
+    with get_launcher_db(write=True) as conn:
+        row = conn.execute("SELECT * FROM prompt_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.isdir(get_cache_entry_path(key)):
+            conn.execute("DELETE FROM prompt_cache WHERE key = ?", (key,))
+            return None
+        conn.execute(
+            "UPDATE prompt_cache SET hits = hits + 1, last_used_at = ? WHERE key = ?",
+            (time.time(), key),
+        )
+    return {
+        "key": key,
+        "prompt_id": row["prompt_id"],
+        "outputs": json.loads(row["outputs"]),
+        "created_at": row["created_at"],
+    }
+
+
+def get_cached_file_path(key, file_name):
+    if not KEY_RE.match(key) or os.path.basename(file_name) != file_name or file_name in ("", ".", ".."):
+        return None
+    file_path = os.path.join(get_cache_entry_path(key), file_name)
+    return file_path if os.path.isfile(file_path) else None
+
+
+def store_prompt_result(key, project_id, prompt_id, outputs, source_dir):
+    """
+    Сохраняет выходные файлы промпта: outputs - [{"node_id", "kind", "file", "source"}], где file - имя файла
+    в source_dir. Файлы копируются в кеш под именами <узел>_<имя файла в ComfyUI>.
+    """
+    if not is_prompt_cache_enabled() or not outputs:
+        return
+    entry_path = get_cache_entry_path(key)
+    if os.path.isdir(entry_path):
+        return
+    os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+    tmp_path = os.path.join(PROMPT_CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp_path)
+    cached_outputs = []
+    size_bytes = 0
+    try:
+        for output in outputs:
+            file_name = f"{output['node_id']}_{os.path.basename(output['source']['filename'])}"
+            while os.path.exists(os.path.join(tmp_path, file_name)):
+                file_name = f"{output['node_id']}_{uuid.uuid4().hex[:8]}_{os.path.basename(output['source']['filename'])}"
+            shutil.copyfile(os.path.join(source_dir, output["file"]), os.path.join(tmp_path, file_name))
+            size_bytes += os.path.getsize(os.path.join(tmp_path, file_name))
+            cached_outputs.append({**output, "file": file_name})
+        os.rename(tmp_path, entry_path)
+    except OSError as e:
+        # Запись уже сохранена параллельным запросом или файлы недоступны
+        logger.warning(f"Failed to cache result of prompt {prompt_id}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    now = time.time()
+    with get_launcher_db(write=True) as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO prompt_cache (key, project_id, prompt_id, outputs, size_bytes, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (key, project_id, prompt_id, json.dumps(cached_outputs), size_bytes, now, now),
+        )
+    _evict()
+
+
+def copy_cached_outputs(cached, target_dir, prefix=""):
+    """Копирует файлы сохраненного результата в target_dir; возвращает outputs с новыми именами файлов"""
+    outputs = []
+    for output in cached["outputs"]:
+        file_name = prefix + output["file"]
+        shutil.copyfile(os.path.join(get_cache_entry_path(cached["key"]), output["file"]), os.path.join(target_dir, file_name))
+        outputs.append({**output, "file": file_name, "cached": True})
+    return outputs
+
+
+def _evict():
+    """Удаляет давно не использованные записи, пока кеш больше PROMPT_CACHE_MAX_MB"""
+    max_bytes = PROMPT_CACHE_MAX_MB * 1024 * 1024
+    evicted = []
+    with get_launcher_db(write=True) as conn:
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM prompt_cache").fetchone()[0]
+        if total <= max_bytes:
+            return
+        for row in conn.execute("SELECT key, size_bytes FROM prompt_cache ORDER BY last_used_at").fetchall():
+            if total <= max_bytes:
+                break
+            evicted.append(row["key"])
+            total -= row["size_bytes"]
+        conn.executemany("DELETE FROM prompt_cache WHERE key = ?", [(key,) for key in evicted])
+    for key in evicted:
+        shutil.rmtree(get_cache_entry_path(key), ignore_errors=True)
+    logger.info(f"Evicted {len(evicted)} prompt results from the cache")
+
+
+def delete_project_prompt_cache(project_id):
+    with get_launcher_db(write=True) as conn:
+        keys = [row["key"] for row in conn.execute("SELECT key FROM prompt_cache WHERE project_id = ?", (project_id,))]
+        conn.execute("DELETE FROM prompt_cache WHERE project_id = ?", (project_id,))
+    for key in keys:
+        shutil.rmtree(get_cache_entry_path(key), ignore_errors=True)
+
+
+def download_prompt_outputs(port, prompt_id, entry, target_dir, prefix=""):
+    """Скачивает через /view выходные файлы записи истории ComfyUI; возвращает [{"node_id", "kind", "file", "source"}]"""
+    outputs = []
+    for node_id, node_outputs in (entry.get("outputs") or {}).items():
+        for kind, files in node_outputs.items():
+            for file in files if isinstance(files, list) else []:
+                if not isinstance(file, dict) or "filename" not in file:
+                    continue
+                file_name = f"{prefix}{node_id}_{os.path.basename(file['filename'])}"
+                params = {
+                    "filename": file["filename"],
+                    "subfolder": file.get("subfolder", ""),
+                    "type": file.get("type", "output"),
+                }
+                with requests.get(
+                    f"http://127.0.0.1:{port}/view", params=params, stream=True, timeout=REQUEST_TIMEOUT_SECS
+                ) as response:
+                    response.raise_for_status()
+                    with open(os.path.join(target_dir, file_name), "wb") as f:
+                        for chunk in response.iter_content(1024 * 1024):
+                            f.write(chunk)
+                outputs.append({"node_id": node_id, "kind": kind, "file": file_name, "source": params})
+    return outputs
+
+
+class _ResultCollector:
+    """Ждет выполнения промптов, отправленных мимо кеша, и сохраняет их результаты"""
+
+    def __init__(self):
+        # prompt_id -> (ключ, id проекта, порт, срок ожидания)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, key, project_id, port, prompt_id):
+        with self._lock:
+            self._pending[prompt_id] = (key, project_id, port, time.time() + BATCH_JOB_PROMPT_TIMEOUT_SECS)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="prompt-cache", daemon=True)
+                self._thread.start()
+
+    def _collect(self, prompt_id, key, project_id, port):
+        """True, когда промпт больше не нужно отслеживать"""
+        try:
+            entry = requests.get(f"http://127.0.0.1:{port}/history/{prompt_id}", timeout=REQUEST_TIMEOUT_SECS).json().get(prompt_id)
+        except (requests.RequestException, ValueError):
+            return False
+        if entry is None:
+            return False
+        status = entry.get("status") or {}
+        if status.get("status_str") == "error":
+            return True
+        if not status.get("completed", True):
+            return False
+        os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+        download_path = os.path.join(PROMPT_CACHE_DIR, f".download-{uuid.uuid4().hex}")
+        os.makedirs(download_path)
+        try:
+            outputs = download_prompt_outputs(port, prompt_id, entry, download_path)
+            store_prompt_result(key, project_id, prompt_id, outputs, download_path)
+        except (requests.RequestException, OSError) as e:
+            logger.warning(f"Failed to cache result of prompt {prompt_id}: {e}")
+        finally:
+            shutil.rmtree(download_path, ignore_errors=True)
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(HISTORY_POLL_SECS)
+            with self._lock:
+                pending = list(self._pending.items())
+            if not pending:
+                continue
+            for prompt_id, (key, project_id, port, deadline) in pending:
+                try:
+                    done = self._collect(prompt_id, key, project_id, port) or time.time() > deadline
+                except Exception as e:
+                    logger.error(f"Failed to cache result of prompt {prompt_id}: {e}", exc_info=True)
+                    done = True
+                if done:
+                    with self._lock:
+                        self._pending.pop(prompt_id, None)
+
+
+result_collector = _ResultCollector()
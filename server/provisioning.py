@@ -0,0 +1,358 @@
+import filecmp
+import json
+import os
+import shutil
+import logging
+from hardware import get_torch_index_url, resolve_torch_variant
+from executor import raise_if_revoked
+from progress import report_progress
+from state_store import set_pinned_project_port
+from utils import (
+    COMFYUI_REPO_URL,
+    clone_custom_nodes_from_snapshot,
+    clone_default_custom_nodes,
+    clone_or_checkout_repo,
+    compute_stage_fingerprint,
+    create_symlink,
+    create_virtualenv,
+    get_stage_fingerprints,
+    install_default_custom_nodes,
+    install_pip_reqs,
+    install_requirements_file,
+    link_tree,
+    normalize_model_filepaths_in_workflow_json,
+    record_stage_fingerprint,
+    relocate_virtualenv,
+    set_default_workflow_from_launcher_json,
+    set_launcher_state_data,
+    set_tree_read_only,
+    setup_custom_nodes_from_snapshot,
+    setup_files_from_launcher_json,
+    setup_initial_models_folder,
+    write_json_atomic,
+)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VENV_INCOMPLETE = "incomplete"
+
+# Каталоги ComfyUI с данными конкретного проекта, которые не переносятся при форке
+COMFYUI_PROJECT_STATE_DIRS = {"models", "input", "output", "temp", "user"}
+
+
+class ProvisioningContext:
+    def __init__(self, project_folder_path, models_folder_path, launcher_json=None, port=None, fork_from_path=None, torch_variant=None):
+        self.project_folder_path = os.path.abspath(project_folder_path)
+        self.models_folder_path = os.path.abspath(models_folder_path)
+        self.launcher_json = launcher_json
+        self.port = port
+        self.fork_from_path = os.path.abspath(fork_from_path) if fork_from_path else None
+        self.torch_variant = resolve_torch_variant(torch_variant)
+
+
+def stage_fork_environment(ctx):
+    """
+    Для форка: клонирует comfyui/ и venv/ исходного проекта через reflink/жесткие ссылки
+    вместе с отпечатками шагов, так что дальнейшие шаги применяют только отличия
+    """
+    if not ctx.fork_from_path:
+        return
+
+    source_comfyui_path = os.path.join(ctx.fork_from_path, "comfyui")
+
+    def ignore_project_state(dir_path, names):
+        if os.path.abspath(dir_path) == source_comfyui_path:
+            return [name for name in names if name in COMFYUI_PROJECT_STATE_DIRS]
+        return []
+
+    for folder_name in ("comfyui", "venv"):
+        target_path = os.path.join(ctx.project_folder_path, folder_name)
+        if os.path.exists(target_path):
+            logger.info(f"Removing partially forked folder: {target_path}")
+            shutil.rmtree(target_path, ignore_errors=True)
+
+    link_tree(source_comfyui_path, os.path.join(ctx.project_folder_path, "comfyui"), ignore=ignore_project_state)
+    link_tree(os.path.join(ctx.fork_from_path, "venv"), os.path.join(ctx.project_folder_path, "venv"))
+    # venv общей сборки доступен только для чтения (см. runtimes), а копия принадлежит проекту
+    set_tree_read_only(os.path.join(ctx.project_folder_path, "venv"), False, dirs_only=True)
+    relocate_virtualenv(os.path.join(ctx.project_folder_path, "venv"), os.path.join(ctx.fork_from_path, "venv"))
+
+    for stage_key, fingerprint in get_stage_fingerprints(ctx.fork_from_path).items():
+        record_stage_fingerprint(ctx.project_folder_path, stage_key, fingerprint)
+
+
+def stage_download_comfyui(ctx):
+    comfyui_path = os.path.join(ctx.project_folder_path, "comfyui")
+
+    # Повторный запуск на существующем проекте не клонирует ComfyUI заново,
+    # а только переключает его на нужный коммит (если он изменился)
+    comfyui_commit_hash = None
+    if ctx.launcher_json:
+        comfyui_commit_hash = ctx.launcher_json["snapshot_json"]["comfyui"]
+
+    logger.info("Cloning ComfyUI repository")
+    clone_or_checkout_repo(COMFYUI_REPO_URL, comfyui_path, comfyui_commit_hash)
+
+    logger.info("Setting up web interface files")
+    web_frame_path = os.path.join("web", "comfy_frame.html")
+    comfyui_index_path = os.path.join(comfyui_path, "web", "index.html")
+    # При повторном запуске index.html уже может быть нашим фреймом
+    if not filecmp.cmp(comfyui_index_path, web_frame_path, shallow=False):
+        os.replace(comfyui_index_path, os.path.join(comfyui_path, "web", "comfyui_index.html"))
+
+    logger.info(f"Copying frame file from: {web_frame_path}")
+    shutil.copy(web_frame_path, comfyui_index_path)
+
+    comfyui_models_path = os.path.join(comfyui_path, "models")
+    if os.path.exists(comfyui_models_path) and not os.path.islink(comfyui_models_path):
+        logger.info("Removing existing models directory")
+        shutil.rmtree(comfyui_models_path, ignore_errors=True)
+
+    if not os.path.exists(ctx.models_folder_path):
+        logger.info("Setting up initial models folder")
+        setup_initial_models_folder(ctx.models_folder_path)
+
+    logger.info("Creating models symlink")
+    create_symlink(ctx.models_folder_path, comfyui_models_path)
+
+
+def stage_create_venv(ctx):
+    venv_path = os.path.join(ctx.project_folder_path, "venv")
+    fingerprint = compute_stage_fingerprint(get_torch_index_url(ctx.torch_variant))
+    recorded_fingerprint = get_stage_fingerprints(ctx.project_folder_path).get("venv")
+
+    # Окружение, оборванное посреди установки, или собранное под другой torch, пересоздаем.
+    # Окружения без отпечатка (созданные до его появления) считаем рабочими.
+    if os.path.exists(venv_path) and recorded_fingerprint not in (None, fingerprint):
+        logger.info(f"Virtual environment is outdated or incomplete, recreating: {venv_path}")
+        shutil.rmtree(venv_path, ignore_errors=True)
+
+    logger.info("Creating virtual environment")
+    record_stage_fingerprint(ctx.project_folder_path, "venv", VENV_INCOMPLETE)
+    create_virtualenv(venv_path, ctx.torch_variant)
+    record_stage_fingerprint(ctx.project_folder_path, "venv", fingerprint)
+
+
+def stage_install_comfyui_requirements(ctx):
+    logger.info("Installing ComfyUI requirements")
+    install_requirements_file(
+        ctx.project_folder_path,
+        os.path.join(ctx.project_folder_path, "comfyui", "requirements.txt"),
+        "comfyui",
+    )
+
+
+def stage_clone_default_custom_nodes(ctx):
+    logger.info("Downloading default custom nodes")
+    clone_default_custom_nodes(ctx.project_folder_path)
+
+
+def stage_clone_custom_nodes(ctx):
+    logger.info("Downloading custom nodes from snapshot")
+    clone_custom_nodes_from_snapshot(ctx.project_folder_path, ctx.launcher_json)
+
+
+def stage_install_default_custom_nodes(ctx):
+    logger.info("Installing default custom nodes")
+    install_default_custom_nodes(ctx.project_folder_path, ctx.launcher_json)
+
+
+def stage_install_custom_nodes(ctx):
+    logger.info("Installing custom nodes from snapshot")
+    setup_custom_nodes_from_snapshot(ctx.project_folder_path, ctx.launcher_json)
+
+
+def stage_install_pip_requirements(ctx):
+    if ctx.launcher_json and "pip_requirements" in ctx.launcher_json:
+        logger.info("Installing additional pip requirements")
+        install_pip_reqs(ctx.project_folder_path, ctx.launcher_json["pip_requirements"])
+
+
+def stage_download_files(ctx):
+    logger.info("Setting up files from launcher json")
+    setup_files_from_launcher_json(ctx.project_folder_path, ctx.launcher_json)
+
+
+def stage_finalize(ctx):
+    set_default_workflow_from_launcher_json(ctx.project_folder_path, ctx.launcher_json)
+
+    if ctx.launcher_json:
+        logger.info("Saving launcher.json")
+        with open(os.path.join(ctx.project_folder_path, "launcher.json"), "w") as f:
+            json.dump(ctx.launcher_json, f)
+
+    if ctx.port is not None:
+        logger.info(f"Setting port: {ctx.port}")
+        set_pinned_project_port(ctx.project_folder_path, ctx.port)
+
+
+# (имя шага, состояние проекта, сообщение для UI, функция)
+PROVISIONING_STAGES = [
+    ("fork_environment", "fork_environment", "Copying environment...", stage_fork_environment),
+    ("download_comfyui", "download_comfyui", "Downloading ComfyUI...", stage_download_comfyui),
+    ("clone_default_custom_nodes", "download_comfyui", "Downloading custom nodes...", stage_clone_default_custom_nodes),
+    ("clone_custom_nodes", "download_comfyui", "Downloading custom nodes...", stage_clone_custom_nodes),
+    ("create_venv", "install_comfyui", "Installing ComfyUI...", stage_create_venv),
+    ("install_comfyui_requirements", "install_comfyui", "Installing ComfyUI...", stage_install_comfyui_requirements),
+    ("install_default_custom_nodes", "install_custom_nodes", "Installing custom nodes...", stage_install_default_custom_nodes),
+    ("install_custom_nodes", "install_custom_nodes", "Installing custom nodes...", stage_install_custom_nodes),
+    ("install_pip_requirements", "install_custom_nodes", "Installing custom nodes...", stage_install_pip_requirements),
+    ("download_files", "download_files", "Downloading models & other files...", stage_download_files),
+    ("finalize", "download_files", "Downloading models & other files...", stage_finalize),
+]
+
+PROVISIONING_STAGES_BY_NAME = {stage[0]: stage for stage in PROVISIONING_STAGES}
+PROVISIONING_STAGE_NAMES = [stage[0] for stage in PROVISIONING_STAGES]
+
+# Вид работы каждого шага: при раздельном выполнении шаг уходит в очередь своего вида
+# (см. PROVISIONING_QUEUES), чтобы скачивание одного проекта шло параллельно со сборкой pip другого
+STAGE_WORK_KINDS = {
+    "fork_environment": "finalize",
+    "download_comfyui": "git",
+    "clone_default_custom_nodes": "git",
+    "clone_custom_nodes": "git",
+    "create_venv": "pip",
+    "install_comfyui_requirements": "pip",
+    "install_default_custom_nodes": "pip",
+    "install_custom_nodes": "pip",
+    "install_pip_requirements": "pip",
+    "download_files": "download",
+    "finalize": "finalize",
+}
+
+
+def get_completed_stages(project_folder_path):
+    stages_path = os.path.join(project_folder_path, ".launcher", "stages.json")
+    if not os.path.exists(stages_path):
+        return []
+    try:
+        with open(stages_path, "r") as f:
+            return json.load(f).get("completed", [])
+    except (OSError, json.JSONDecodeError):
+        return []
+
+
+def mark_stage_completed(project_folder_path, stage_name):
+    completed_stages = get_completed_stages(project_folder_path)
+    if stage_name not in completed_stages:
+        completed_stages.append(stage_name)
+    os.makedirs(os.path.join(project_folder_path, ".launcher"), exist_ok=True)
+    write_json_atomic(
+        os.path.join(project_folder_path, ".launcher", "stages.json"),
+        {"completed": completed_stages},
+    )
+
+
+def reset_completed_stages(project_folder_path):
+    stages_path = os.path.join(project_folder_path, ".launcher", "stages.json")
+    if os.path.exists(stages_path):
+        os.remove(stages_path)
+
+
+def save_provisioning_args(project_folder_path, args: dict):
+    """Сохраняет аргументы задачи установки, чтобы ее можно было возобновить после ошибки"""
+    os.makedirs(os.path.join(project_folder_path, ".launcher"), exist_ok=True)
+    write_json_atomic(os.path.join(project_folder_path, ".launcher", "task_args.json"), args)
+
+
+def get_provisioning_args(project_folder_path):
+    task_args_path = os.path.join(project_folder_path, ".launcher", "task_args.json")
+    if not os.path.exists(task_args_path):
+        return None
+    with open(task_args_path, "r") as f:
+        return json.load(f)
+
+
+def get_first_incomplete_stage(project_folder_path):
+    completed_stages = get_completed_stages(project_folder_path)
+    for stage_name, _, _, _ in PROVISIONING_STAGES:
+        if stage_name not in completed_stages:
+            return stage_name
+    return None
+
+
+# Шаги, не зависящие от конкретного проекта: их можно выполнить заранее (теплый пул)
+GENERIC_PROVISIONING_STAGES = [
+    "download_comfyui",
+    "clone_default_custom_nodes",
+    "create_venv",
+    "install_comfyui_requirements",
+    "install_default_custom_nodes",
+]
+
+
+def prepare_launcher_json(ctx):
+    if ctx.launcher_json:
+        logger.info("Processing launcher_json configuration")
+        ctx.launcher_json["workflow_json"] = normalize_model_filepaths_in_workflow_json(ctx.launcher_json["workflow_json"])
+
+
+def load_provisioning_context(project_folder_path):
+    """Контекст установки из сохраненных аргументов задачи (для шагов, выполняемых отдельными задачами)"""
+    provisioning_args = get_provisioning_args(project_folder_path)
+    assert provisioning_args, f"No saved provisioning args in {project_folder_path}"
+    ctx = ProvisioningContext(
+        project_folder_path,
+        provisioning_args["models_folder_path"],
+        launcher_json=provisioning_args["launcher_json"],
+        port=provisioning_args["port"],
+        fork_from_path=provisioning_args.get("fork_from_path"),
+        torch_variant=provisioning_args.get("torch_variant"),
+    )
+    prepare_launcher_json(ctx)
+    return ctx
+
+
+def begin_provisioning(ctx, resume=False):
+    if not resume:
+        reset_completed_stages(ctx.project_folder_path)
+    set_launcher_state_data(ctx.project_folder_path, {"torch_variant": ctx.torch_variant, "failed_stage": None})
+
+
+def run_provisioning_stage(ctx, stage_name, update_state=True):
+    """Выполняет один шаг установки, если он еще не завершен. Возвращает True, если шаг выполнялся."""
+    _, state, status_message, stage_fn = PROVISIONING_STAGES_BY_NAME[stage_name]
+    if stage_name in get_completed_stages(ctx.project_folder_path):
+        logger.info(f"Stage {stage_name} already completed, skipping")
+        return False
+    # Отмененная установка (проект удален) не должна писать в его папку
+    raise_if_revoked()
+    if update_state:
+        set_launcher_state_data(
+            ctx.project_folder_path,
+            {"status_message": status_message, "state": state},
+        )
+    logger.info(f"Running stage: {stage_name}")
+    report_progress(
+        stage=stage_name,
+        step_index=PROVISIONING_STAGE_NAMES.index(stage_name) + 1,
+        step_count=len(PROVISIONING_STAGE_NAMES),
+        custom_node=None,
+        force=True,
+    )
+    try:
+        stage_fn(ctx)
+    except Exception:
+        set_launcher_state_data(ctx.project_folder_path, {"failed_stage": stage_name})
+        raise
+    raise_if_revoked()
+    mark_stage_completed(ctx.project_folder_path, stage_name)
+    return True
+
+
+def run_provisioning_stages(ctx, resume=False, only_stages=None):
+    """
+    Выполняет шаги установки по порядку, отмечая завершенные в .launcher/stages.json.
+    С resume=True уже завершенные шаги пропускаются, only_stages ограничивает набор шагов.
+    """
+    prepare_launcher_json(ctx)
+    begin_provisioning(ctx, resume=resume)
+
+    current_state = None
+    for stage_name, state, _, _ in PROVISIONING_STAGES:
+        if only_stages is not None and stage_name not in only_stages:
+            continue
+        if run_provisioning_stage(ctx, stage_name, update_state=state != current_state):
+            current_state = state
@@ -0,0 +1,331 @@
+import asyncio
+import os
+import re
+import time
+import logging
+from collections import deque
+import aiohttp
+from aiohttp import web
+from settings import (
+    PROJECT_START_TIMEOUT_SECS,
+    PROJECTS_DIR,
+    PROXY_HOST,
+    PROXY_LATENCY_HISTORY_SIZE,
+    PROXY_PORT,
+    PROXY_UPSTREAM_CONNECTIONS,
+    PROXY_UPSTREAM_KEEPALIVE_SECS,
+    SERVER_PORT,
+)
+from idle import record_proxy_activity
+from state_store import load_project_state
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Обратный прокси PROXY_MODE (отдельный процесс на asyncio, вместо nginx). Запросы к /comfy/<id>/...
+# уходят в ComfyUI проекта <id> (порт берется из состояния проекта), остальные - в API лаунчера.
+# Соединения с ComfyUI и лаунчером переиспользуются (keep-alive), WebSocket (/ws ComfyUI) проксируется
+# целиком. Если ComfyUI проекта не запущен (остановлен по простою), прокси будит его через
+# /api/comfy/<port>/wake и повторяет запрос. По каждому проекту считаются запросы, задержка до
+# заголовков ответа и переданные байты: GET /api/proxy/stats. Время последнего запроса к проекту (и открытых
+# WebSocket) раз в ACTIVITY_FLUSH_SECS записывается для монитора простоя: соединения из пула
+# переиспользуются, и по новым соединениям с портом активность через прокси не видна.
+
+COMFY_PATH_RE = re.compile(r"^/comfy/([^/?]+)(/[^?]*)?(\?.*)?$")
+PROJECT_ID_RE = re.compile(r"^[\w.-]+$")
+# Состояния, в которых у проекта есть порт, на который можно проксировать
+PROXIED_STATES = ("starting", "running", "idle")
+# Состояние проекта перечитывается не чаще раза в секунду
+PROJECT_CACHE_TTL_SECS = 1
+CONNECT_TIMEOUT_SECS = 5
+STREAM_CHUNK_SIZE = 64 * 1024
+ACTIVITY_FLUSH_SECS = 5
+
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+WEBSOCKET_HANDSHAKE_HEADERS = {
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+    "sec-websocket-accept",
+}
+
+
+class ProjectStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.websocket_connections = 0
+        self.active_websockets = 0
+        # Задержка до заголовков ответа ComfyUI, мс
+        self.latencies_ms = deque(maxlen=PROXY_LATENCY_HISTORY_SIZE)
+
+    def to_json(self):
+        latencies = sorted(self.latencies_ms)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 2) if latencies else None
+
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "websocket_connections": self.websocket_connections,
+            "active_websockets": self.active_websockets,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1], 2) if latencies else None,
+            },
+        }
+
+
+class ComfyProxy:
+    def __init__(self):
+        self.session = None
+        self.stats = {}
+        # id проекта -> (время устаревания, состояние)
+        self._project_cache = {}
+        # Проекты, к которым были запросы после последней записи активности
+        self._active_projects = set()
+        self._activity_task = None
+
+    async def _flush_activity(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_SECS)
+            project_ids = self._active_projects
+            self._active_projects = set()
+            project_ids |= {project_id for project_id, stats in self.stats.items() if stats.active_websockets > 0}
+            try:
+                await asyncio.to_thread(record_proxy_activity, sorted(project_ids))
+            except Exception as e:
+                logger.warning(f"Failed to record proxy activity: {e}")
+
+    async def start(self, app):
+        connector = aiohttp.TCPConnector(
+            limit=PROXY_UPSTREAM_CONNECTIONS,
+            keepalive_timeout=PROXY_UPSTREAM_KEEPALIVE_SECS,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            # Тело ответа передается клиенту как есть, со своим Content-Encoding
+            auto_decompress=False,
+            # Куки клиентов не должны смешиваться в общем пуле
+            cookie_jar=aiohttp.DummyCookieJar(),
+            skip_auto_headers=("User-Agent", "Accept", "Accept-Encoding"),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT_SECS),
+        )
+        self._activity_task = asyncio.create_task(self._flush_activity())
+
+    async def close(self, app):
+        self._activity_task.cancel()
+        await asyncio.gather(self._activity_task, return_exceptions=True)
+        await self.session.close()
+
+    def _get_stats(self, project_id):
+        if project_id not in self.stats:
+            self.stats[project_id] = ProjectStats()
+        return self.stats[project_id]
+
+    async def _get_project_state(self, project_id, refresh=False):
+        cached = self._project_cache.get(project_id)
+        if cached and not refresh and cached[0] > time.time():
+            return cached[1]
+        project_folder_path = os.path.join(PROJECTS_DIR, project_id)
+        if os.path.isdir(project_folder_path):
+            state = await asyncio.to_thread(load_project_state, project_folder_path)
+        else:
+            state = None
+        self._project_cache[project_id] = (time.time() + PROJECT_CACHE_TTL_SECS, state)
+        return state
+
+    async def _wake(self, project_id, port):
+        """Запускает остановленный проект через лаунчер и ждет его готовности"""
+        logger.info(f"Waking project {project_id} (port {port})")
+        try:
+            async with self.session.post(
+                f"http://127.0.0.1:{SERVER_PORT}/api/comfy/{port}/wake",
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(total=PROJECT_START_TIMEOUT_SECS + 30),
+            ) as response:
+                await response.read()
+                woken = response.status == 307
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to wake project {project_id}: {e}")
+            woken = False
+        await self._get_project_state(project_id, refresh=True)
+        return woken
+
+    def _upstream_headers(self, request, prefix=None, websocket=False):
+        headers = {}
+        for name, value in request.headers.items():
+            lower_name = name.lower()
+            if lower_name in HOP_BY_HOP_HEADERS or (websocket and lower_name in WEBSOCKET_HANDSHAKE_HEADERS):
+                continue
+            if lower_name in headers:
+                headers[lower_name] += ", " + value
+            else:
+                headers[lower_name] = value
+        if not request.body_exists:
+            headers.pop("content-length", None)
+        remote = request.remote or ""
+        forwarded_for = request.headers.get("X-Forwarded-For")
+        headers["x-forwarded-for"] = f"{forwarded_for}, {remote}" if forwarded_for else remote
+        headers["x-real-ip"] = remote
+        headers["x-forwarded-proto"] = request.scheme
+        if prefix:
+            headers["x-forwarded-prefix"] = prefix
+        return headers
+
+    async def handle(self, request):
+        if request.path == "/api/proxy/stats":
+            return web.json_response({project_id: stats.to_json() for project_id, stats in self.stats.items()})
+
+        match = COMFY_PATH_RE.match(request.raw_path)
+        if not match:
+            return await self._forward(request, SERVER_PORT, request.raw_path)
+
+        project_id, path, query = match.group(1), match.group(2), match.group(3) or ""
+        if not PROJECT_ID_RE.match(project_id) or project_id in (".", ".."):
+            return web.json_response({"success": False, "error": "Invalid project id"}, status=400)
+        if path is None:
+            raise web.HTTPMovedPermanently(f"/comfy/{project_id}/{query}")
+        state = await self._get_project_state(project_id)
+        if state is None:
+            return web.json_response({"success": False, "error": f"Project {project_id} not found"}, status=404)
+        if state.get("state") not in PROXIED_STATES or not state.get("port"):
+            return web.json_response({"success": False, "error": f"Project {project_id} is not running"}, status=503)
+        return await self._forward(request, state["port"], path + query, project_id)
+
+    async def _forward(self, request, port, path, project_id=None):
+        stats = self._get_stats(project_id) if project_id else None
+        if stats:
+            stats.requests += 1
+            self._active_projects.add(project_id)
+        is_websocket = request.headers.get("Upgrade", "").lower() == "websocket"
+        try:
+            for attempt in range(2):
+                try:
+                    if is_websocket:
+                        return await self._forward_websocket(request, port, path, project_id, stats)
+                    return await self._forward_http(request, port, path, project_id, stats)
+                except aiohttp.ClientConnectorError:
+                    # ComfyUI не слушает порт: он остановлен по простою или еще запускается
+                    if attempt or not project_id or not await self._wake(project_id, port):
+                        raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if stats:
+                stats.errors += 1
+            upstream = f"project {project_id}" if project_id else "launcher"
+            logger.warning(f"Proxy request {request.method} {path} to {upstream} failed: {e}")
+            return web.json_response({"success": False, "error": f"Bad gateway: {e}"}, status=502)
+
+    async def _forward_http(self, request, port, path, project_id, stats):
+        prefix = f"/comfy/{project_id}" if project_id else None
+        started_at = time.perf_counter()
+        async with self.session.request(
+            request.method,
+            f"http://127.0.0.1:{port}{path}",
+            headers=self._upstream_headers(request, prefix),
+            data=request.content if request.body_exists else None,
+            allow_redirects=False,
+        ) as upstream:
+            if stats:
+                stats.latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                stats.bytes_in += request.content.total_bytes
+            response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+            for name, value in upstream.headers.items():
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            try:
+                # Ответ передается по частям: потоки вроде /api/events не буферизуются
+                async for chunk in upstream.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    await response.write(chunk)
+                    if stats:
+                        stats.bytes_out += len(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Заголовки уже отправлены: остается только оборвать соединение с клиентом
+                if stats:
+                    stats.errors += 1
+                logger.warning(f"Proxy response {request.method} {path} was interrupted: {e}")
+                response.force_close()
+                return response
+            await response.write_eof()
+            return response
+
+    async def _forward_websocket(self, request, port, path, project_id, stats):
+        protocols = [p.strip() for p in request.headers.get("Sec-WebSocket-Protocol", "").split(",") if p.strip()]
+        prefix = f"/comfy/{project_id}" if project_id else None
+        started_at = time.perf_counter()
+        upstream = await self.session.ws_connect(
+            f"http://127.0.0.1:{port}{path}",
+            headers=self._upstream_headers(request, prefix, websocket=True),
+            protocols=protocols,
+            max_msg_size=0,
+        )
+        if stats:
+            stats.latencies_ms.append((time.perf_counter() - started_at) * 1000)
+            stats.websocket_connections += 1
+            stats.active_websockets += 1
+        client = web.WebSocketResponse(protocols=[upstream.protocol] if upstream.protocol else (), max_msg_size=0)
+        try:
+            await client.prepare(request)
+
+            async def pipe(source, target, counter):
+                async for message in source:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        await target.send_str(message.data)
+                        size = len(message.data.encode())
+                    elif message.type == aiohttp.WSMsgType.BINARY:
+                        await target.send_bytes(message.data)
+                        size = len(message.data)
+                    else:
+                        continue
+                    if stats:
+                        setattr(stats, counter, getattr(stats, counter) + size)
+
+            tasks = [
+                asyncio.create_task(pipe(client, upstream, "bytes_in")),
+                asyncio.create_task(pipe(upstream, client, "bytes_out")),
+            ]
+            # Соединение закрыто с одной стороны - закрываем и другую
+            _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            if stats:
+                stats.active_websockets -= 1
+            await upstream.close()
+            await client.close()
+        return client
+
+
+def create_proxy_app():
+    proxy = ComfyProxy()
+    app = web.Application()
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.close)
+    app.router.add_route("*", "/{path:.*}", proxy.handle)
+    return app
+
+
+if __name__ == "__main__":
+    logger.info(f"Proxying port {PROXY_PORT} to the launcher on port {SERVER_PORT} and projects at /comfy/<id>/")
+    web.run_app(create_proxy_app(), host=PROXY_HOST, port=PROXY_PORT, access_log=None)
@@ -0,0 +1,74 @@
+import os
+import time
+import logging
+import requests
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Определение готовности запущенного ComfyUI: вывод процесса (строка о том, что сервер слушает порт)
+# и опрос HTTP ComfyUI с быстро растущей паузой. Вывод ComfyUI пишется в файл, а не в pipe, чтобы
+# процесс не зависел от лаунчера после запуска.
+
+# ComfyUI печатает эту строку, когда HTTP-сервер уже принимает соединения
+COMFYUI_LISTENING_LINE = b"To see the GUI go to:"
+PROBE_INITIAL_DELAY_SECS = 0.05
+PROBE_MAX_DELAY_SECS = 1
+PROBE_TIMEOUT_SECS = 2
+
+
+def get_comfyui_log_path(project_folder_path, replica=0):
+    file_name = f"comfyui-replica-{replica}.log" if replica else "comfyui.log"
+    return os.path.join(project_folder_path, ".launcher", file_name)
+
+
+def _probe_http(port):
+    try:
+        requests.get(f"http://127.0.0.1:{port}/", timeout=PROBE_TIMEOUT_SECS)
+        return True
+    except requests.RequestException:
+        return False
+
+
+class _OutputWatcher:
+    """Дочитывает лог запуска и ищет в нем строку COMFYUI_LISTENING_LINE"""
+
+    def __init__(self, log_path, offset=0):
+        self.log_path = log_path
+        self.offset = offset
+        self.tail = b""
+
+    def saw_listening_line(self):
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return False
+        self.offset += len(data)
+        # Хвост предыдущего чтения - на случай, если строка попала на границу
+        text = self.tail + data
+        self.tail = text[-len(COMFYUI_LISTENING_LINE):]
+        return COMFYUI_LISTENING_LINE in text
+
+
+def wait_until_ready(process, port, log_path, timeout_secs, log_offset=0, should_stop=None):
+    """
+    Ждет готовности только что запущенного ComfyUI. process - объект с poll() (subprocess.Popen или аналог).
+    Возвращает None, когда ComfyUI готов, иначе причину неудачи.
+    """
+    deadline = time.time() + timeout_secs
+    output_watcher = _OutputWatcher(log_path, log_offset)
+    delay = PROBE_INITIAL_DELAY_SECS
+    while time.time() < deadline:
+        if should_stop and should_stop():
+            return "Start was cancelled"
+        if output_watcher.saw_listening_line() or _probe_http(port):
+            return None
+        exit_code = process.poll()
+        if exit_code is not None:
+            return f"ComfyUI exited with code {exit_code}"
+        time.sleep(delay)
+        delay = min(delay * 2, PROBE_MAX_DELAY_SECS)
+    return f"ComfyUI did not start within {timeout_secs}s"
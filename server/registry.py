@@ -0,0 +1,196 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from settings import PROJECT_REGISTRY_POLL_SECS, PROJECTS_DIR
+from ports import get_project_port
+from state_store import get_project_state_version, get_project_state_versions
+from utils import get_launcher_state, on_launcher_state_change
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Кеш проектов для /api/projects: записи обновляются сразу при записи состояния в процессе сервера
+# и фоновым наблюдателем, который по версиям записей в базе состояний замечает изменения из воркеров,
+# а по mtime - появление/удаление папок проектов. Запросы читают только память.
+
+
+def _stat_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ProjectRegistry:
+    def __init__(self, projects_dir):
+        self.projects_dir = os.path.abspath(projects_dir)
+        self._lock = threading.RLock()
+        self._projects = {}
+        self._signatures = {}
+        self._scanned = False
+        self._watcher = None
+        # Номер версии содержимого реестра. Версия начинается заново
+        # при каждом запуске процесса, поэтому в тег версии входит id экземпляра реестра.
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.version = 0
+
+    def _get_project_path(self, project_id):
+        return os.path.join(self.projects_dir, project_id)
+
+    def _get_signature(self, project_path, state_version=None):
+        if state_version is None:
+            state_version = get_project_state_version(project_path) or 0
+        return (_stat_mtime(project_path), state_version)
+
+    def _bump_version(self):
+        self.version += 1
+
+    def _remove(self, project_id):
+        self._signatures.pop(project_id, None)
+        if self._projects.pop(project_id, None) is not None:
+            self._bump_version()
+
+    def refresh(self, project_id, signature=None):
+        """Перечитывает проект с диска (или убирает его из реестра, если папки больше нет)"""
+        project_path = self._get_project_path(project_id)
+        with self._lock:
+            if not os.path.isdir(project_path):
+                self._remove(project_id)
+                return
+            if signature is None:
+                signature = self._get_signature(project_path)
+            try:
+                launcher_state = get_launcher_state(project_path)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                # Перечитаем на следующем проходе
+                logger.debug(f"Failed to read state of project {project_id}: {e}")
+                return
+            self._signatures[project_id] = signature
+            if not launcher_state:
+                if self._projects.pop(project_id, None) is not None:
+                    self._bump_version()
+                return
+            self._projects[project_id] = {
+                "id": project_id,
+                "state": launcher_state,
+                "project_folder_name": project_id,
+                "project_folder_path": project_path,
+                "last_modified": os.stat(project_path).st_mtime,
+                "port": get_project_port(project_id),
+            }
+            self._bump_version()
+
+    def refresh_path(self, project_folder_path, data=None):
+        project_folder_path = os.path.abspath(project_folder_path)
+        if os.path.dirname(project_folder_path) == self.projects_dir:
+            self.refresh(os.path.basename(project_folder_path))
+
+    def scan(self):
+        """Сверяет реестр с диском и базой; перечитываются только проекты, у которых изменилась папка или запись"""
+        try:
+            project_ids = set(os.listdir(self.projects_dir))
+        except OSError as e:
+            logger.warning(f"Failed to list projects: {e}")
+            return
+        # Версии всех записей одним запросом; папки без записи (еще не перенесенные в базу) перечитываются
+        state_versions = get_project_state_versions(self.projects_dir)
+        with self._lock:
+            for project_id in set(self._signatures) - project_ids:
+                self._remove(project_id)
+            for project_id in project_ids:
+                project_path = self._get_project_path(project_id)
+                signature = self._get_signature(project_path, state_versions.get(project_id, 0))
+                if signature[0] is None:
+                    continue
+                if self._signatures.get(project_id) != signature:
+                    self.refresh(project_id, signature)
+            self._scanned = True
+
+    def _ensure_scanned(self):
+        if not self._scanned:
+            self.scan()
+
+    def list(self):
+        """Копии записей всех проектов (их можно дополнять в ответе API)"""
+        with self._lock:
+            self._ensure_scanned()
+            return [dict(project) for project in self._projects.values()]
+
+    def get(self, project_id):
+        with self._lock:
+            self._ensure_scanned()
+            project = self._projects.get(project_id)
+            return dict(project) if project else None
+
+    def get_version_tag(self):
+        with self._lock:
+            self._ensure_scanned()
+            return f"{self.instance_id}-{self.version}"
+
+    def _watch(self):
+        while True:
+            time.sleep(PROJECT_REGISTRY_POLL_SECS)
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f"Project registry scan failed: {e}", exc_info=True)
+
+    def start_watcher(self):
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="project-registry-watcher", daemon=True)
+                self._watcher.start()
+
+
+def sort_projects(projects):
+    """Порядок списка проектов: сначала недавно измененные"""
+    projects.sort(key=lambda p: (-p["last_modified"], p["id"]))
+    return projects
+
+
+def encode_cursor(project):
+    return base64.urlsafe_b64encode(json.dumps([project["last_modified"], project["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    last_modified, project_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(last_modified), str(project_id)
+
+
+def paginate_projects(projects, limit=None, cursor=None):
+    """
+    Страница из отсортированного sort_projects списка: проекты после cursor (не включая его), не более limit.
+    Возвращает (страница, курсор следующей страницы или None).
+    """
+    if cursor:
+        cursor_key = decode_cursor(cursor)
+        cursor_key = (-cursor_key[0], cursor_key[1])
+        projects = [p for p in projects if (-p["last_modified"], p["id"]) > cursor_key]
+    if limit is None or len(projects) <= limit:
+        return projects, None
+    page = projects[:limit]
+    return page, encode_cursor(page[-1])
+
+
+def compute_listing_etag(version_tag, query_string, projects):
+    """
+    ETag списка проектов: версия реестра, параметры запроса и позиции в очереди установки с оценками
+    времени старта (они меняются и без изменения реестра).
+    """
+    queue_estimates = [
+        (p["id"], p["queue_position"], int(p["estimated_start"])) for p in projects if "queue_position" in p
+    ]
+    return hashlib.sha256(f"{version_tag}?{query_string}#{queue_estimates}".encode()).hexdigest()[:32]
+
+
+project_registry = ProjectRegistry(PROJECTS_DIR)
+
+# Записи состояния из этого процесса видны в реестре сразу, без ожидания наблюдателя
+on_launcher_state_change(project_registry.refresh_path)
@@ -0,0 +1,38 @@
+import random
+import logging
+from metrics import get_queue_depth
+from supervisor import get_instance_state, get_replica_numbers
+from utils import get_launcher_state
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Выбор экземпляра ComfyUI проекта для промпта: из работающих экземпляров (основного и реплик)
+# берется тот, у которого короче очередь. Используется API лаунчера и пакетными заданиями.
+
+
+def get_running_replicas(project_folder_path):
+    """[(номер реплики, порт)] работающих экземпляров проекта; 0 - основной экземпляр"""
+    launcher_state = get_launcher_state(project_folder_path)
+    replicas = []
+    for replica in [0] + get_replica_numbers(launcher_state):
+        instance_state = get_instance_state(project_folder_path, replica)
+        if instance_state.get("state") == "running" and instance_state.get("port"):
+            replicas.append((replica, instance_state["port"]))
+    return replicas
+
+
+def choose_replica(project_folder_path):
+    """(номер реплики, порт) работающего экземпляра с самой короткой очередью, либо None"""
+    loads = []
+    for replica, port in get_running_replicas(project_folder_path):
+        queue_depth = get_queue_depth(port)
+        if queue_depth is not None:
+            loads.append((queue_depth, replica, port))
+    if not loads:
+        return None
+    # При равной длине очереди - случайный экземпляр, а не всегда основной
+    random.shuffle(loads)
+    _, replica, port = min(loads, key=lambda load: load[0])
+    return replica, port
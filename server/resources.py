@@ -0,0 +1,210 @@
+import json
+import os
+import time
+import logging
+import psutil
+from launcher_db import get_launcher_db, register_schema
+from settings import CPU_PARTITIONING, LAUNCHER_CGROUP_DIR, PROJECT_MEMORY_LIMIT_MB
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Профили ресурсов экземпляров ComfyUI. Ядра процессора делятся между запущенными экземплярами
+# (на CPU - всегда, с CPU_PARTITIONING=all - и на GPU): у каждого свой непересекающийся набор ядер,
+# при запуске и остановке экземпляров наборы пересчитываются и применяются ко всем потокам процессов.
+# Число потоков OpenMP/MKL/torch задается по размеру набора на момент запуска. Лимит памяти - через
+# cgroup v2 (LAUNCHER_CGROUP_DIR, делегированный лаунчеру), иначе через RLIMIT_AS на Linux.
+# Профиль проекта (state["resource_profile"]): {"cpu_cores": число ядер, "memory_limit_mb": лимит}.
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS cpu_assignments (
+        project_id TEXT PRIMARY KEY,
+        pid INTEGER,
+        requested_cores INTEGER,
+        cores TEXT NOT NULL DEFAULT '[]',
+        assigned_at REAL NOT NULL
+    )
+    """,
+)
+
+
+def get_available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        # macOS: привязка к ядрам не поддерживается
+        return list(range(os.cpu_count() or 1))
+
+
+def should_partition_cpu(cpu_only, resource_profile):
+    if CPU_PARTITIONING == "off":
+        return False
+    return cpu_only or CPU_PARTITIONING == "all" or bool((resource_profile or {}).get("cpu_cores"))
+
+
+def partition_cores(cores, requests):
+    """
+    Делит cores между проектами. requests - [(id проекта, запрошенное число ядер или None)] в порядке
+    запуска. Явные запросы выполняются первыми, остальные ядра делятся поровну; если ядер меньше,
+    чем проектов, проекты делят ядра по кругу.
+    """
+    if not requests:
+        return {}
+    if len(requests) > len(cores):
+        return {project_id: [cores[i % len(cores)]] for i, (project_id, _) in enumerate(requests)}
+
+    sizes = {project_id: min(requested, len(cores)) for project_id, requested in requests if requested}
+    auto_ids = [project_id for project_id, requested in requests if not requested]
+    remaining = len(cores) - sum(sizes.values())
+    if remaining < len(auto_ids):
+        # Явные запросы не помещаются: всем поровну
+        sizes, auto_ids, remaining = {}, [project_id for project_id, _ in requests], len(cores)
+    for i, project_id in enumerate(auto_ids):
+        sizes[project_id] = remaining // len(auto_ids) + (1 if i < remaining % len(auto_ids) else 0)
+
+    partition, start = {}, 0
+    for project_id, _ in requests:
+        partition[project_id] = cores[start:start + sizes[project_id]]
+        start += sizes[project_id]
+    return partition
+
+
+def _set_process_affinity(pid, cores):
+    """Привязывает к ядрам все потоки процесса и его дочерних процессов"""
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return
+    for p in processes:
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                # На Linux привязка действует на поток, а не на процесс целиком
+                for thread in p.threads():
+                    try:
+                        os.sched_setaffinity(thread.id, cores)
+                    except OSError:
+                        pass
+            else:
+                p.cpu_affinity(cores)
+        except (AttributeError, psutil.Error):
+            pass
+
+
+def _rebalance(conn):
+    """
+    Пересчитывает раздел ядер в транзакции conn. Возвращает раздел и [(pid, ядра)] для _apply_affinities:
+    привязка потоков выполняется после фиксации транзакции, чтобы не держать блокировку записи в базу.
+    """
+    rows = conn.execute(
+        "SELECT project_id, pid, requested_cores FROM cpu_assignments ORDER BY assigned_at, project_id"
+    ).fetchall()
+    partition = partition_cores(get_available_cores(), [(row["project_id"], row["requested_cores"]) for row in rows])
+    affinities = []
+    for row in rows:
+        cores = partition[row["project_id"]]
+        conn.execute(
+            "UPDATE cpu_assignments SET cores = ? WHERE project_id = ?", (json.dumps(cores), row["project_id"])
+        )
+        if row["pid"]:
+            affinities.append((row["pid"], cores))
+    return partition, affinities
+
+
+def _apply_affinities(affinities):
+    for pid, cores in affinities:
+        _set_process_affinity(pid, cores)
+
+
+def acquire_project_cores(project_id, requested_cores=None):
+    """Включает проект в раздел ядер (до запуска процесса) и возвращает его набор ядер"""
+    with get_launcher_db(write=True) as conn:
+        row = conn.execute("SELECT project_id FROM cpu_assignments WHERE project_id = ?", (project_id,)).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO cpu_assignments (project_id, requested_cores, assigned_at) VALUES (?, ?, ?)",
+                (project_id, requested_cores, time.time()),
+            )
+        else:
+            conn.execute(
+                "UPDATE cpu_assignments SET requested_cores = ? WHERE project_id = ?", (requested_cores, project_id)
+            )
+        partition, affinities = _rebalance(conn)
+    _apply_affinities(affinities)
+    return partition[project_id]
+
+
+def attach_project_process(project_id, pid):
+    """Привязывает запущенный процесс проекта к его набору ядер"""
+    with get_launcher_db(write=True) as conn:
+        conn.execute("UPDATE cpu_assignments SET pid = ? WHERE project_id = ?", (pid, project_id))
+        row = conn.execute("SELECT cores FROM cpu_assignments WHERE project_id = ?", (project_id,)).fetchone()
+    if row:
+        _set_process_affinity(pid, json.loads(row["cores"]))
+
+
+def release_project_cores(project_id):
+    """Исключает проект из раздела; его ядра переходят к остальным запущенным проектам"""
+    affinities = []
+    with get_launcher_db(write=True) as conn:
+        if conn.execute("DELETE FROM cpu_assignments WHERE project_id = ?", (project_id,)).rowcount:
+            _, affinities = _rebalance(conn)
+    _apply_affinities(affinities)
+
+
+def prune_project_cores(project_ids):
+    """Исключает из раздела проекты, которых нет среди project_ids (например, после перезапуска лаунчера)"""
+    affinities = []
+    with get_launcher_db(write=True) as conn:
+        rows = conn.execute("SELECT project_id FROM cpu_assignments").fetchall()
+        stale_ids = [row["project_id"] for row in rows if row["project_id"] not in project_ids]
+        for project_id in stale_ids:
+            conn.execute("DELETE FROM cpu_assignments WHERE project_id = ?", (project_id,))
+        if stale_ids:
+            _, affinities = _rebalance(conn)
+    _apply_affinities(affinities)
+
+
+def get_thread_env(core_count):
+    return {name: str(max(1, core_count)) for name in THREAD_ENV_VARS}
+
+
+def _move_to_cgroup(project_id, pid, memory_limit_mb):
+    cgroup_path = os.path.join(LAUNCHER_CGROUP_DIR, project_id)
+    os.makedirs(cgroup_path, exist_ok=True)
+    with open(os.path.join(cgroup_path, "memory.max"), "w") as f:
+        f.write(str(memory_limit_mb * 1024 * 1024))
+    with open(os.path.join(cgroup_path, "cgroup.procs"), "w") as f:
+        f.write(str(pid))
+
+
+def apply_memory_limit(project_id, pid, memory_limit_mb=None):
+    """Ограничивает память процесса проекта (memory_limit_mb или PROJECT_MEMORY_LIMIT_MB; 0 - без лимита)"""
+    memory_limit_mb = memory_limit_mb or PROJECT_MEMORY_LIMIT_MB
+    if not memory_limit_mb:
+        return
+    if LAUNCHER_CGROUP_DIR:
+        try:
+            _move_to_cgroup(project_id, pid, memory_limit_mb)
+            return
+        except OSError as e:
+            logger.warning(f"Failed to apply cgroup memory limit to project {project_id}: {e}")
+    try:
+        import resource
+        limit = memory_limit_mb * 1024 * 1024
+        # RLIMIT_AS ограничивает адресное пространство, а не RSS: лимит нужен с запасом
+        resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, AttributeError, OSError) as e:
+        logger.warning(f"Memory limit is not supported for project {project_id}: {e}")
@@ -0,0 +1,271 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import time
+import logging
+from settings import PROJECTS_DIR, RUNTIMES_DIR
+from provisioning import ProvisioningContext, get_completed_stages, run_provisioning_stages
+from utils import (
+    CUSTOM_NODES_TO_IGNORE_FROM_SNAPSHOTS,
+    create_symlink,
+    get_launcher_state,
+    WRITE_BITS,
+    release_lock_file,
+    set_launcher_state_data,
+    set_tree_read_only,
+    try_acquire_lock_file,
+    write_json_atomic,
+)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Общие окружения: проекты с одинаковым отпечатком окружения (коммит ComfyUI, custom nodes с хешами,
+# pip-зависимости, вариант torch) используют одну сборку comfyui+venv в RUNTIMES_DIR/<отпечаток>/.
+# В папке проекта остается только "представление": venv и каталоги кода ComfyUI - симлинки на сборку,
+# а web/, input/, output/, temp/, user/ и ComfyUI-ComfyWorkflows - собственные для каждого проекта.
+# venv готовой сборки доступен только для чтения: pip install из ComfyUI-Manager одного проекта не должен
+# менять окружение всех проектов с тем же отпечатком (процесс от root права на запись не ограничивают).
+# Сборки, на которые не ссылается ни один проект, удаляются prune_unused_runtimes (при запуске сервера
+# и удалении проекта). Сборка и удаление идут под блокировкой RUNTIMES_DIR/<отпечаток>.lock.
+
+RUNTIME_STAGES = [
+    "download_comfyui",
+    "clone_default_custom_nodes",
+    "clone_custom_nodes",
+    "create_venv",
+    "install_comfyui_requirements",
+    "install_default_custom_nodes",
+    "install_custom_nodes",
+    "install_pip_requirements",
+]
+
+PROJECT_STAGES = ["download_files", "finalize"]
+
+# Каталоги ComfyUI, которые у каждого проекта свои
+PROJECT_OWNED_COMFYUI_DIRS = {"web", "input", "output", "temp", "user"}
+
+# Custom nodes, в которые лаунчер пишет данные проекта (current_graph.json)
+PROJECT_OWNED_CUSTOM_NODES = {"ComfyUI-ComfyWorkflows"}
+
+RUNTIME_LOCK_POLL_SECS = 5
+
+
+def _normalize_pip_requirement(req):
+    if isinstance(req, dict):
+        return f"{req['_key']}=={req['_version']}"
+    return str(req).strip()
+
+
+def get_environment_spec(launcher_json, torch_variant):
+    """Каноническое описание окружения, от которого зависит сборка comfyui+venv"""
+    snapshot_json = (launcher_json or {}).get("snapshot_json") or {}
+    custom_nodes = {}
+    for custom_node_repo_url, custom_node_repo_info in (snapshot_json.get("git_custom_nodes") or {}).items():
+        if any(ignored in custom_node_repo_url for ignored in CUSTOM_NODES_TO_IGNORE_FROM_SNAPSHOTS):
+            continue
+        if custom_node_repo_info.get("disabled"):
+            continue
+        normalized_url = custom_node_repo_url.rstrip("/")
+        if normalized_url.endswith(".git"):
+            normalized_url = normalized_url[: -len(".git")]
+        custom_nodes[normalized_url] = custom_node_repo_info.get("hash")
+
+    pip_requirements = sorted(
+        _normalize_pip_requirement(req) for req in ((launcher_json or {}).get("pip_requirements") or [])
+    )
+    return {
+        "comfyui": snapshot_json.get("comfyui"),
+        "git_custom_nodes": custom_nodes,
+        "pip_requirements": pip_requirements,
+        "torch_variant": torch_variant,
+    }
+
+
+def compute_environment_fingerprint(launcher_json, torch_variant):
+    canonical = json.dumps(get_environment_spec(launcher_json, torch_variant), sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def get_runtime_path(fingerprint):
+    return os.path.abspath(os.path.join(RUNTIMES_DIR, fingerprint))
+
+
+def is_runtime_ready(runtime_path):
+    completed_stages = get_completed_stages(runtime_path)
+    return all(stage_name in completed_stages for stage_name in RUNTIME_STAGES)
+
+
+def _protect_runtime_venv(runtime_path):
+    venv_path = os.path.join(runtime_path, "venv")
+    # Сборки, собранные до защиты venv, защищаются при следующем использовании
+    if os.path.isdir(venv_path) and os.stat(venv_path).st_mode & WRITE_BITS:
+        set_tree_read_only(venv_path, True)
+
+
+def ensure_runtime(fingerprint, launcher_json, models_folder_path, torch_variant):
+    """
+    Готовит общую сборку, собирая (или достраивая) ее при необходимости. Возвращает путь к сборке и держит
+    ее блокировку: вызывающий освобождает ее release_lock_file(<путь>.lock), закончив с представлением проекта.
+    """
+    runtime_path = get_runtime_path(fingerprint)
+    os.makedirs(RUNTIMES_DIR, exist_ok=True)
+    lock_path = runtime_path + ".lock"
+    while not try_acquire_lock_file(lock_path):
+        logger.info(f"Shared runtime {fingerprint} is being built or removed by another task, waiting...")
+        time.sleep(RUNTIME_LOCK_POLL_SECS)
+    try:
+        if is_runtime_ready(runtime_path):
+            logger.info(f"Reusing shared runtime {fingerprint}")
+            _protect_runtime_venv(runtime_path)
+            return runtime_path
+        logger.info(f"Building shared runtime {fingerprint}")
+        os.makedirs(runtime_path, exist_ok=True)
+        write_json_atomic(
+            os.path.join(runtime_path, "runtime.json"),
+            {"fingerprint": fingerprint, "environment": get_environment_spec(launcher_json, torch_variant)},
+        )
+        ctx = ProvisioningContext(
+            runtime_path, models_folder_path, launcher_json=copy.deepcopy(launcher_json), torch_variant=torch_variant
+        )
+        # Сборка, прерванная ранее, продолжается с первого незавершенного шага
+        run_provisioning_stages(ctx, resume=True, only_stages=RUNTIME_STAGES)
+        _protect_runtime_venv(runtime_path)
+        return runtime_path
+    except BaseException:
+        release_lock_file(lock_path)
+        raise
+
+
+def _remove_path(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def materialize_project_view(project_folder_path, runtime_path, models_folder_path):
+    """Создает (или обновляет) в папке проекта представление общей сборки"""
+    runtime_comfyui_path = os.path.join(runtime_path, "comfyui")
+    project_comfyui_path = os.path.join(project_folder_path, "comfyui")
+    os.makedirs(project_comfyui_path, exist_ok=True)
+
+    venv_path = os.path.join(project_folder_path, "venv")
+    if os.path.lexists(venv_path):
+        _remove_path(venv_path)
+    create_symlink(os.path.join(runtime_path, "venv"), venv_path)
+
+    for entry in os.scandir(runtime_comfyui_path):
+        target_path = os.path.join(project_comfyui_path, entry.name)
+        if entry.name in (".git", "models"):
+            continue
+        if entry.name in PROJECT_OWNED_COMFYUI_DIRS:
+            if entry.name == "web" and os.path.lexists(target_path):
+                # web/ пересобираем, defaultGraph.js заново пишет шаг finalize
+                _remove_path(target_path)
+            if not os.path.lexists(target_path):
+                shutil.copytree(entry.path, target_path, symlinks=True)
+            continue
+        if os.path.lexists(target_path):
+            _remove_path(target_path)
+        if entry.name == "custom_nodes":
+            os.makedirs(target_path)
+            for custom_node_entry in os.scandir(entry.path):
+                custom_node_target_path = os.path.join(target_path, custom_node_entry.name)
+                if custom_node_entry.name in PROJECT_OWNED_CUSTOM_NODES or not custom_node_entry.is_dir():
+                    if custom_node_entry.is_dir():
+                        shutil.copytree(custom_node_entry.path, custom_node_target_path, symlinks=True)
+                    else:
+                        shutil.copy2(custom_node_entry.path, custom_node_target_path)
+                else:
+                    create_symlink(custom_node_entry.path, custom_node_target_path)
+        elif entry.is_dir():
+            create_symlink(entry.path, target_path)
+        else:
+            # Файлы верхнего уровня (main.py, folder_paths.py, ...) копируем: ComfyUI определяет
+            # свой базовый каталог через realpath(__file__), и он должен указывать на проект
+            shutil.copy2(entry.path, target_path)
+
+    # Убираем то, чего больше нет в сборке (например, после смены окружения проекта)
+    runtime_entries = set(os.listdir(runtime_comfyui_path))
+    for name in os.listdir(project_comfyui_path):
+        if name not in runtime_entries and name not in PROJECT_OWNED_COMFYUI_DIRS and name != "models":
+            _remove_path(os.path.join(project_comfyui_path, name))
+
+    create_symlink(models_folder_path, os.path.join(project_comfyui_path, "models"))
+
+
+def run_shared_runtime_provisioning(ctx, resume=False):
+    """Установка проекта поверх общей сборки: собирается только окружение с новым отпечатком"""
+    fingerprint = compute_environment_fingerprint(ctx.launcher_json, ctx.torch_variant)
+    set_launcher_state_data(
+        ctx.project_folder_path,
+        {"status_message": "Preparing shared environment...", "state": "install_comfyui", "runtime": fingerprint},
+    )
+    runtime_path = ensure_runtime(fingerprint, ctx.launcher_json, ctx.models_folder_path, ctx.torch_variant)
+    try:
+        materialize_project_view(ctx.project_folder_path, runtime_path, ctx.models_folder_path)
+    finally:
+        # Проект уже ссылается на сборку (state.runtime), и prune_unused_runtimes ее не удалит
+        release_lock_file(runtime_path + ".lock")
+    run_provisioning_stages(ctx, resume=resume, only_stages=PROJECT_STAGES)
+
+
+def group_projects_by_runtime(projects):
+    """{отпечаток окружения: [id проектов]} для проектов на общих сборках"""
+    projects_by_runtime = {}
+    for project in projects:
+        fingerprint = (project.get("state") or {}).get("runtime")
+        if fingerprint:
+            projects_by_runtime.setdefault(fingerprint, []).append(project["id"])
+    return projects_by_runtime
+
+
+def get_referenced_runtimes():
+    """Отпечатки сборок, на которые ссылаются проекты"""
+    fingerprints = set()
+    if not os.path.isdir(PROJECTS_DIR):
+        return fingerprints
+    for project_id in os.listdir(PROJECTS_DIR):
+        project_folder_path = os.path.join(PROJECTS_DIR, project_id)
+        if os.path.isdir(project_folder_path):
+            fingerprint = (get_launcher_state(project_folder_path) or {}).get("runtime")
+            if fingerprint:
+                fingerprints.add(fingerprint)
+    return fingerprints
+
+
+def prune_unused_runtimes():
+    """Удаляет сборки RUNTIMES_DIR/<отпечаток>, на которые не ссылается ни один проект; возвращает их отпечатки"""
+    if not os.path.isdir(RUNTIMES_DIR):
+        return []
+    referenced = get_referenced_runtimes()
+    candidates = [
+        name
+        for name in os.listdir(RUNTIMES_DIR)
+        if name not in referenced and os.path.isdir(os.path.join(RUNTIMES_DIR, name))
+    ]
+    # Сборки, которые сейчас собираются или подключаются к проекту, пропускаем
+    locked = [fingerprint for fingerprint in candidates if try_acquire_lock_file(get_runtime_path(fingerprint) + ".lock")]
+    removed = []
+    try:
+        # Проект мог сослаться на сборку, пока брались блокировки: он записывает state.runtime до ensure_runtime
+        referenced = get_referenced_runtimes()
+        for fingerprint in locked:
+            if fingerprint in referenced:
+                continue
+            runtime_path = get_runtime_path(fingerprint)
+            logger.info(f"Removing unused shared runtime {fingerprint}")
+            try:
+                set_tree_read_only(runtime_path, False)
+                shutil.rmtree(runtime_path)
+                removed.append(fingerprint)
+            except OSError as e:
+                logger.warning(f"Failed to remove shared runtime {fingerprint}: {e}")
+    finally:
+        for fingerprint in locked:
+            release_lock_file(get_runtime_path(fingerprint) + ".lock")
+    return removed
@@ -0,0 +1,72 @@
+import json
+import os
+import time
+import logging
+from settings import PROVISIONING_CONCURRENCY, PROVISIONING_STATS_PATH
+from utils import write_json_atomic
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Состояния проекта, пока задача установки еще не взята воркером
+QUEUED_STATES = {"initializing"}
+
+# Состояния проекта во время выполнения задачи установки
+PROVISIONING_STATES = {"fork_environment", "download_comfyui", "install_comfyui", "install_custom_nodes", "download_files"}
+
+# Оценка длительности установки, пока статистики еще нет
+DEFAULT_PROVISIONING_DURATION_SECS = 15 * 60
+
+MAX_RECORDED_DURATIONS = 20
+
+
+def record_provisioning_duration(duration_secs):
+    """Запоминает длительность успешной установки для оценки времени ожидания в очереди"""
+    durations = get_recent_provisioning_durations()
+    durations.append(duration_secs)
+    write_json_atomic(PROVISIONING_STATS_PATH, {"durations": durations[-MAX_RECORDED_DURATIONS:]})
+
+
+def get_recent_provisioning_durations():
+    if not os.path.exists(PROVISIONING_STATS_PATH):
+        return []
+    try:
+        with open(PROVISIONING_STATS_PATH, "r") as f:
+            return json.load(f).get("durations", [])
+    except (OSError, json.JSONDecodeError):
+        return []
+
+
+def get_average_provisioning_duration():
+    durations = get_recent_provisioning_durations()
+    if not durations:
+        return DEFAULT_PROVISIONING_DURATION_SECS
+    return sum(durations) / len(durations)
+
+
+def annotate_queue_positions(projects):
+    """
+    Добавляет к ожидающим установки проектам позицию в очереди (с 1) и оценку времени старта.
+    projects - элементы ответа /api/projects (с ключом state).
+    """
+    now = time.time()
+    average_duration = get_average_provisioning_duration()
+
+    running = [p for p in projects if (p.get("state") or {}).get("state") in PROVISIONING_STATES]
+    queued = [p for p in projects if (p.get("state") or {}).get("state") in QUEUED_STATES]
+    queued.sort(key=lambda p: p["state"].get("queued_at") or p.get("last_modified") or now)
+
+    # Когда освободится каждый из слотов воркера
+    slot_free_at = sorted(
+        max(now, (p["state"].get("started_at") or now) + average_duration) for p in running
+    )[:PROVISIONING_CONCURRENCY]
+    slot_free_at += [now] * max(0, PROVISIONING_CONCURRENCY - len(slot_free_at))
+
+    for position, project in enumerate(queued, 1):
+        slot_free_at.sort()
+        estimated_start = slot_free_at[0]
+        slot_free_at[0] = estimated_start + average_duration
+        project["queue_position"] = position
+        project["estimated_start"] = estimated_start
+    return projects
@@ -1,35 +1,60 @@
 import json
 import shutil
 import signal
-import subprocess
 import stat
 import time
 import torch
 import logging
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, redirect, request, render_template, send_file, stream_with_context
 from showinfm import show_in_file_manager
-from settings import ALLOW_OVERRIDABLE_PORTS_PER_PROJECT, CELERY_BROKER_DIR, CELERY_RESULTS_DIR, PROJECT_MAX_PORT, PROJECT_MIN_PORT, PROJECTS_DIR, MODELS_DIR, PROXY_MODE, SERVER_PORT, TEMPLATES_DIR
+from settings import ALLOW_OVERRIDABLE_PORTS_PER_PROJECT, CELERY_BROKER_DIR, CELERY_RESULTS_DIR, PROJECT_MAX_PORT, PROJECT_MAX_REPLICAS, PROJECT_MIN_PORT, PROJECT_START_TIMEOUT_SECS, PROJECTS_DIR, MODELS_DIR, PROXY_MODE, SERVER_PORT, TEMPLATES_DIR, WARM_POOL_SIZE
 import requests
-import os, psutil, sys
+import os, sys
+from urllib.parse import urlencode
 from utils import (
     CONFIG_FILEPATH,
     DEFAULT_CONFIG,
     get_config,
     get_launcher_json_for_workflow_json,
     get_launcher_state,
-    get_project_port,
     is_launcher_json_format,
     is_port_in_use,
+    on_launcher_state_change,
     run_command,
     run_command_in_project_comfyui_venv,
     set_config,
     set_launcher_state_data,
     slugify,
     update_config,
-    check_url_structure
+    check_url_structure,
+    claim_launcher_state,
 )
 from celery import Celery, Task
-from tasks import create_comfyui_project
+from tasks import enqueue_project_provisioning, refill_warm_pool_task, run_batch_job_task
+from executor import is_embedded_executor, revoke_task, start_embedded_executor, submit_task
+from provisioning import get_first_incomplete_stage, get_provisioning_args
+from warm_pool import claim_warm_pool_entry
+from runtimes import group_projects_by_runtime, prune_unused_runtimes
+from scheduler import annotate_queue_positions
+from progress import get_progress
+from registry import compute_listing_etag, paginate_projects, project_registry, sort_projects
+from ports import PortLeaseError, acquire_project_port, get_port_owner, get_replica_owner_id, release_project_port
+from state_store import delete_project_state, get_project_task_ids, set_project_task_ids
+from events import (
+    publish_project_deleted,
+    publish_state_change,
+    start_redis_events_relay,
+    stream_events,
+)
+from serving import serve
+from supervisor import get_instance_state, get_replica_numbers, reconcile_instances, start_instance, stop_instance, stop_replica
+from resources import should_partition_cpu
+from metrics import metrics_sampler
+from replicas import choose_replica, get_running_replicas
+from prompt_cache import compute_prompt_cache_key, delete_project_prompt_cache, get_cached_file_path, get_cached_result, is_prompt_cache_enabled, result_collector
+from batch import BatchJobError, cancel_batch_job, cancel_project_batch_jobs, create_batch_job, delete_project_batch_jobs, get_batch_job, list_batch_jobs
+from idle import idle_monitor
+from hardware import LEGACY_TORCH_VARIANT, TORCH_VARIANTS, resolve_torch_variant
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -63,6 +88,7 @@ app.config.from_mapping(
         task_always_eager=False,
         broker_connection_retry=True,
         broker_connection_retry_on_startup=True,
+        # Очереди и пул воркеров настраиваются только в celery_app.py
         # Добавляем эти две строки:
         worker_redirect_stdouts=False,
         worker_redirect_stdouts_level='INFO'
@@ -70,6 +96,9 @@ app.config.from_mapping(
 )
 celery_app = celery_init_app(app)
 
+# Изменения состояния, записанные этим процессом, сразу уходят клиентам /api/events
+on_launcher_state_change(publish_state_change)
+
 @app.route("/api/open_models_folder")
 def open_models_folder():
     show_in_file_manager(MODELS_DIR)
@@ -81,49 +110,125 @@ def api_settings():
         "PROJECT_MIN_PORT": PROJECT_MIN_PORT,
         "PROJECT_MAX_PORT": PROJECT_MAX_PORT,
         "ALLOW_OVERRIDABLE_PORTS_PER_PROJECT": ALLOW_OVERRIDABLE_PORTS_PER_PROJECT,
-        "PROXY_MODE": PROXY_MODE
+        "PROXY_MODE": PROXY_MODE,
+        "TORCH_VARIANT": resolve_torch_variant(),
+        "TORCH_VARIANTS": list(TORCH_VARIANTS)
     })
 
+def get_running_instances(states=("starting", "running")):
+    """[(id, pid, порт)] запущенных экземпляров для замеров метрик и проверки простоя; id реплик - <id проекта>#<номер>"""
+    instances = []
+    for project in project_registry.list():
+        if project["state"].get("state") in states and project["state"].get("pid"):
+            instances.append((project["id"], project["state"]["pid"], project["state"].get("port")))
+        for replica, replica_state in (project["state"].get("replicas") or {}).items():
+            if replica_state.get("state") in states and replica_state.get("pid"):
+                instances.append(
+                    (get_replica_owner_id(project["id"], int(replica)), replica_state["pid"], replica_state.get("port"))
+                )
+    return instances
+
+def get_project_listing():
+    projects = project_registry.list()
+
+    # Показываем, какие проекты используют одну общую сборку окружения
+    projects_by_runtime = group_projects_by_runtime(projects)
+    for project in projects:
+        runtime = project["state"].get("runtime")
+        project["runtime"] = runtime
+        project["shared_runtime_with"] = [
+            project_id for project_id in projects_by_runtime.get(runtime, []) if project_id != project["id"]
+        ]
+
+    annotate_queue_positions(projects)
+
+    sort_projects(projects)
+    return projects
+
+
 @app.route("/api/projects", methods=["GET"])
 def list_projects():
-    projects = []
-    for proj_folder in os.listdir(PROJECTS_DIR):
-        full_proj_path = os.path.join(PROJECTS_DIR, proj_folder)
-        if not os.path.isdir(full_proj_path):
-            continue
-        launcher_state, _ = get_launcher_state(full_proj_path)
-        if not launcher_state:
-            continue
-        project_port = get_project_port(proj_folder)
-        projects.append(
-            {
-                "id": proj_folder,
-                "state": launcher_state,
-                "project_folder_name": proj_folder,
-                "project_folder_path": full_proj_path,
-                "last_modified": os.stat(full_proj_path).st_mtime,
-                "port" : project_port
-            }
-        )
+    """
+    Список проектов. Поддерживает условные запросы (ETag по версии реестра и очереди установки) и параметры:
+    state=ready,running - фильтр по состоянию, fields=id,state - только нужные поля,
+    limit=N и cursor=... - постраничная выдача (курсор следующей страницы - в заголовках X-Next-Cursor и Link).
+    """
+    state_filter = {s for s in request.args.get("state", "").split(",") if s}
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    if limit is not None and limit <= 0:
+        return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+
+    # Решение о 304 принимается только по ETag: Last-Modified с точностью до секунды пропустил бы изменения.
+    projects = get_project_listing()
+    etag = compute_listing_etag(project_registry.get_version_tag(), request.query_string.decode(), projects)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        if state_filter:
+            projects = [p for p in projects if p["state"].get("state") in state_filter]
+        total_count = len(projects)
+        try:
+            projects, next_cursor = paginate_projects(projects, limit, cursor)
+        except (ValueError, TypeError):
+            return jsonify({"success": False, "error": "Invalid cursor"}), 400
+        if fields:
+            projects = [{k: v for k, v in p.items() if k == "id" or k in fields} for p in projects]
+
+        response = jsonify(projects)
+        response.headers["X-Total-Count"] = str(total_count)
+        if next_cursor:
+            next_args = request.args.to_dict()
+            next_args["cursor"] = next_cursor
+            response.headers["X-Next-Cursor"] = next_cursor
+            response.headers["Link"] = f'<{request.path}?{urlencode(next_args)}>; rel="next"'
 
-    projects.sort(key=lambda x: x["last_modified"], reverse=True)
-    return jsonify(projects)
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route("/api/projects/<id>", methods=["GET"])
 def get_project(id):
-    project_path = os.path.join(PROJECTS_DIR, id)
-    assert os.path.exists(project_path), f"Project with id {id} does not exist"
-    launcher_state, _ = get_launcher_state(project_path)
-    project_port = get_project_port(id)
-    return jsonify(
-        {
-            "id": id,
-            "state": launcher_state,
-            "project_folder_name": id,
-            "project_folder_path": project_path,
-            "last_modified": os.stat(project_path).st_mtime,
-            "port" : project_port
-        }
+    project = project_registry.get(id)
+    assert project, f"Project with id {id} does not exist"
+    return jsonify(project)
+
+@app.route("/api/projects/<id>/task", methods=["GET"])
+def get_project_task(id):
+    """Подробный прогресс установки проекта из result backend (файлы проекта не читаются)"""
+    state, progress = get_progress(id)
+    return jsonify({"id": id, "task_state": state, "progress": progress})
+
+@app.route("/api/projects/<id>/metrics", methods=["GET"])
+def get_project_metrics(id):
+    """Замеры ресурсов запущенного проекта (новые в конце); ?since=<timestamp> - только более поздние"""
+    assert project_registry.get(id), f"Project with id {id} does not exist"
+    if not metrics_sampler.is_running():
+        return jsonify({"success": False, "error": "Metrics are not sampled by this process"}), 503
+    since = request.args.get("since", type=float)
+    samples = metrics_sampler.get_samples(id, since)
+    return jsonify({"id": id, "latest": samples[-1] if samples else None, "samples": samples})
+
+@app.route("/api/metrics", methods=["GET"])
+def get_host_metrics():
+    """Сводка по хосту: загрузка CPU и памяти, суммарное потребление проектов и самые крупные из них"""
+    if not metrics_sampler.is_running():
+        return jsonify({"success": False, "error": "Metrics are not sampled by this process"}), 503
+    return jsonify(metrics_sampler.get_host_summary())
+
+@app.route("/api/events", methods=["GET"])
+def stream_project_events():
+    """
+    Поток Server-Sent Events с изменениями проектов: project_state (id и измененные поля состояния),
+    project_deleted и reset (пропущенные события недоступны - нужно заново запросить /api/projects).
+    Переподключение с Last-Event-ID (или ?last_event_id=) продолжает поток без потерь.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    return app.response_class(
+        stream_with_context(stream_events(last_event_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 @app.route("/api/get_config", methods=["GET"])
@@ -156,6 +261,7 @@ def create_project():
         
         logger.info(f"Creating project with id {id} and name {name} from template {template_id}")
         assert not os.path.exists(project_path), f"Project with id {id} already exists"
+        torch_variant = resolve_torch_variant(request_data.get("torch_variant"))
 
         models_path = MODELS_DIR
         launcher_json = None
@@ -187,36 +293,39 @@ def create_project():
                     })
 
         # Создание директории проекта и установка начального состояния
-        os.makedirs(project_path)
+        # Общие шаги установки могут быть уже выполнены в окружении из теплого пула
+        claimed_warm_pool_entry = claim_warm_pool_entry(project_path, launcher_json, torch_variant)
+        if not claimed_warm_pool_entry:
+            os.makedirs(project_path)
         set_launcher_state_data(
             project_path,
             {
                 "id": id,
                 "name": name, 
                 "status_message": "Initializing project...", 
-                "state": "initializing"
+                "state": "initializing",
+                "queued_at": time.time()
             },
         )
 
         # Создание и запуск Celery задачи
         logger.info(f"Creating Celery task for project {id}")
-        task = create_comfyui_project.apply_async(
-            args=[project_path, models_path],
-            kwargs={
-                "id": id,
-                "name": name,
-                "launcher_json": launcher_json,
-                "port": port,
-                "create_project_folder": False
-            }
+        task_ids = enqueue_project_provisioning(
+            project_path, models_path,
+            id=id,
+            name=name,
+            launcher_json=launcher_json,
+            port=port,
+            create_project_folder=False,
+            resume=claimed_warm_pool_entry,
+            torch_variant=torch_variant,
         )
-        logger.info(f"Celery task created with ID: {task.id}")
+        logger.info(f"Celery task created with ID: {task_ids[-1]}")
 
         # Сохранение ID задачи
-        with open(os.path.join(project_path, "setup_task_id.txt"), "w") as f:
-            f.write(task.id)
+        set_project_task_ids(project_path, task_ids)
 
-        return jsonify({"success": True, "id": id, "task_id": task.id})
+        return jsonify({"success": True, "id": id, "task_id": task_ids[-1]})
 
     except Exception as e:
         logger.error(f"Error creating project: {str(e)}", exc_info=True)
@@ -237,6 +346,7 @@ def import_project():
         id = slugify(name)
         project_path = os.path.join(PROJECTS_DIR, id)
         assert not os.path.exists(project_path), f"Project with id {id} already exists"
+        torch_variant = resolve_torch_variant(request_data.get("torch_variant"))
 
         models_path = MODELS_DIR
 
@@ -270,31 +380,34 @@ def import_project():
             
         logger.info(f"Creating project with id {id} and name {name} from imported json")
         
-        os.makedirs(project_path)
+        # Общие шаги установки могут быть уже выполнены в окружении из теплого пула
+        claimed_warm_pool_entry = claim_warm_pool_entry(project_path, launcher_json, torch_variant)
+        if not claimed_warm_pool_entry:
+            os.makedirs(project_path)
         set_launcher_state_data(
             project_path,
             {
                 "id": id,
                 "name": name, 
                 "status_message": "Initializing imported project...", 
-                "state": "initializing"
+                "state": "initializing",
+                "queued_at": time.time()
             },
         )
 
-        task = create_comfyui_project.apply_async(
-            args=[project_path, models_path],
-            kwargs={
-                "id": id,
-                "name": name,
-                "launcher_json": launcher_json,
-                "port": port,
-                "create_project_folder": False
-            }
+        task_ids = enqueue_project_provisioning(
+            project_path, models_path,
+            id=id,
+            name=name,
+            launcher_json=launcher_json,
+            port=port,
+            create_project_folder=False,
+            resume=claimed_warm_pool_entry,
+            torch_variant=torch_variant,
         )
-        logger.info(f"Created import task with ID: {task.id}")
+        logger.info(f"Created import task with ID: {task_ids[-1]}")
 
-        with open(os.path.join(project_path, "setup_task_id.txt"), "w") as f:
-            f.write(task.id)
+        set_project_task_ids(project_path, task_ids)
         
         return jsonify({"success": True, "id": id}) 
 
@@ -304,110 +417,520 @@ def import_project():
             shutil.rmtree(project_path, ignore_errors=True)
         return jsonify({"success": False, "error": str(e)})
 
-@app.route("/api/projects/<id>/start", methods=["POST"])
-def start_project(id):
+@app.route("/api/projects/<id>/reprovision", methods=["POST"])
+def reprovision_project(id):
+    """Повторная установка существующего проекта: неизмененные шаги пропускаются по отпечаткам"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    launcher_state = get_launcher_state(project_path)
+    assert launcher_state
+    assert launcher_state["state"] in ("ready", "error"), f"Project with id {id} is busy ({launcher_state['state']})"
+
+    request_data = request.get_json(silent=True) or {}
+    launcher_json = request_data.get("launcher_json")
+    # По умолчанию остаемся на той сборке torch, с которой проект был установлен
+    torch_variant = resolve_torch_variant(
+        request_data.get("torch_variant") or launcher_state.get("torch_variant") or LEGACY_TORCH_VARIANT
+    )
+    if launcher_json is None:
+        launcher_json_fp = os.path.join(project_path, "launcher.json")
+        if os.path.exists(launcher_json_fp):
+            with open(launcher_json_fp, "r") as f:
+                launcher_json = json.load(f)
+
+    set_launcher_state_data(
+        project_path,
+        {"status_message": "Updating project...", "state": "initializing", "queued_at": time.time()},
+    )
+    task_ids = enqueue_project_provisioning(
+        project_path, MODELS_DIR,
+        id=id,
+        name=launcher_state.get("name", id),
+        launcher_json=launcher_json,
+        create_project_folder=False,
+        torch_variant=torch_variant,
+    )
+    logger.info(f"Created reprovision task with ID: {task_ids[-1]}")
+
+    set_project_task_ids(project_path, task_ids)
+
+    return jsonify({"success": True, "id": id, "task_id": task_ids[-1]})
+
+@app.route("/api/projects/<id>/resume", methods=["POST"])
+def resume_project(id):
+    """Возобновление упавшей установки с первого незавершенного шага"""
     project_path = os.path.join(PROJECTS_DIR, id)
     assert os.path.exists(project_path), f"Project with id {id} does not exist"
 
-    launcher_state, _ = get_launcher_state(project_path)
+    launcher_state = get_launcher_state(project_path)
     assert launcher_state
-    assert launcher_state["state"] == "ready", f"Project with id {id} is not ready yet"
+    assert launcher_state["state"] == "error", f"Project with id {id} is not in error state"
+
+    provisioning_args = get_provisioning_args(project_path)
+    assert provisioning_args, f"Project with id {id} has no saved setup to resume"
+
+    first_incomplete_stage = get_first_incomplete_stage(project_path)
+    logger.info(f"Resuming project {id} from stage {first_incomplete_stage}")
+
+    set_launcher_state_data(
+        project_path,
+        {"status_message": "Resuming project setup...", "state": "initializing", "queued_at": time.time()},
+    )
+    task_ids = enqueue_project_provisioning(
+        project_path, provisioning_args["models_folder_path"],
+        id=provisioning_args["id"],
+        name=provisioning_args["name"],
+        launcher_json=provisioning_args["launcher_json"],
+        port=provisioning_args["port"],
+        create_project_folder=False,
+        resume=True,
+        fork_from_path=provisioning_args.get("fork_from_path"),
+        torch_variant=provisioning_args.get("torch_variant"),
+    )
+    logger.info(f"Created resume task with ID: {task_ids[-1]}")
+
+    set_project_task_ids(project_path, task_ids)
+
+    return jsonify({"success": True, "id": id, "task_id": task_ids[-1], "stage": first_incomplete_stage})
+
+@app.route("/api/projects/<id>/fork", methods=["POST"])
+def fork_project(id):
+    """
+    Создание нового проекта на основе окружения существующего: comfyui/ и venv/ клонируются
+    ссылками, а установка применяет только отличия snapshot_json, pip_requirements и files
+    """
+    source_project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(source_project_path), f"Project with id {id} does not exist"
+
+    source_launcher_state = get_launcher_state(source_project_path)
+    assert source_launcher_state
+    assert source_launcher_state["state"] in ("ready", "running"), f"Project with id {id} is not ready yet"
 
-    port = get_project_port(id)
-    assert port, "No free port found"
-    assert not is_port_in_use(port), f"Port {port} is already in use"
+    project_path = None
+    try:
+        request_data = request.get_json()
+        name = request_data["name"]
+        port = request_data.get("port")
+        torch_variant = resolve_torch_variant(
+            request_data.get("torch_variant") or source_launcher_state.get("torch_variant") or LEGACY_TORCH_VARIANT
+        )
+        launcher_json = request_data.get("launcher_json")
+        if launcher_json is None:
+            source_launcher_json_fp = os.path.join(source_project_path, "launcher.json")
+            if os.path.exists(source_launcher_json_fp):
+                with open(source_launcher_json_fp, "r") as f:
+                    launcher_json = json.load(f)
+
+        new_id = slugify(name)
+        project_path = os.path.join(PROJECTS_DIR, new_id)
+        assert not os.path.exists(project_path), f"Project with id {new_id} already exists"
+
+        logger.info(f"Forking project {id} into {new_id}")
+        os.makedirs(project_path)
+        set_launcher_state_data(
+            project_path,
+            {
+                "id": new_id,
+                "name": name,
+                "status_message": "Initializing forked project...",
+                "state": "initializing",
+                "queued_at": time.time(),
+                "forked_from": id
+            },
+        )
+
+        task_ids = enqueue_project_provisioning(
+            project_path, MODELS_DIR,
+            id=new_id,
+            name=name,
+            launcher_json=launcher_json,
+            port=port,
+            create_project_folder=False,
+            fork_from_path=source_project_path,
+            torch_variant=torch_variant,
+        )
+        logger.info(f"Created fork task with ID: {task_ids[-1]}")
+
+        set_project_task_ids(project_path, task_ids)
+
+        return jsonify({"success": True, "id": new_id, "task_id": task_ids[-1]})
+
+    except Exception as e:
+        logger.error(f"Error forking project: {str(e)}", exc_info=True)
+        if project_path and os.path.exists(project_path):
+            shutil.rmtree(project_path, ignore_errors=True)
+        return jsonify({"success": False, "error": str(e)})
+
+def get_venv_python(project_path):
+    if os.name == "nt":
+        return os.path.abspath(os.path.join(project_path, "venv", "Scripts", "python.exe"))
+    return os.path.abspath(os.path.join(project_path, "venv", "bin", "python"))
+
+def get_gpu_flag(launcher_state):
+    """" --cpu", если ComfyUI проекта должен работать на CPU, иначе пустая строка"""
+    mps_available = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
+    if launcher_state.get("torch_variant") == "cpu" or (not torch.cuda.is_available() and not mps_available):
+        return " --cpu"
+    return ""
+
+def get_replica_count(launcher_state):
+    return launcher_state.get("replica_count") or 1
+
+def start_project_replicas(id):
+    """Запускает недостающие реплики запущенного проекта: те же comfyui/ и venv/, свои порт и GPU (если их несколько)"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    launcher_state = get_launcher_state(project_path)
+    comfyui_path = os.path.abspath(os.path.join(project_path, "comfyui"))
+    gpu_flag = get_gpu_flag(launcher_state)
+    device_count = torch.cuda.device_count() if not gpu_flag and torch.cuda.is_available() else 0
+    resource_profile = launcher_state.get("resource_profile")
+
+    for replica in range(1, get_replica_count(launcher_state)):
+        if get_instance_state(project_path, replica).get("state") in ("starting", "running", "stopping"):
+            continue
+        owner_id = get_replica_owner_id(id, replica)
+        try:
+            port = acquire_project_port(owner_id)
+        except PortLeaseError as e:
+            logger.warning(f"Not starting replica {replica} of project {id}: {e}")
+            return
+        if is_port_in_use(port):
+            release_project_port(owner_id)
+            logger.warning(f"Not starting replica {replica} of project {id}: port {port} is already in use")
+            continue
+
+        cmd = [get_venv_python(project_path), "main.py", "--port", str(port), "--listen", "0.0.0.0"] + gpu_flag.split()
+        if device_count > 1:
+            # Основной экземпляр работает на устройстве 0, реплики распределяются по остальным по кругу
+            cmd += ["--cuda-device", str(replica % device_count)]
+        logger.info(f"Starting replica {replica} of project {id}: {' '.join(cmd)}")
+        try:
+            start_instance(
+                project_path,
+                cmd,
+                comfyui_path,
+                port,
+                resource_profile=resource_profile,
+                cpu_partitioned=should_partition_cpu(bool(gpu_flag), resource_profile),
+                replica=replica,
+            )
+        except Exception as e:
+            logger.error(f"Error starting replica {replica} of project {id}: {e}")
+            release_project_port(owner_id)
+
+class ProjectStartError(Exception):
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+def launch_project(id):
+    """
+    Запускает ComfyUI проекта и его реплики; возвращает порт. Проверка и смена состояния проекта - на вызывающем.
+    При ошибке порт освобождается, а проект переходит в состояние failed.
+    """
+    project_path = os.path.join(PROJECTS_DIR, id)
+    launcher_state = get_launcher_state(project_path)
+
+    try:
+        port = acquire_project_port(id)
+    except PortLeaseError as e:
+        set_launcher_state_data(project_path, {"state": "failed", "status_message": f"Error: {e}"})
+        raise ProjectStartError(str(e), 409)
+    if is_port_in_use(port):
+        release_project_port(id)
+        set_launcher_state_data(project_path, {"state": "failed", "status_message": f"Error: port {port} is already in use", "port": None})
+        raise ProjectStartError(f"Port {port} is already in use", 409)
 
     # Получаем абсолютные пути
     comfyui_path = os.path.abspath(os.path.join(project_path, "comfyui"))
-    venv_python = os.path.abspath(os.path.join(project_path, "venv", "Scripts", "python.exe"))
+    venv_python = get_venv_python(project_path)
     
     logger.info(f"Starting ComfyUI for project {id}")
     logger.info(f"ComfyUI path: {comfyui_path}")
     logger.info(f"Python path: {venv_python}")
     
     # Проверяем GPU
-    mps_available = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
-    if not torch.cuda.is_available() and not mps_available:
+    gpu_flag = get_gpu_flag(launcher_state)
+    if gpu_flag:
         logger.warning("No GPU/MPS detected, launching ComfyUI with CPU...")
-        gpu_flag = " --cpu"
-    else:
-        gpu_flag = ""
     
-    # Создаем bat файл для запуска проекта
-    start_bat_content = f'''@echo off
+    # Создаем bat файл для ручного запуска проекта
+    if os.name == "nt":
+        start_bat_content = f'''@echo off
 cd /d "{comfyui_path}"
 call "{os.path.join(project_path, "venv", "Scripts", "activate.bat")}"
 "{venv_python}" main.py --port {port} --listen 0.0.0.0{gpu_flag}
 pause
 '''
-    start_bat_path = os.path.join(project_path, f"start_{id}.bat")
-    with open(start_bat_path, 'w') as f:
-        f.write(start_bat_content)
+        start_bat_path = os.path.join(project_path, f"start_{id}.bat")
+        with open(start_bat_path, 'w') as f:
+            f.write(start_bat_content)
     
-    # Запускаем процесс через subprocess
+    # Запускаем интерпретатор напрямую, без оболочки; готовность и падения отслеживает супервизор
     try:
-        # Создаем команду запуска
-        cmd = f'cmd /c "cd /d "{comfyui_path}" && "{venv_python}" main.py --port {port} --listen 0.0.0.0{gpu_flag}"'
-        logger.info(f"Executing command: {cmd}")
-        
-        # Запускаем в новом окне
-        process = subprocess.Popen(
-            cmd,
-            shell=True,
-            creationflags=subprocess.CREATE_NEW_CONSOLE
-        )
-        
-        pid = process.pid
-        logger.info(f"Started process with PID: {pid}")
-        
-        # Ждем пока порт станет доступен
-        max_wait_secs = 60
-        while max_wait_secs > 0:
-            if is_port_in_use(port):
-                break
-            time.sleep(1)
-            max_wait_secs -= 1
-        
-        if max_wait_secs <= 0:
-            logger.warning(f"Timeout waiting for port {port} to become available")
-        
-        # Обновляем состояние
-        set_launcher_state_data(
+        cmd = [venv_python, "main.py", "--port", str(port), "--listen", "0.0.0.0"] + gpu_flag.split()
+        logger.info(f"Executing command: {' '.join(cmd)}")
+        resource_profile = launcher_state.get("resource_profile")
+        start_instance(
             project_path,
-            {
-                "state": "running",
-                "status_message": "Running...",
-                "port": port,
-                "pid": pid
-            }
+            cmd,
+            comfyui_path,
+            port,
+            resource_profile=resource_profile,
+            cpu_partitioned=should_partition_cpu(bool(gpu_flag), resource_profile),
         )
-        
-        return jsonify({"success": True, "port": port})
-        
+        start_project_replicas(id)
     except Exception as e:
         logger.error(f"Error starting project: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        release_project_port(id)
+        set_launcher_state_data(project_path, {"state": "failed", "status_message": f"Error: {e}", "port": None, "pid": None})
+        raise ProjectStartError(str(e))
+    return port
+
+@app.route("/api/projects/<id>/start", methods=["POST"])
+def start_project(id):
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    launcher_state = get_launcher_state(project_path)
+    assert launcher_state
+    # Проект запускает только один из одновременных запросов (в том числе пробуждение)
+    claimed = claim_launcher_state(project_path, ("ready", "failed", "idle"), {"state": "starting", "status_message": "Starting..."})
+    assert claimed, f"Project with id {id} is not ready yet"
+
+    try:
+        port = launch_project(id)
+    except ProjectStartError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
+    return jsonify({"success": True, "port": port})
+
+@app.route("/api/comfy/<int:port>/wake", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+def wake_project(port):
+    """
+    Запрос к проекту, ComfyUI которого не запущен (прокси PROXY_MODE обращается сюда, не достучавшись до порта).
+    Запускает проект, которому принадлежит порт, ждет готовности и перенаправляет запрос обратно (307).
+    """
+    id = get_port_owner(port)
+    if not id:
+        return jsonify({"success": False, "error": f"No project uses port {port}"}), 502
+    project_path = os.path.join(PROJECTS_DIR, id)
+    original_uri = request.headers.get("X-Original-URI") or f"/comfy/{port}/"
+
+    # Будит проект только первый из одновременных запросов (в любом процессе); упавший проект не перезапускается
+    if claim_launcher_state(project_path, ("idle",), {"state": "starting", "status_message": "Waking up..."}):
+        logger.info(f"Waking project {id} on request to {original_uri}")
+        try:
+            launch_project(id)
+        except ProjectStartError as e:
+            return jsonify({"success": False, "error": f"Project {id} failed to start: {e}"}), 503
+
+    deadline = time.time() + PROJECT_START_TIMEOUT_SECS
+    while time.time() < deadline:
+        launcher_state = get_launcher_state(project_path)
+        if launcher_state.get("state") == "running" and launcher_state.get("port") == port:
+            return redirect(original_uri, code=307)
+        if launcher_state.get("state") != "starting":
+            break
+        time.sleep(0.5)
+    return jsonify({"success": False, "error": f"Project {id} failed to start: {launcher_state.get('status_message')}"}), 503
+
+@app.route("/api/projects/<id>/resources", methods=["POST"])
+def set_project_resources(id):
+    """Профиль ресурсов проекта: cpu_cores и memory_limit_mb (null - по умолчанию), действует со следующего запуска"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    request_data = request.get_json() or {}
+    resource_profile = {}
+    for key in ("cpu_cores", "memory_limit_mb"):
+        value = request_data.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+            return jsonify({"success": False, "error": f"{key} must be a positive integer or null"}), 400
+        resource_profile[key] = value
+    set_launcher_state_data(project_path, {"resource_profile": resource_profile})
+    return jsonify({"success": True, "resource_profile": resource_profile})
+
+@app.route("/api/projects/<id>/replicas", methods=["GET"])
+def get_project_replicas(id):
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    launcher_state = get_launcher_state(project_path)
+    replicas = []
+    for replica in [0] + get_replica_numbers(launcher_state):
+        instance_state = get_instance_state(project_path, replica)
+        replicas.append({
+            "replica": replica,
+            "state": instance_state.get("state"),
+            "status_message": instance_state.get("status_message"),
+            "port": instance_state.get("port"),
+            "pid": instance_state.get("pid"),
+        })
+    return jsonify({"replica_count": get_replica_count(launcher_state), "replicas": replicas})
+
+@app.route("/api/projects/<id>/replicas", methods=["POST"])
+def set_project_replicas(id):
+    """Число экземпляров ComfyUI проекта (count, вместе с основным); у запущенного проекта меняется сразу"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    count = (request.get_json() or {}).get("count")
+    if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= PROJECT_MAX_REPLICAS:
+        return jsonify({"success": False, "error": f"count must be an integer from 1 to {PROJECT_MAX_REPLICAS}"}), 400
+    set_launcher_state_data(project_path, {"replica_count": count})
+
+    launcher_state = get_launcher_state(project_path)
+    if launcher_state.get("state") in ("starting", "running"):
+        for replica in get_replica_numbers(launcher_state):
+            if replica >= count and launcher_state["replicas"][str(replica)].get("state") in ("starting", "running"):
+                stop_replica(project_path, replica)
+        start_project_replicas(id)
+    return jsonify({"success": True, "replica_count": count})
+
+def get_from_replicas(id, path):
+    """Ответы GET path работающих экземпляров проекта: [(номер реплики, порт, JSON или None)]"""
+    responses = []
+    for replica, port in get_running_replicas(os.path.join(PROJECTS_DIR, id)):
+        try:
+            data = requests.get(f"http://127.0.0.1:{port}{path}", timeout=5).json()
+        except (requests.RequestException, ValueError):
+            data = None
+        responses.append((replica, port, data))
+    return responses
+
+@app.route("/api/projects/<id>/prompt", methods=["POST"])
+def submit_project_prompt(id):
+    """
+    Отправляет промпт (тело как у /prompt ComfyUI) работающему экземпляру проекта с самой короткой очередью.
+    Если тот же промпт уже выполнялся в том же окружении, сразу возвращает сохраненные выходные файлы
+    (cached: true); "cache": false в теле - выполнить промпт заново.
+    """
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    body = request.get_json() or {}
+    use_cache = body.pop("cache", True) is not False and is_prompt_cache_enabled()
+    cache_key = None
+    if use_cache and isinstance(body.get("prompt"), dict):
+        cache_key = compute_prompt_cache_key(project_path, body["prompt"])
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            outputs = [
+                {**output, "url": f"/api/prompt_cache/{cache_key}/{output['file']}"} for output in cached["outputs"]
+            ]
+            return jsonify({"prompt_id": cached["prompt_id"], "number": None, "node_errors": {}, "cached": True, "outputs": outputs})
+
+    chosen = choose_replica(project_path)
+    if chosen is None:
+        return jsonify({"success": False, "error": f"Project {id} is not running"}), 409
+    replica, port = chosen
+
+    try:
+        response = requests.post(f"http://127.0.0.1:{port}/prompt", json=body, timeout=30)
+    except requests.RequestException as e:
+        return jsonify({"success": False, "error": f"Failed to submit prompt to replica {replica}: {e}"}), 502
+    try:
+        data = response.json()
+    except ValueError:
+        data = {"error": response.text}
+    if isinstance(data, dict):
+        data.update({"replica": replica, "port": port, "cached": False})
+        if cache_key and response.ok and "prompt_id" in data:
+            result_collector.add(cache_key, id, port, data["prompt_id"])
+    return jsonify(data), response.status_code
+
+@app.route("/api/prompt_cache/<key>/<file_name>", methods=["GET"])
+def get_prompt_cache_file(key, file_name):
+    file_path = get_cached_file_path(key, file_name)
+    if file_path is None:
+        return jsonify({"success": False, "error": "File not found"}), 404
+    return send_file(os.path.abspath(file_path))
+
+@app.route("/api/projects/<id>/queue", methods=["GET"])
+def get_project_queue(id):
+    """Очередь ComfyUI всех работающих экземпляров проекта"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    queue = {"queue_running": [], "queue_pending": [], "replicas": []}
+    for replica, port, data in get_from_replicas(id, "/queue"):
+        data = data or {}
+        queue["queue_running"] += data.get("queue_running", [])
+        queue["queue_pending"] += data.get("queue_pending", [])
+        queue["replicas"].append({
+            "replica": replica,
+            "port": port,
+            "available": bool(data),
+            "queue_running": len(data.get("queue_running", [])),
+            "queue_pending": len(data.get("queue_pending", [])),
+        })
+    return jsonify(queue)
+
+@app.route("/api/projects/<id>/history", methods=["GET"])
+@app.route("/api/projects/<id>/history/<prompt_id>", methods=["GET"])
+def get_project_history(id, prompt_id=None):
+    """История ComfyUI всех работающих экземпляров проекта (max_items - с каждого экземпляра)"""
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    path = f"/history/{prompt_id}" if prompt_id else "/history"
+    if request.query_string:
+        path += "?" + request.query_string.decode()
+    history = {}
+    for _, _, data in get_from_replicas(id, path):
+        if isinstance(data, dict):
+            history.update(data)
+    return jsonify(history)
+
+@app.route("/api/projects/<id>/jobs", methods=["POST"])
+def create_project_batch_job(id):
+    """
+    Пакетное задание: workflow ("launcher" - workflow_json из launcher.json, либо промпт в формате API),
+    sweep {"seeds": [...] или {"start", "count"}, "prompts": [...], "csv": "..."}, необязательные
+    targets {"seed": ["3.seed"], ...} и concurrency. Проект должен быть запущен.
+    """
+    project_path = os.path.join(PROJECTS_DIR, id)
+    assert os.path.exists(project_path), f"Project with id {id} does not exist"
+
+    try:
+        job_id = create_batch_job(id, request.get_json() or {})
+    except (BatchJobError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    submit_task(run_batch_job_task, job_id)
+    return jsonify({"success": True, "job": get_batch_job(job_id)})
+
+@app.route("/api/projects/<id>/jobs", methods=["GET"])
+def list_project_batch_jobs(id):
+    return jsonify(list_batch_jobs(id))
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = get_batch_job(job_id, with_items=request.args.get("items") == "true")
+    if job is None:
+        return jsonify({"success": False, "error": f"Job {job_id} not found"}), 404
+    return jsonify(job)
+
+@app.route("/api/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    if not cancel_batch_job(job_id):
+        return jsonify({"success": False, "error": f"Job {job_id} is not running"}), 409
+    return jsonify({"success": True})
 
 @app.route("/api/projects/<id>/stop", methods=["POST"])
 def stop_project(id):
     project_path = os.path.join(PROJECTS_DIR, id)
     assert os.path.exists(project_path), f"Project with id {id} does not exist"
 
-    launcher_state, _ = get_launcher_state(project_path)
+    launcher_state = get_launcher_state(project_path)
     assert launcher_state
 
-    assert launcher_state["state"] == "running", f"Project with id {id} is not running"
+    assert launcher_state["state"] in ("starting", "running", "idle"), f"Project with id {id} is not running"
 
-    try:
-        pid = launcher_state["pid"]
-        parent_pid = pid
-        parent = psutil.Process(parent_pid)
-        for child in parent.children(recursive=True):
-            child.terminate()
-        parent.terminate()
-    except:
-        pass
+    if launcher_state["state"] != "idle":
+        stop_instance(project_path)
 
+    release_project_port(id)
     set_launcher_state_data(project_path, {"state": "ready", "status_message" : "Ready", "port": None, "pid": None})
     return jsonify({"success": True})
 
@@ -416,18 +939,17 @@ def delete_project(id):
     project_path = os.path.join(PROJECTS_DIR, id)
     assert os.path.exists(project_path), f"Project with id {id} does not exist"
 
-    setup_task_id_fp = os.path.join(project_path, "setup_task_id.txt")
-    if os.path.exists(setup_task_id_fp):
-        with open(setup_task_id_fp, "r") as f:
-            setup_task_id = f.read()
-            if setup_task_id:
-                try:
-                    celery_app.control.revoke(setup_task_id, terminate=True)
-                except:
-                    pass
-
-    launcher_state, _ = get_launcher_state(project_path)
-    if launcher_state and launcher_state["state"] == "running":
+    # Установка может состоять из цепочки задач
+    for setup_task_id in get_project_task_ids(project_path):
+        try:
+            revoke_task(setup_task_id)
+        except:
+            pass
+    # Пакетные задания останавливаются до удаления папки с их результатами
+    cancel_project_batch_jobs(id)
+
+    launcher_state = get_launcher_state(project_path)
+    if launcher_state and launcher_state["state"] in ("starting", "running", "idle"):
         stop_project(id)
 
     try:
@@ -442,11 +964,14 @@ def delete_project(id):
                 func(path)  # Пробуем удалить снова
                 
             # Сначала делаем все файлы доступными для записи
+            # (симлинки пропускаем: они могут вести в общую сборку окружения)
             for root, dirs, files in os.walk(project_path):
                 for dir in dirs:
-                    os.chmod(os.path.join(root, dir), stat.S_IWRITE)
+                    if not os.path.islink(os.path.join(root, dir)):
+                        os.chmod(os.path.join(root, dir), stat.S_IWRITE)
                 for file in files:
-                    os.chmod(os.path.join(root, file), stat.S_IWRITE)
+                    if not os.path.islink(os.path.join(root, file)):
+                        os.chmod(os.path.join(root, file), stat.S_IWRITE)
                     
             # Пытаемся удалить еще раз с обработчиком ошибок
             shutil.rmtree(project_path, onerror=on_rm_error)
@@ -460,6 +985,14 @@ def delete_project(id):
         logger.error(f"Error deleting project: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+    release_project_port(id, keep_pinned=False)
+    delete_project_state(project_path)
+    delete_project_batch_jobs(id)
+    delete_project_prompt_cache(id)
+    # Общая сборка окружения, которой пользовался только этот проект, больше не нужна
+    prune_unused_runtimes()
+    project_registry.refresh(id)
+    publish_project_deleted(id)
     return jsonify({"success": True})
 
 @app.route('/', defaults={'path': ''})
@@ -474,5 +1007,21 @@ if __name__ == "__main__":
     os.makedirs(MODELS_DIR, exist_ok=True)
     if not os.path.exists(CONFIG_FILEPATH):
         set_config(DEFAULT_CONFIG)
+    if is_embedded_executor():
+        # Без брокера задачи установки выполняются в этом же процессе
+        start_embedded_executor()
+        if WARM_POOL_SIZE > 0:
+            submit_task(refill_warm_pool_task)
+    # Экземпляры ComfyUI, пережившие перезапуск лаунчера
+    reconcile_instances()
+    prune_unused_runtimes()
+
+    def start_services():
+        project_registry.start_watcher()
+        metrics_sampler.start(get_running_instances)
+        idle_monitor.start(lambda: get_running_instances(states=("running",)))
+        if not is_embedded_executor():
+            start_redis_events_relay()
+
     logger.info(f"Open http://localhost:{SERVER_PORT} in your browser.")
-    app.run(host="0.0.0.0", debug=False, port=SERVER_PORT)    
\ No newline at end of file
+    serve(app, start_services)    
\ No newline at end of file
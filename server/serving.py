@@ -0,0 +1,51 @@
+import signal
+import sys
+import logging
+from settings import (
+    SERVER_GRACEFUL_TIMEOUT_SECS,
+    SERVER_KEEPALIVE_SECS,
+    SERVER_MODE,
+    SERVER_PORT,
+    SERVER_THREADS,
+)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Запуск сервера API. В режиме production запросы обрабатываются пулом потоков waitress, поэтому
+# долгие обработчики (start_project ждет запуска ComfyUI) и потоки /api/events не блокируют остальные.
+# Сервер всегда работает в одном процессе: супервизор экземпляров ComfyUI, остановка по простою и
+# сбор метрик живут в памяти процесса и должны быть единственными.
+# Фоновые службы (наблюдатель реестра, пересылка событий из Redis) запускаются start_services.
+
+SERVER_HOST = "0.0.0.0"
+
+
+def _serve_waitress(app, start_services):
+    from waitress import create_server
+
+    start_services()
+    server = create_server(
+        app,
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        threads=SERVER_THREADS,
+        channel_timeout=SERVER_KEEPALIVE_SECS,
+        ident="ComfyUI Launcher",
+    )
+    # waitress завершает работу по SystemExit/KeyboardInterrupt, дожидаясь потоков запросов
+    task_dispatcher_shutdown = server.task_dispatcher.shutdown
+    server.task_dispatcher.shutdown = lambda: task_dispatcher_shutdown(timeout=SERVER_GRACEFUL_TIMEOUT_SECS)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Serving with waitress on port {SERVER_PORT} ({SERVER_THREADS} threads)")
+    server.run()
+
+
+def serve(app, start_services):
+    if SERVER_MODE != "production":
+        start_services()
+        app.run(host=SERVER_HOST, debug=False, port=SERVER_PORT)
+        return
+
+    _serve_waitress(app, start_services)
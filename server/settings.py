@@ -18,6 +18,12 @@ os.makedirs(os.path.join(os.environ.get("CELERY_DIR", ".celery"), "broker"), exi
 CELERY_RESULTS_DIR = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "results")
 CELERY_BROKER_DIR = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "broker")
 
+os.makedirs(os.path.join(os.environ.get("CELERY_DIR", ".celery"), "slots"), exist_ok=True)
+SCHEDULER_SLOTS_DIR = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "slots")
+# Shared launcher database (port leases, ...), safe to use from the API server and Celery workers
+LAUNCHER_DB_PATH = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "launcher.sqlite3")
+PROVISIONING_STATS_PATH = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "provisioning_stats.json")
+
 # Redis configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -42,8 +48,110 @@ ALLOW_OVERRIDABLE_PORTS_PER_PROJECT = os.environ.get("ALLOW_OVERRIDABLE_PORTS_PE
 PROJECT_MIN_PORT = int(os.environ.get("PROJECT_MIN_PORT", "4001"))
 PROJECT_MAX_PORT = int(os.environ.get("PROJECT_MAX_PORT", "4100"))
 SERVER_PORT = int(os.environ.get("SERVER_PORT", "4000"))
+# Built-in reverse proxy (PROXY_MODE): serves the launcher at / and project instances at /comfy/<id>/
+PROXY_HOST = os.environ.get("PROXY_HOST", "0.0.0.0")
+PROXY_PORT = int(os.environ.get("PROXY_PORT", os.environ.get("NGINX_PORT", "80")))
+# Pooled keep-alive connections to the launcher and instances
+PROXY_UPSTREAM_CONNECTIONS = int(os.environ.get("PROXY_UPSTREAM_CONNECTIONS", "256"))
+PROXY_UPSTREAM_KEEPALIVE_SECS = int(os.environ.get("PROXY_UPSTREAM_KEEPALIVE_SECS", "60"))
+# Latency percentiles in /api/proxy/stats are computed over this many recent requests per project
+PROXY_LATENCY_HISTORY_SIZE = int(os.environ.get("PROXY_LATENCY_HISTORY_SIZE", "1000"))
+# How long a starting ComfyUI may take to accept HTTP requests before the start is marked failed
+PROJECT_START_TIMEOUT_SECS = int(os.environ.get("PROJECT_START_TIMEOUT_SECS", "120"))
+# Stopping ComfyUI sends SIGTERM to its process group and SIGKILL after this many seconds
+PROJECT_STOP_TIMEOUT_SECS = int(os.environ.get("PROJECT_STOP_TIMEOUT_SECS", "15"))
+# Crashed instances are restarted with exponential backoff, at most this many times in a row
+PROJECT_MAX_RESTARTS = int(os.environ.get("PROJECT_MAX_RESTARTS", "5"))
+PROJECT_RESTART_BACKOFF_MAX_SECS = int(os.environ.get("PROJECT_RESTART_BACKOFF_MAX_SECS", "60"))
+# Upper bound for replicas (ComfyUI processes sharing one project's comfyui/ and venv/) per project
+PROJECT_MAX_REPLICAS = int(os.environ.get("PROJECT_MAX_REPLICAS", "8"))
+# CPU cores are split between running instances: "auto" (instances running on CPU and projects
+# with an explicit cpu_cores profile), "all" (every instance) or "off"
+CPU_PARTITIONING = os.environ.get("CPU_PARTITIONING", "auto").lower()
+# Default memory limit per instance in MB (0 - no limit), enforced through cgroup v2 when
+# LAUNCHER_CGROUP_DIR points to a cgroup delegated to the launcher, otherwise with RLIMIT_AS
+PROJECT_MEMORY_LIMIT_MB = int(os.environ.get("PROJECT_MEMORY_LIMIT_MB", "0"))
+LAUNCHER_CGROUP_DIR = os.environ.get("LAUNCHER_CGROUP_DIR", "")
+
+# Runtime metrics of running instances (/api/projects/<id>/metrics), sampled and kept in memory by the
+# API server process (it always runs as a single process): sampling interval and number of samples kept per
+# project (default: last 30 minutes)
+METRICS_SAMPLE_INTERVAL_SECS = float(os.environ.get("METRICS_SAMPLE_INTERVAL_SECS", "5"))
+METRICS_HISTORY_SIZE = int(os.environ.get("METRICS_HISTORY_SIZE", "360"))
+
+# Running instances without queued prompts, new history entries or new client connections for
+# IDLE_TIMEOUT_SECS are stopped (0 - never); in PROXY_MODE the next request to /comfy/<id>/ wakes them up
+IDLE_TIMEOUT_SECS = int(os.environ.get("IDLE_TIMEOUT_SECS", "0"))
+IDLE_CHECK_INTERVAL_SECS = int(os.environ.get("IDLE_CHECK_INTERVAL_SECS", "30"))
+
+# Batch jobs (/api/projects/<id>/jobs): default number of prompts in flight per job, upper bound for
+# prompts in one sweep and how long a single prompt may take
+BATCH_JOB_CONCURRENCY = int(os.environ.get("BATCH_JOB_CONCURRENCY", "2"))
+BATCH_JOB_MAX_ITEMS = int(os.environ.get("BATCH_JOB_MAX_ITEMS", "10000"))
+BATCH_JOB_PROMPT_TIMEOUT_SECS = int(os.environ.get("BATCH_JOB_PROMPT_TIMEOUT_SECS", "3600"))
+
+# Results of prompts submitted through the launcher are cached by prompt, environment and input files;
+# least recently used results are evicted above PROMPT_CACHE_MAX_MB (0 - cache disabled)
+PROMPT_CACHE_DIR = os.environ.get("PROMPT_CACHE_DIR", os.path.join(os.environ.get("CELERY_DIR", ".celery"), "prompt_cache"))
+PROMPT_CACHE_MAX_MB = int(os.environ.get("PROMPT_CACHE_MAX_MB", "10240"))
+
+# API server: "development" (Flask's built-in server) or "production" (waitress)
+SERVER_MODE = os.environ.get("SERVER_MODE", "development").lower()
+# The API server runs as a single process: it supervises ComfyUI instances and runs the idle monitor
+# and metrics sampler, which must not be duplicated.
+# Request threads of the server process; each open /api/events stream holds one of them
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "32"))
+# Idle keep-alive connections are closed after this many seconds
+SERVER_KEEPALIVE_SECS = int(os.environ.get("SERVER_KEEPALIVE_SECS", "75"))
+# On SIGTERM/SIGINT in-flight requests get this long to finish
+SERVER_GRACEFUL_TIMEOUT_SECS = int(os.environ.get("SERVER_GRACEFUL_TIMEOUT_SECS", "30"))
+
+# Warm pool of pre-built project environments
+WARM_POOL_DIR = os.environ.get("WARM_POOL_DIR", "./.warm_pool")
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0"))
+# Comma-separated ComfyUI commits to keep warm in addition to the latest one
+WARM_POOL_COMFYUI_COMMITS = [c.strip() for c in os.environ.get("WARM_POOL_COMFYUI_COMMITS", "").split(",") if c.strip()]
+
+# Torch build to install into project venvs: auto (detect from hardware), cpu, cu118, cu121, cu124, rocm5.7, rocm6.0, mps
+TORCH_VARIANT = os.environ.get("TORCH_VARIANT", "auto").lower()
+
+# Shared runtimes: projects with identical environment fingerprints share one comfyui+venv build
+SHARED_RUNTIMES = os.environ.get("SHARED_RUNTIMES", "false").lower() == "true"
+RUNTIMES_DIR = os.environ.get("RUNTIMES_DIR", "./runtimes")
+
+# Concurrent provisioning: number of setup tasks a worker runs at once, and separate budgets
+# for network transfers (git clone, model downloads), pip/CPU work and bulk disk I/O
+PROVISIONING_CONCURRENCY = int(os.environ.get("PROVISIONING_CONCURRENCY", "4"))
+PROVISIONING_BUDGETS = {
+    "network": int(os.environ.get("PROVISIONING_NETWORK_SLOTS", "2")),
+    "pip": int(os.environ.get("PROVISIONING_PIP_SLOTS", str(max(1, (os.cpu_count() or 2) // 4)))),
+    "disk": int(os.environ.get("PROVISIONING_DISK_SLOTS", "2")),
+}
+
+# How often the API server re-checks project folders for changes made by other processes (seconds)
+PROJECT_REGISTRY_POLL_SECS = float(os.environ.get("PROJECT_REGISTRY_POLL_SECS", "1"))
+
+# Project state change events (/api/events): workers publish them over Redis pub/sub,
+# the API server keeps the last EVENTS_BUFFER_SIZE events for clients resuming with Last-Event-ID
+REDIS_URL = f"redis://{os.environ.get('REDIS_HOST', 'localhost')}:{os.environ.get('REDIS_PORT', '6379')}/0"
+EVENTS_CHANNEL = os.environ.get("EVENTS_CHANNEL", "launcher:events")
+EVENTS_BUFFER_SIZE = int(os.environ.get("EVENTS_BUFFER_SIZE", "1000"))
+
+# Task executor: "celery" (Redis broker + Celery workers started by run.sh / entrypoint.sh) or
+# "embedded" (thread pool inside the launcher process with a durable SQLite job table, no Redis needed)
+TASK_EXECUTOR = os.environ.get("TASK_EXECUTOR", "celery").lower()
+EMBEDDED_JOBS_DB_PATH = os.path.join(os.environ.get("CELERY_DIR", ".celery"), "jobs.sqlite3")
+
+# Provisioning is split into chained per-stage tasks routed to a queue per kind of work,
+# so each queue can be served by its own worker pool (see run.sh / entrypoint.sh)
+PROVISIONING_QUEUES = {
+    "git": "provision_git",
+    "pip": "provision_pip",
+    "download": "provision_download",
+    "finalize": "provision_finalize",
+}
 
 # Additional settings for Windows
 CELERY_POOL_RESTARTS = True
-CELERY_WORKER_POOL = 'solo'
+CELERY_WORKER_POOL = 'threads'
 CELERYD_POOL_RESTARTS = True
\ No newline at end of file
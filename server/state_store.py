@@ -0,0 +1,249 @@
+import json
+import os
+import time
+import logging
+from launcher_db import get_launcher_db, register_schema
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Состояние проектов в общей базе лаунчера: состояние для UI, закрепленный порт, id задач установки
+# и время изменений. Запись - транзакция BEGIN IMMEDIATE, поэтому частичные обновления из сервера API
+# и воркеров не теряют друг друга. Записи привязаны к пути папки и ее inode: запись от удаленной
+# в обход API папки с тем же именем не подхватывается новой.
+# Старые файлы проекта (.launcher/state.json, port.txt, setup_task_id.txt) переносятся в базу
+# при первом обращении к проекту и удаляются.
+
+LEGACY_STATE_FILE = os.path.join(".launcher", "state.json")
+LEGACY_PORT_FILE = "port.txt"
+LEGACY_TASK_IDS_FILE = "setup_task_id.txt"
+
+register_schema(
+    """
+    CREATE TABLE IF NOT EXISTS project_states (
+        path TEXT PRIMARY KEY,
+        parent_path TEXT NOT NULL,
+        folder_id TEXT,
+        state TEXT NOT NULL DEFAULT '{}',
+        status TEXT,
+        pinned_port INTEGER,
+        task_ids TEXT NOT NULL DEFAULT '[]',
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS project_states_parent_path ON project_states (parent_path)",
+    "CREATE INDEX IF NOT EXISTS project_states_status ON project_states (status)",
+    "CREATE INDEX IF NOT EXISTS project_states_updated_at ON project_states (updated_at)",
+)
+
+
+def _normalize_path(project_folder_path):
+    return os.path.abspath(project_folder_path)
+
+
+def _get_folder_id(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat_result.st_dev}:{stat_result.st_ino}"
+
+
+def _read_legacy_files(path):
+    """Данные из файлов проекта до переноса в базу, либо None, если файлов нет"""
+    state_path = os.path.join(path, LEGACY_STATE_FILE)
+    port_path = os.path.join(path, LEGACY_PORT_FILE)
+    task_ids_path = os.path.join(path, LEGACY_TASK_IDS_FILE)
+    if not any(os.path.exists(p) for p in (state_path, port_path, task_ids_path)):
+        return None
+
+    legacy = {"state": {}, "pinned_port": None, "task_ids": []}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            legacy["state"] = json.load(f)
+    if os.path.exists(port_path):
+        with open(port_path, "r") as f:
+            legacy["pinned_port"] = int(f.read().strip())
+    if os.path.exists(task_ids_path):
+        with open(task_ids_path, "r") as f:
+            legacy["task_ids"] = f.read().split()
+    return legacy
+
+
+def _remove_legacy_files(path):
+    for name in (LEGACY_STATE_FILE, LEGACY_PORT_FILE, LEGACY_TASK_IDS_FILE):
+        try:
+            os.remove(os.path.join(path, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove migrated file {name} in {path}: {e}")
+
+
+def _load_row(conn, path):
+    """Актуальная запись проекта; записи от другой папки с тем же путем удаляются"""
+    row = conn.execute("SELECT * FROM project_states WHERE path = ?", (path,)).fetchone()
+    folder_id = _get_folder_id(path)
+    if row and row["folder_id"] != folder_id:
+        conn.execute("DELETE FROM project_states WHERE path = ?", (path,))
+        row = None
+    return row
+
+
+def _migrate_legacy_files(conn, path):
+    legacy = _read_legacy_files(path)
+    if legacy is None:
+        return None
+    now = time.time()
+    conn.execute(
+        """
+        INSERT INTO project_states (path, parent_path, folder_id, state, status, pinned_port, task_ids, created_at, updated_at, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+        """,
+        (
+            path,
+            os.path.dirname(path),
+            _get_folder_id(path),
+            json.dumps(legacy["state"]),
+            legacy["state"].get("state"),
+            legacy["pinned_port"],
+            json.dumps(legacy["task_ids"]),
+            now,
+            now,
+        ),
+    )
+    logger.info(f"Migrated project files of {path} to the launcher database")
+    return conn.execute("SELECT * FROM project_states WHERE path = ?", (path,)).fetchone()
+
+
+def _get_row(project_folder_path):
+    path = _normalize_path(project_folder_path)
+    with get_launcher_db() as conn:
+        row = conn.execute("SELECT * FROM project_states WHERE path = ?", (path,)).fetchone()
+    if row and row["folder_id"] == _get_folder_id(path):
+        return row
+    if row is None and _read_legacy_files(path) is None:
+        return None
+
+    # Устаревшая запись или файлы, еще не перенесенные в базу
+    with get_launcher_db(write=True) as conn:
+        row = _load_row(conn, path) or _migrate_legacy_files(conn, path)
+    if row is not None:
+        _remove_legacy_files(path)
+    return row
+
+
+def _update_row(project_folder_path, update):
+    """
+    Изменяет запись проекта в одной транзакции: update(row) возвращает {столбец: значение} или None,
+    если запись менять не нужно. Возвращает True, если запись изменена.
+    """
+    path = _normalize_path(project_folder_path)
+    with get_launcher_db(write=True) as conn:
+        row = _load_row(conn, path)
+        migrated = False
+        if row is None:
+            row = _migrate_legacy_files(conn, path)
+            migrated = row is not None
+        now = time.time()
+        if row is None:
+            conn.execute(
+                """
+                INSERT INTO project_states (path, parent_path, folder_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (path, os.path.dirname(path), _get_folder_id(path), now, now),
+            )
+            row = conn.execute("SELECT * FROM project_states WHERE path = ?", (path,)).fetchone()
+        fields = update(row)
+        if fields is None:
+            return False
+        assignments = ", ".join([f"{name} = ?" for name in fields] + ["updated_at = ?", "version = version + 1"])
+        conn.execute(f"UPDATE project_states SET {assignments} WHERE path = ?", [*fields.values(), now, path])
+    if migrated:
+        _remove_legacy_files(path)
+    return True
+
+
+def load_project_state(project_folder_path):
+    row = _get_row(project_folder_path)
+    return json.loads(row["state"]) if row else {}
+
+
+def update_project_state(project_folder_path, data):
+    """Атомарно дописывает поля data в состояние проекта"""
+
+    def merge(row):
+        state = json.loads(row["state"])
+        state.update(data)
+        return {"state": json.dumps(state), "status": state.get("state")}
+
+    _update_row(project_folder_path, merge)
+
+
+def claim_project_state(project_folder_path, from_states, data):
+    """
+    Атомарно дописывает data в состояние проекта, только если его state входит в from_states.
+    Возвращает True, если состояние изменено этим вызовом (из нескольких процессов - ровно одним).
+    """
+
+    def merge(row):
+        state = json.loads(row["state"])
+        if state.get("state") not in from_states:
+            return None
+        state.update(data)
+        return {"state": json.dumps(state), "status": state.get("state")}
+
+    return _update_row(project_folder_path, merge)
+
+
+def update_project_replica_state(project_folder_path, replica, data):
+    """Атомарно дописывает поля data в состояние реплики проекта (state["replicas"][номер])"""
+
+    def merge(row):
+        state = json.loads(row["state"])
+        replicas = state.setdefault("replicas", {})
+        replicas.setdefault(str(replica), {}).update(data)
+        return {"state": json.dumps(state)}
+
+    _update_row(project_folder_path, merge)
+
+
+def get_project_state_version(project_folder_path):
+    row = _get_row(project_folder_path)
+    return row["version"] if row else None
+
+
+def get_project_state_versions(parent_path):
+    """{имя папки: версия записи} для всех записей в каталоге parent_path (например, PROJECTS_DIR)"""
+    with get_launcher_db() as conn:
+        rows = conn.execute(
+            "SELECT path, version FROM project_states WHERE parent_path = ?", (_normalize_path(parent_path),)
+        ).fetchall()
+    return {os.path.basename(row["path"]): row["version"] for row in rows}
+
+
+def get_pinned_project_port(project_folder_path):
+    row = _get_row(project_folder_path)
+    return row["pinned_port"] if row else None
+
+
+def set_pinned_project_port(project_folder_path, port):
+    _update_row(project_folder_path, lambda row: {"pinned_port": port})
+
+
+def get_project_task_ids(project_folder_path):
+    row = _get_row(project_folder_path)
+    return json.loads(row["task_ids"]) if row else []
+
+
+def set_project_task_ids(project_folder_path, task_ids):
+    _update_row(project_folder_path, lambda row: {"task_ids": json.dumps(list(task_ids))})
+
+
+def delete_project_state(project_folder_path):
+    with get_launcher_db(write=True) as conn:
+        conn.execute("DELETE FROM project_states WHERE path = ?", (_normalize_path(project_folder_path),))
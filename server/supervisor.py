@@ -0,0 +1,447 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+import logging
+import psutil
+from settings import (
+    PROJECT_MAX_RESTARTS,
+    PROJECT_RESTART_BACKOFF_MAX_SECS,
+    PROJECT_START_TIMEOUT_SECS,
+    PROJECT_STOP_TIMEOUT_SECS,
+    PROJECTS_DIR,
+)
+from ports import get_replica_owner_id, release_project_port
+from readiness import get_comfyui_log_path, wait_until_ready
+from resources import (
+    acquire_project_cores,
+    apply_memory_limit,
+    attach_project_process,
+    get_thread_env,
+    prune_project_cores,
+    release_project_cores,
+)
+from state_store import update_project_replica_state
+from utils import get_launcher_state, set_launcher_state_data
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Супервизор экземпляров ComfyUI. Интерпретатор venv запускается напрямую, без оболочки, в своей
+# группе процессов (на POSIX - в своей сессии), поэтому остановка TERM -> (PROJECT_STOP_TIMEOUT_SECS) -> KILL
+# доходит до всех его дочерних процессов. Для каждого экземпляра поток процесса сервера ждет готовности,
+# затем следит за процессом и перезапускает упавший с растущей паузой (не более PROJECT_MAX_RESTARTS раз
+# подряд). Команда запуска и время создания процесса хранятся в состоянии проекта: при старте лаунчера
+# живые экземпляры берутся под наблюдение заново, а состояние с умершими pid сбрасывается.
+# Реплики проекта (дополнительные экземпляры на других портах) наблюдаются так же; их состояние
+# хранится в state["replicas"][номер], порт и ядра арендуются под id реплики (см. get_replica_owner_id).
+
+SUPERVISOR_POLL_SECS = 1
+RESTART_BACKOFF_INITIAL_SECS = 1
+# Экземпляр, проработавший столько, считается здоровым: счетчик перезапусков обнуляется
+RESTART_RESET_SECS = 300
+MAX_RECORDED_START_DURATIONS = 20
+
+
+class _AdoptedProcess:
+    """Экземпляр, запущенный до старта лаунчера: тот же интерфейс poll(), что у subprocess.Popen"""
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+
+    def poll(self):
+        try:
+            if self.process.is_running() and self.process.status() != psutil.STATUS_ZOMBIE:
+                return None
+        except psutil.Error:
+            pass
+        # Код выхода не нашего дочернего процесса неизвестен
+        return -1
+
+
+def _get_process_create_time(pid):
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.Error:
+        return None
+
+
+def _find_process(pid, create_time):
+    """Процесс экземпляра, если он жив и pid не достался другому процессу"""
+    if not pid:
+        return None
+    try:
+        process = psutil.Process(pid)
+        if create_time is not None and abs(process.create_time() - create_time) > 1:
+            return None
+        if process.status() == psutil.STATUS_ZOMBIE:
+            return None
+        return process
+    except psutil.Error:
+        return None
+
+
+def _is_group_leader(pid):
+    try:
+        return os.getpgid(pid) == pid
+    except OSError:
+        return False
+
+
+def _spawn(command, cwd, log_path, append, env):
+    with open(log_path, "ab" if append else "wb") as log_file:
+        log_offset = log_file.tell()
+        kwargs = {}
+        if os.name == "posix":
+            kwargs["start_new_session"] = True
+        else:
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            # Без буферизации строка о готовности попадает в лог сразу
+            env={**os.environ, **env, "PYTHONUNBUFFERED": "1"},
+            **kwargs,
+        )
+    return process, log_offset
+
+
+def terminate_instance(pid, create_time=None, timeout=PROJECT_STOP_TIMEOUT_SECS):
+    """Останавливает экземпляр со всеми дочерними процессами: TERM, через timeout секунд - KILL"""
+    process = _find_process(pid, create_time)
+    if process is None:
+        return
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        processes = [process]
+
+    if os.name == "posix" and _is_group_leader(pid):
+        # Экземпляр - лидер своей группы: сигнал получают и процессы, уже отвязавшиеся от него
+        os.killpg(pid, signal.SIGTERM)
+    else:
+        for p in processes:
+            try:
+                p.terminate()
+            except psutil.Error:
+                pass
+
+    _, alive = psutil.wait_procs(processes, timeout=timeout)
+    if alive:
+        logger.warning(f"Instance {pid} did not stop in {timeout}s, killing it")
+        if os.name == "posix" and _is_group_leader(pid):
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for p in alive:
+            try:
+                p.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(alive, timeout=timeout)
+
+
+def get_instance_state(project_folder_path, replica=0):
+    launcher_state = get_launcher_state(project_folder_path)
+    if not replica:
+        return launcher_state
+    return (launcher_state.get("replicas") or {}).get(str(replica), {})
+
+
+def _set_instance_state(project_folder_path, replica, data):
+    if replica:
+        # Состояние реплики не рассылается как состояние проекта
+        update_project_replica_state(project_folder_path, replica, data)
+    else:
+        set_launcher_state_data(project_folder_path, data)
+
+
+class _Instance:
+    def __init__(
+        self, project_folder_path, command, cwd, port, resource_profile=None, cpu_partitioned=False, replica=0
+    ):
+        self.project_folder_path = project_folder_path
+        self.replica = replica
+        self.project_id = get_replica_owner_id(os.path.basename(project_folder_path), replica)
+        self.command = command
+        self.cwd = cwd
+        self.port = port
+        self.resource_profile = resource_profile or {}
+        self.cpu_partitioned = cpu_partitioned
+        self.process = None
+        self.restarts = 0
+        self.stopping = threading.Event()
+
+    def is_current(self):
+        """Состояние проекта все еще относится к этому экземпляру (его не остановили и не удалили)"""
+        if self.stopping.is_set() or not os.path.isdir(self.project_folder_path):
+            return False
+        instance_state = get_instance_state(self.project_folder_path, self.replica)
+        return instance_state.get("state") in ("starting", "running") and instance_state.get("pid") == self.process.pid
+
+    def spawn(self, append_log=False):
+        env = {}
+        if self.cpu_partitioned:
+            cores = acquire_project_cores(self.project_id, self.resource_profile.get("cpu_cores"))
+            env.update(get_thread_env(len(cores)))
+        try:
+            self.process, self.log_offset = _spawn(
+                self.command, self.cwd, get_comfyui_log_path(self.project_folder_path, self.replica), append_log, env
+            )
+        except OSError:
+            release_project_cores(self.project_id)
+            raise
+        if self.cpu_partitioned:
+            attach_project_process(self.project_id, self.process.pid)
+        apply_memory_limit(self.project_id, self.process.pid, self.resource_profile.get("memory_limit_mb"))
+        self.started_at = time.time()
+        logger.info(f"Started ComfyUI for project {self.project_id} with PID {self.process.pid}")
+        _set_instance_state(
+            self.project_folder_path,
+            self.replica,
+            {
+                "state": "starting",
+                "status_message": "Starting..." if not self.restarts else f"Restarting after crash ({self.restarts})...",
+                "port": self.port,
+                "pid": self.process.pid,
+                "pid_create_time": _get_process_create_time(self.process.pid),
+                "launch_command": self.command,
+                "cpu_partitioned": self.cpu_partitioned,
+                "restarts": self.restarts,
+            },
+        )
+
+    def fail(self, error):
+        logger.warning(f"Project {self.project_id} failed: {error}")
+        terminate_instance(self.process.pid)
+        release_project_port(self.project_id)
+        release_project_cores(self.project_id)
+        log_name = os.path.basename(get_comfyui_log_path(self.project_folder_path, self.replica))
+        _set_instance_state(
+            self.project_folder_path,
+            self.replica,
+            {
+                "state": "failed",
+                "status_message": f"Error: {error}, see .launcher/{log_name}",
+                "port": None,
+                "pid": None,
+            },
+        )
+
+    def wait_for_ready(self):
+        error = wait_until_ready(
+            self.process,
+            self.port,
+            get_comfyui_log_path(self.project_folder_path, self.replica),
+            PROJECT_START_TIMEOUT_SECS,
+            log_offset=self.log_offset,
+            should_stop=self.stopping.is_set,
+        )
+        if not self.is_current():
+            return False
+        if error:
+            self.fail(error)
+            return False
+
+        time_to_ready = time.time() - self.started_at
+        logger.info(f"Project {self.project_id} is ready on port {self.port} in {time_to_ready:.1f}s")
+        start_durations = get_instance_state(self.project_folder_path, self.replica).get("start_durations") or []
+        _set_instance_state(
+            self.project_folder_path,
+            self.replica,
+            {
+                "state": "running",
+                "status_message": "Running...",
+                "time_to_ready_secs": time_to_ready,
+                "start_durations": (start_durations + [time_to_ready])[-MAX_RECORDED_START_DURATIONS:],
+            },
+        )
+        return True
+
+    def wait_for_exit(self):
+        while self.process.poll() is None:
+            if self.stopping.wait(SUPERVISOR_POLL_SECS):
+                return
+
+    def supervise(self, ready=False):
+        try:
+            while True:
+                if not ready and not self.wait_for_ready():
+                    return
+                ready = False
+                self.wait_for_exit()
+                if not self.is_current():
+                    return
+
+                if time.time() - self.started_at >= RESTART_RESET_SECS:
+                    self.restarts = 0
+                if not self.command:
+                    # Экземпляр запущен прежней версией лаунчера, команда запуска неизвестна
+                    self.fail("ComfyUI exited")
+                    return
+                if self.restarts >= PROJECT_MAX_RESTARTS:
+                    self.fail(f"ComfyUI crashed {self.restarts + 1} times in a row")
+                    return
+                backoff = min(RESTART_BACKOFF_INITIAL_SECS * 2 ** self.restarts, PROJECT_RESTART_BACKOFF_MAX_SECS)
+                self.restarts += 1
+                logger.warning(
+                    f"ComfyUI of project {self.project_id} exited with code {self.process.poll()}, "
+                    f"restarting in {backoff}s ({self.restarts}/{PROJECT_MAX_RESTARTS})"
+                )
+                if self.stopping.wait(backoff) or not self.is_current():
+                    return
+                try:
+                    self.spawn(append_log=True)
+                except OSError as e:
+                    self.fail(f"Failed to restart ComfyUI: {e}")
+                    return
+        except Exception as e:
+            logger.error(f"Supervisor of project {self.project_id} failed: {e}", exc_info=True)
+        finally:
+            _forget(self)
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def _forget(instance):
+    key = (instance.project_folder_path, instance.replica)
+    with _instances_lock:
+        if _instances.get(key) is instance:
+            del _instances[key]
+
+
+def _run(instance, ready=False):
+    with _instances_lock:
+        _instances[(instance.project_folder_path, instance.replica)] = instance
+    threading.Thread(
+        target=instance.supervise,
+        args=(ready,),
+        name=f"supervisor-{instance.project_id}",
+        daemon=True,
+    ).start()
+
+
+def start_instance(
+    project_folder_path, command, cwd, port, resource_profile=None, cpu_partitioned=False, replica=0
+):
+    """Запускает ComfyUI проекта (или его реплику) под наблюдением супервизора и возвращает pid"""
+    instance = _Instance(
+        os.path.abspath(project_folder_path), command, cwd, port, resource_profile, cpu_partitioned, replica
+    )
+    instance.spawn()
+    _run(instance)
+    return instance.process.pid
+
+
+def _stop(project_folder_path, replica):
+    with _instances_lock:
+        instance = _instances.get((project_folder_path, replica))
+    if instance:
+        instance.stopping.set()
+    instance_state = get_instance_state(project_folder_path, replica)
+    _set_instance_state(project_folder_path, replica, {"state": "stopping", "status_message": "Stopping..."})
+    terminate_instance(instance_state.get("pid"), instance_state.get("pid_create_time"))
+    release_project_cores(get_replica_owner_id(os.path.basename(project_folder_path), replica))
+
+
+def get_replica_numbers(launcher_state):
+    """Номера реплик проекта, у которых есть состояние (без основного экземпляра)"""
+    return sorted(int(replica) for replica in (launcher_state.get("replicas") or {}))
+
+
+def stop_replica(project_folder_path, replica):
+    """Останавливает реплику проекта и освобождает ее порт"""
+    project_folder_path = os.path.abspath(project_folder_path)
+    _stop(project_folder_path, replica)
+    release_project_port(get_replica_owner_id(os.path.basename(project_folder_path), replica))
+    update_project_replica_state(
+        project_folder_path, replica, {"state": "stopped", "status_message": "Stopped", "port": None, "pid": None}
+    )
+
+
+def stop_instance(project_folder_path):
+    """
+    Останавливает экземпляр проекта вместе с его репликами. Экземпляр, запущенный другим процессом лаунчера,
+    останавливается по pid из состояния; его супервизор не перезапустит процесс, увидев, что состояние сменилось.
+    Порт основного экземпляра не освобождается.
+    """
+    project_folder_path = os.path.abspath(project_folder_path)
+    launcher_state = get_launcher_state(project_folder_path)
+    for replica in get_replica_numbers(launcher_state):
+        if launcher_state["replicas"][str(replica)].get("state") in ("starting", "running", "stopping"):
+            stop_replica(project_folder_path, replica)
+    _stop(project_folder_path, 0)
+
+
+def _reconcile(project_folder_path, replica, instance_state):
+    """Берет под наблюдение живой экземпляр (True) или сбрасывает состояние умершего (False)"""
+    owner_id = get_replica_owner_id(os.path.basename(project_folder_path), replica)
+    process = _find_process(instance_state.get("pid"), instance_state.get("pid_create_time"))
+    if process is None or instance_state["state"] == "stopping":
+        if process is not None:
+            terminate_instance(process.pid)
+        logger.info(f"Resetting stale state of project {owner_id} (PID {instance_state.get('pid')})")
+        release_project_port(owner_id)
+        release_project_cores(owner_id)
+        _set_instance_state(
+            project_folder_path,
+            replica,
+            {
+                "state": "stopped" if replica else "ready",
+                "status_message": "Stopped" if replica else "Ready",
+                "port": None,
+                "pid": None,
+            },
+        )
+        return False
+
+    logger.info(f"Adopting running ComfyUI of project {owner_id} (PID {process.pid})")
+    instance = _Instance(
+        project_folder_path,
+        instance_state.get("launch_command"),
+        os.path.join(project_folder_path, "comfyui"),
+        instance_state.get("port"),
+        get_launcher_state(project_folder_path).get("resource_profile"),
+        instance_state.get("cpu_partitioned", False),
+        replica,
+    )
+    instance.process = _AdoptedProcess(process)
+    instance.started_at = process.create_time()
+    # Строка о готовности могла быть напечатана до перезапуска лаунчера, поэтому для экземпляра
+    # в состоянии starting готовность определит опрос HTTP
+    log_path = get_comfyui_log_path(project_folder_path, replica)
+    instance.log_offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    instance.restarts = instance_state.get("restarts") or 0
+    _run(instance, ready=instance_state["state"] == "running")
+    return True
+
+
+def reconcile_instances():
+    """При старте лаунчера: берет под наблюдение живые экземпляры и сбрасывает состояние умерших"""
+    try:
+        project_ids = os.listdir(PROJECTS_DIR)
+    except OSError:
+        return
+    running_owner_ids = set()
+    for project_id in project_ids:
+        project_folder_path = os.path.abspath(os.path.join(PROJECTS_DIR, project_id))
+        if not os.path.isdir(project_folder_path):
+            continue
+        launcher_state = get_launcher_state(project_folder_path)
+        for replica in [0] + get_replica_numbers(launcher_state):
+            instance_state = get_instance_state(project_folder_path, replica)
+            if instance_state.get("state") not in ("starting", "running", "stopping"):
+                continue
+            if _reconcile(project_folder_path, replica, instance_state):
+                running_owner_ids.add(get_replica_owner_id(project_id, replica))
+
+    # Ядра удаленных проектов и экземпляров, не переживших перезапуск
+    prune_project_cores(running_owner_ids)
@@ -1,17 +1,109 @@
-import json
 import os
 import shutil
-from celery import shared_task
+import time
+from celery import chain, shared_task
+from celery.signals import worker_init, worker_ready
 import logging
-from utils import COMFYUI_REPO_URL, create_symlink, create_virtualenv, install_default_custom_nodes, install_pip_reqs, normalize_model_filepaths_in_workflow_json, run_command, run_command_in_project_venv, set_default_workflow_from_launcher_json, set_launcher_state_data, setup_custom_nodes_from_snapshot, setup_files_from_launcher_json, setup_initial_models_folder
+from batch import fail_interrupted_batch_job, run_batch_job
+from provisioning import (
+    PROVISIONING_STAGES,
+    STAGE_WORK_KINDS,
+    ProvisioningContext,
+    begin_provisioning,
+    load_provisioning_context,
+    run_provisioning_stage,
+    run_provisioning_stages,
+    save_provisioning_args,
+)
+from events import publish_state_change_to_redis
+from executor import JobRevokedError, is_embedded_executor, set_recovery_handler, submit_task
+from progress import ProvisioningProgress, tracking_progress
+from runtimes import run_shared_runtime_provisioning
+from scheduler import record_provisioning_duration
+from settings import PROVISIONING_QUEUES, SHARED_RUNTIMES, WARM_POOL_SIZE
+from utils import get_launcher_state, on_launcher_state_change, set_launcher_state_data
+from warm_pool import refill_warm_pool
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def get_project_progress(project_folder_path, resume=False):
+    # id проекта совпадает с именем его папки в PROJECTS_DIR
+    return ProvisioningProgress(os.path.basename(project_folder_path), resume=resume)
+
+
+def prepare_project_folder(project_folder_path, create_project_folder):
+    if create_project_folder:
+        logger.info(f"Creating project folder: {project_folder_path}")
+        if os.path.exists(project_folder_path):
+            logger.warning(f"Project folder already exists, removing: {project_folder_path}")
+            shutil.rmtree(project_folder_path, ignore_errors=True)
+        os.makedirs(project_folder_path)
+    else:
+        logger.info(f"Using existing project folder: {project_folder_path}")
+        if not os.path.exists(project_folder_path):
+            logger.info(f"Creating project folder as it doesn't exist: {project_folder_path}")
+            os.makedirs(project_folder_path)
+
+
+def start_provisioning(project_folder_path, models_folder_path, id, name, launcher_json, port, fork_from_path, torch_variant):
+    # Сохраняем аргументы задачи до нормализации launcher_json, чтобы ее можно было возобновить
+    save_provisioning_args(
+        project_folder_path,
+        {
+            "models_folder_path": models_folder_path,
+            "id": id,
+            "name": name,
+            "launcher_json": launcher_json,
+            "port": port,
+            "fork_from_path": fork_from_path,
+            "torch_variant": torch_variant,
+        },
+    )
+    set_launcher_state_data(project_folder_path, {"id": id, "name": name, "started_at": time.time()})
+
+
+def finish_provisioning(project_folder_path, progress):
+    launcher_state = get_launcher_state(project_folder_path)
+    started_at = (launcher_state or {}).get("started_at")
+    set_launcher_state_data(
+        project_folder_path, {"status_message": "Ready", "state": "ready"}
+    )
+    logger.info("Project creation completed successfully")
+    if started_at:
+        record_provisioning_duration(time.time() - started_at)
+    progress.finish()
+    if WARM_POOL_SIZE > 0:
+        submit_task(refill_warm_pool_task)
+
+
+def fail_provisioning(project_folder_path, progress, e):
+    if isinstance(e, JobRevokedError):
+        logger.info(f"Provisioning of {project_folder_path} was cancelled")
+        progress.fail(e)
+        # Проект удален во время установки: убираем то, что шаг успел записать после удаления
+        if not get_launcher_state(project_folder_path):
+            shutil.rmtree(project_folder_path, ignore_errors=True)
+        return
+    logger.error(f"Error creating project: {str(e)}", exc_info=True)
+    progress.fail(e)
+    try:
+        # Пробуем установить статус ошибки
+        set_launcher_state_data(
+            project_folder_path, 
+            {
+                "status_message": f"Error: {str(e)}", 
+                "state": "error"
+            }
+        )
+    except:
+        pass
+
+
 @shared_task(ignore_result=False, bind=True)
 def create_comfyui_project(
-    self, project_folder_path, models_folder_path, id, name, launcher_json=None, port=None, create_project_folder=True
+    self, project_folder_path, models_folder_path, id, name, launcher_json=None, port=None, create_project_folder=True, resume=False, fork_from_path=None, torch_variant=None
 ):
     logger.info(f"Starting task create_comfyui_project with id: {id}, name: {name}")
     logger.info(f"Project path: {project_folder_path}")
@@ -20,134 +112,129 @@ def create_comfyui_project(
     project_folder_path = os.path.abspath(project_folder_path)
     models_folder_path = os.path.abspath(models_folder_path)
 
+    progress = get_project_progress(project_folder_path)
     try:
-        if create_project_folder:
-            logger.info(f"Creating project folder: {project_folder_path}")
-            if os.path.exists(project_folder_path):
-                logger.warning(f"Project folder already exists, removing: {project_folder_path}")
-                shutil.rmtree(project_folder_path, ignore_errors=True)
-            os.makedirs(project_folder_path)
-        else:
-            logger.info(f"Using existing project folder: {project_folder_path}")
-            if not os.path.exists(project_folder_path):
-                logger.info(f"Creating project folder as it doesn't exist: {project_folder_path}")
-                os.makedirs(project_folder_path)
+        with tracking_progress(progress):
+            prepare_project_folder(project_folder_path, create_project_folder)
+            start_provisioning(project_folder_path, models_folder_path, id, name, launcher_json, port, fork_from_path, torch_variant)
 
-        set_launcher_state_data(
-            project_folder_path,
-            {"id":id,"name":name, "status_message": "Downloading ComfyUI...", "state": "download_comfyui"},
-        )
-        logger.info("Cloning ComfyUI repository")
-        run_command(
-            ["git", "clone", COMFYUI_REPO_URL, os.path.join(project_folder_path, 'comfyui')],
-        )
-
-        if launcher_json:
-            logger.info("Processing launcher_json configuration")
-            comfyui_commit_hash = launcher_json["snapshot_json"]["comfyui"]
-            if comfyui_commit_hash:
-                logger.info(f"Checking out commit: {comfyui_commit_hash}")
-                run_command(
-                    ["git", "checkout", comfyui_commit_hash],
-                    cwd=os.path.join(project_folder_path, 'comfyui'),
-                )
-            launcher_json['workflow_json'] = normalize_model_filepaths_in_workflow_json(launcher_json['workflow_json'])
-
-        logger.info("Setting up web interface files")
-        os.rename(
-            os.path.join(project_folder_path, "comfyui", "web", "index.html"),
-            os.path.join(project_folder_path, "comfyui", "web", "comfyui_index.html"),
-        )
-
-        web_frame_path = os.path.join("web", "comfy_frame.html")
-        logger.info(f"Copying frame file from: {web_frame_path}")
-        shutil.copy(
-            web_frame_path,
-            os.path.join(project_folder_path, "comfyui", "web", "index.html"),
-        )
-
-        if os.path.exists(os.path.join(project_folder_path, "comfyui", "models")):
-            logger.info("Removing existing models directory")
-            shutil.rmtree(
-                os.path.join(project_folder_path, "comfyui", "models"), ignore_errors=True
+            ctx = ProvisioningContext(
+                project_folder_path, models_folder_path, launcher_json=launcher_json, port=port, fork_from_path=fork_from_path,
+                torch_variant=torch_variant,
             )
+            if SHARED_RUNTIMES:
+                run_shared_runtime_provisioning(ctx, resume=resume)
+            else:
+                run_provisioning_stages(ctx, resume=resume)
 
-        if not os.path.exists(models_folder_path):
-            logger.info("Setting up initial models folder")
-            setup_initial_models_folder(models_folder_path)
-
-        logger.info("Creating models symlink")
-        create_symlink(models_folder_path, os.path.join(project_folder_path, "comfyui", "models"))
-
-        set_launcher_state_data(
-            project_folder_path,
-            {"status_message": "Installing ComfyUI...", "state": "install_comfyui"},
-        )
-
-        logger.info("Creating virtual environment")
-        create_virtualenv(os.path.join(project_folder_path, 'venv'))
-
-        logger.info("Installing ComfyUI requirements")
-        run_command_in_project_venv(
-            project_folder_path,
-            f"pip install -r {os.path.join(project_folder_path, 'comfyui', 'requirements.txt')}",
-        )
+        finish_provisioning(project_folder_path, progress)
+        return True
 
-        set_launcher_state_data(
-            project_folder_path,
-            {
-                "status_message": "Installing custom nodes...",
-                "state": "install_custom_nodes",
-            },
-        )
+    except Exception as e:
+        fail_provisioning(project_folder_path, progress, e)
+        raise
 
-        logger.info("Installing custom nodes")
-        install_default_custom_nodes(project_folder_path, launcher_json)
-        setup_custom_nodes_from_snapshot(project_folder_path, launcher_json)
 
-        if launcher_json and "pip_requirements" in launcher_json:
-            logger.info("Installing additional pip requirements")
-            install_pip_reqs(project_folder_path, launcher_json["pip_requirements"])
+# Раздельная установка: цепочка задач start -> шаг за шагом -> complete, каждая в очереди своего вида работы.
+# Состояние проекта между задачами хранится в .launcher/ (task_args.json, stages.json) и в базе состояний.
 
-        set_launcher_state_data(
-            project_folder_path,
-            {
-                "status_message": "Downloading models & other files...",
-                "state": "download_files",
-            },
-        )
+@shared_task(ignore_result=False, bind=True)
+def start_project_provisioning(
+    self, project_folder_path, models_folder_path, id, name, launcher_json=None, port=None, create_project_folder=True, resume=False, fork_from_path=None, torch_variant=None
+):
+    logger.info(f"Starting provisioning chain for project with id: {id}, name: {name}")
+    progress = get_project_progress(project_folder_path)
+    try:
+        prepare_project_folder(project_folder_path, create_project_folder)
+        start_provisioning(project_folder_path, models_folder_path, id, name, launcher_json, port, fork_from_path, torch_variant)
+        begin_provisioning(load_provisioning_context(project_folder_path), resume=resume)
+        progress.publish(force=True)
+    except Exception as e:
+        fail_provisioning(project_folder_path, progress, e)
+        raise
 
-        logger.info("Setting up files from launcher json")
-        setup_files_from_launcher_json(project_folder_path, launcher_json)
-        set_default_workflow_from_launcher_json(project_folder_path, launcher_json)
 
-        if launcher_json:
-            logger.info("Saving launcher.json")
-            with open(os.path.join(project_folder_path, "launcher.json"), "w") as f:
-                json.dump(launcher_json, f)
+@shared_task(ignore_result=False, bind=True)
+def run_project_provisioning_stage(self, project_folder_path, stage_name):
+    progress = get_project_progress(project_folder_path, resume=True)
+    try:
+        with tracking_progress(progress):
+            run_provisioning_stage(load_provisioning_context(project_folder_path), stage_name)
+        progress.publish(force=True)
+    except Exception as e:
+        fail_provisioning(project_folder_path, progress, e)
+        raise
 
-        if port is not None:
-            logger.info(f"Setting port: {port}")
-            with open(os.path.join(project_folder_path, "port.txt"), "w") as f:
-                f.write(str(port))
 
-        set_launcher_state_data(
-            project_folder_path, {"status_message": "Ready", "state": "ready"}
-        )
-        logger.info("Project creation completed successfully")
+@shared_task(ignore_result=False, bind=True)
+def complete_project_provisioning(self, project_folder_path):
+    progress = get_project_progress(project_folder_path, resume=True)
+    try:
+        finish_provisioning(project_folder_path, progress)
         return True
-
     except Exception as e:
-        logger.error(f"Error creating project: {str(e)}", exc_info=True)
-        try:
-            # Пробуем установить статус ошибки
-            set_launcher_state_data(
-                project_folder_path, 
-                {
-                    "status_message": f"Error: {str(e)}", 
-                    "state": "error"
-                }
-            )
-        except:
-            pass
-        raise
\ No newline at end of file
+        fail_provisioning(project_folder_path, progress, e)
+        raise
+
+
+def enqueue_project_provisioning(project_folder_path, models_folder_path, **kwargs):
+    """
+    Ставит установку проекта в очередь и возвращает id задач (последняя - итоговая).
+    Цепочка прерывается на первой упавшей задаче; с общими сборками установка идет одной задачей,
+    так как сборка окружения выполняется под блокировкой целиком. Встроенный исполнитель очередей
+    не различает, ему цепочка тоже не нужна.
+    """
+    project_folder_path = os.path.abspath(project_folder_path)
+    models_folder_path = os.path.abspath(models_folder_path)
+    if SHARED_RUNTIMES or is_embedded_executor():
+        return [submit_task(create_comfyui_project, project_folder_path, models_folder_path, **kwargs)]
+
+    finalize_queue = PROVISIONING_QUEUES["finalize"]
+    signatures = [
+        start_project_provisioning.si(project_folder_path, models_folder_path, **kwargs).set(queue=finalize_queue)
+    ]
+    for stage_name, _, _, _ in PROVISIONING_STAGES:
+        queue = PROVISIONING_QUEUES[STAGE_WORK_KINDS[stage_name]]
+        signatures.append(run_project_provisioning_stage.si(project_folder_path, stage_name).set(queue=queue))
+    signatures.append(complete_project_provisioning.si(project_folder_path).set(queue=finalize_queue))
+
+    result = chain(*signatures).apply_async()
+    task_ids = []
+    while result is not None:
+        task_ids.append(result.id)
+        result = result.parent
+    return list(reversed(task_ids))
+
+
+@shared_task(ignore_result=True)
+def run_batch_job_task(job_id):
+    # Задание ждет выполнения промптов в ComfyUI, сам воркер почти не нагружает
+    run_batch_job(job_id)
+
+
+@shared_task(ignore_result=True)
+def refill_warm_pool_task():
+    # Пополнение пула идет в основной очереди, отдельно от шагов установки проектов
+    refill_warm_pool()
+
+
+# Задачи встроенного исполнителя, прерванные остановкой лаунчера: установка продолжается с первого
+# незавершенного шага в той же папке, промпты прерванного пакетного задания уже отправлены, поэтому
+# оно не повторяется, а помечается упавшим; пополнение пула можно просто запустить заново
+set_recovery_handler(
+    create_comfyui_project, lambda args, kwargs: (args, {**kwargs, "create_project_folder": False, "resume": True})
+)
+set_recovery_handler(run_batch_job_task, lambda args, kwargs: fail_interrupted_batch_job(*args, **kwargs))
+set_recovery_handler(refill_warm_pool_task, lambda args, kwargs: (args, kwargs))
+
+
+@worker_ready.connect
+def on_worker_ready(**kwargs):
+    if WARM_POOL_SIZE > 0:
+        refill_warm_pool_task.delay()
+
+
+@worker_init.connect
+def on_worker_init(**kwargs):
+    # Изменения состояния проектов из воркера доходят до /api/events сервера через Redis
+    on_launcher_state_change(publish_state_change_to_redis)
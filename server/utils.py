@@ -3,7 +3,7 @@ import logging
 import os
 import time
 import shutil
-import socket
+import stat
 import requests
 import hashlib
 import unicodedata
@@ -13,12 +13,73 @@ import threading
 import tempfile
 from tqdm import tqdm
 from urllib.parse import urlparse
-from settings import PROJECT_MAX_PORT, PROJECT_MIN_PORT, PROJECTS_DIR
+from contextlib import contextmanager
+from functools import wraps
+from settings import PROVISIONING_BUDGETS, SCHEDULER_SLOTS_DIR
+from hardware import get_torch_index_url, resolve_torch_variant
+from progress import add_progress, report_progress
+from state_store import claim_project_state, load_project_state, update_project_state
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RESOURCE_SLOT_POLL_SECS = 1
+
+_held_resource_slots = threading.local()
+
+
+@contextmanager
+def resource_slot(resource):
+    """
+    Занимает один из PROVISIONING_BUDGETS[resource] слотов, общих для всех процессов воркера,
+    и ждет, пока слот освободится. Повторный вход из того же потока слот не занимает.
+    """
+    held = getattr(_held_resource_slots, "counts", None)
+    if held is None:
+        held = _held_resource_slots.counts = {}
+    if held.get(resource):
+        held[resource] += 1
+        try:
+            yield
+        finally:
+            held[resource] -= 1
+        return
+
+    slots_dir = os.path.join(SCHEDULER_SLOTS_DIR, resource)
+    os.makedirs(slots_dir, exist_ok=True)
+    slot_lock_path = None
+    waited = False
+    while slot_lock_path is None:
+        for slot_index in range(max(1, PROVISIONING_BUDGETS.get(resource, 1))):
+            candidate = os.path.join(slots_dir, f"slot-{slot_index}.lock")
+            if try_acquire_lock_file(candidate):
+                slot_lock_path = candidate
+                break
+        else:
+            if not waited:
+                logger.info(f"Waiting for a free {resource} slot...")
+                waited = True
+            time.sleep(RESOURCE_SLOT_POLL_SECS)
+
+    held[resource] = 1
+    try:
+        yield
+    finally:
+        held[resource] = 0
+        release_lock_file(slot_lock_path)
+
+
+def uses_resource(resource):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with resource_slot(resource):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def check_url_structure(url):
     """Проверка структуры URL и автоматическая замена устаревших ссылок"""
     try:
@@ -68,6 +129,7 @@ def slugify(value, allow_unicode=False):
 
 COMFYUI_REPO_URL = "https://github.com/comfyanonymous/ComfyUI.git"
 
+
 MAX_DOWNLOAD_ATTEMPTS = 3
 
 CUSTOM_NODES_TO_IGNORE_FROM_SNAPSHOTS = ["ComfyUI-ComfyWorkflows", "ComfyUI-Manager"]
@@ -141,7 +203,7 @@ def print_process_output(process):
     except Exception as e:
         print(f"Error in print_process_output: {e}")
 
-def run_command(cmd: List[str], cwd: Optional[str] = None, bg: bool = False) -> None:
+def run_command(cmd: List[str], cwd: Optional[str] = None, bg: bool = False, on_output=None) -> None:
     try:
         process = subprocess.Popen(
             " ".join(cmd),
@@ -162,6 +224,8 @@ def run_command(cmd: List[str], cwd: Optional[str] = None, bg: bool = False) ->
                 break
             if output:
                 logger.info(output.strip())
+                if on_output:
+                    on_output(output.strip())
                 
         retcode = process.poll()
         if retcode != 0:
@@ -190,6 +254,7 @@ def normalize_model_filepaths_in_workflow_json(workflow_json: dict) -> dict:
     return workflow_json
 
 
+@uses_resource("pip")
 def run_command_in_project_venv(project_folder_path, command):
     if os.name == "nt":  # Check if running on Windows
         venv_activate = os.path.join(project_folder_path, "venv", "Scripts", "activate.bat")
@@ -198,13 +263,22 @@ def run_command_in_project_venv(project_folder_path, command):
     
     assert os.path.exists(venv_activate), f"Virtualenv does not exist in project folder: {project_folder_path}"
     
+    # pip запускаем через python окружения: лаунчеры pip.exe/pip содержат абсолютный путь
+    # к интерпретатору и ломаются, если окружение было перенесено или склонировано
+    if command.startswith("pip "):
+        command = "python -m " + command
+
     if os.name == "nt":
         command = ["call", venv_activate, "&&", command]
     else:
         command = [".", venv_activate, "&&", command]
     
     # Run the command using subprocess and capture stdout
-    run_command(command)
+    run_command(command, on_output=count_pip_installed_packages if "-m pip install" in " ".join(command) else None)
+
+def count_pip_installed_packages(output_line):
+    if output_line.startswith("Successfully installed "):
+        add_progress("pip_packages_installed", len(output_line.split()) - 2)
 
 def run_command_in_project_comfyui_venv(project_folder_path, command, in_bg=False):
     venv_activate = os.path.join(project_folder_path, "venv", "Scripts", "activate.bat") if os.name == "nt" else os.path.join(project_folder_path, "venv", "bin", "activate")
@@ -231,24 +305,29 @@ def run_command_in_project_comfyui_venv(project_folder_path, command, in_bg=Fals
             return process.wait() == 0
 
 
-def install_default_custom_nodes(project_folder_path, launcher_json=None):
-    # install default custom nodes
-    # comfyui-manager
-    run_command(["git", "clone", f"https://github.com/ltdrdata/ComfyUI-Manager", os.path.join(project_folder_path, 'comfyui', 'custom_nodes', 'ComfyUI-Manager')])
-
-    # pip install comfyui-manager
-    run_command_in_project_venv(
-        project_folder_path,
-        f"pip install -r {os.path.join(project_folder_path, 'comfyui', 'custom_nodes', 'ComfyUI-Manager', 'requirements.txt')}",
-    )
+DEFAULT_CUSTOM_NODES = {
+    "ComfyUI-Manager": "https://github.com/ltdrdata/ComfyUI-Manager",
+    "ComfyUI-ComfyWorkflows": "https://github.com/thecooltechguy/ComfyUI-ComfyWorkflows",
+}
 
-    run_command(["git", "clone", f"https://github.com/thecooltechguy/ComfyUI-ComfyWorkflows", os.path.join(project_folder_path, 'comfyui', 'custom_nodes', 'ComfyUI-ComfyWorkflows')])
+def clone_default_custom_nodes(project_folder_path):
+    for custom_node_name, custom_node_repo_url in DEFAULT_CUSTOM_NODES.items():
+        custom_node_path = os.path.join(project_folder_path, 'comfyui', 'custom_nodes', custom_node_name)
+        report_progress(custom_node=custom_node_name)
+        clone_or_checkout_repo(custom_node_repo_url, custom_node_path)
 
-    # pip install comfyui-comfyworkflows
-    run_command_in_project_venv(
-        project_folder_path,
-        f"pip install -r {os.path.join(project_folder_path, 'comfyui', 'custom_nodes', 'ComfyUI-ComfyWorkflows', 'requirements.txt')}",
-    )
+def install_default_custom_nodes(project_folder_path, launcher_json=None):
+    # install default custom nodes (comfyui-manager, comfyui-comfyworkflows)
+    # клонирование обычно уже выполнено отдельным шагом, тогда здесь ничего не скачивается
+    clone_default_custom_nodes(project_folder_path)
+    for custom_node_name in DEFAULT_CUSTOM_NODES:
+        custom_node_path = os.path.join(project_folder_path, 'comfyui', 'custom_nodes', custom_node_name)
+        report_progress(custom_node=custom_node_name)
+        install_requirements_file(
+            project_folder_path,
+            os.path.join(custom_node_path, 'requirements.txt'),
+            f"default_custom_node:{custom_node_name}",
+        )
 
 def setup_initial_models_folder(models_folder_path):
     assert not os.path.exists(
@@ -267,9 +346,11 @@ def is_launcher_json_format(import_json):
         return True
     return False
 
-def setup_custom_nodes_from_snapshot(project_folder_path, launcher_json):
+def get_snapshot_custom_nodes(launcher_json):
+    """(url, имя, коммит) включенных custom nodes из snapshot_json"""
     if not launcher_json:
-        return
+        return []
+    custom_nodes = []
     for custom_node_repo_url, custom_node_repo_info in launcher_json["snapshot_json"][
         "git_custom_nodes"
     ].items():
@@ -286,16 +367,40 @@ def setup_custom_nodes_from_snapshot(project_folder_path, launcher_json):
         if custom_node_disabled:
             continue
         custom_node_name = custom_node_repo_url.split("/")[-1].replace(".git", "")
+        custom_nodes.append((custom_node_repo_url, custom_node_name, custom_node_hash))
+    return custom_nodes
+
+def clone_custom_nodes_from_snapshot(project_folder_path, launcher_json):
+    for custom_node_repo_url, custom_node_name, custom_node_hash in get_snapshot_custom_nodes(launcher_json):
         custom_node_path = os.path.join(
             project_folder_path, "comfyui", "custom_nodes", custom_node_name
         )
-        
-        # Clone the custom node repository
-        run_command(["git", "clone", custom_node_repo_url, custom_node_path, "--recursive"])
+        report_progress(custom_node=custom_node_name)
+        # Клонируем репозиторий или переключаем уже существующий на нужный коммит
+        clone_or_checkout_repo(custom_node_repo_url, custom_node_path, custom_node_hash, recursive=True)
 
-        if custom_node_hash:
-            # Checkout the specific hash
-            run_command(["git", "checkout", custom_node_hash], cwd=custom_node_path)
+def setup_custom_nodes_from_snapshot(project_folder_path, launcher_json):
+    # Репозитории, уже переключенные на нужный коммит шагом клонирования, повторно не скачиваются
+    clone_custom_nodes_from_snapshot(project_folder_path, launcher_json)
+    for custom_node_repo_url, custom_node_name, custom_node_hash in get_snapshot_custom_nodes(launcher_json):
+        custom_node_path = os.path.join(
+            project_folder_path, "comfyui", "custom_nodes", custom_node_name
+        )
+        report_progress(custom_node=custom_node_name)
+
+        # Если ни коммит, ни файлы установки не изменились, узел уже установлен
+        stage_key = f"custom_node:{custom_node_name}"
+        fingerprint = compute_stage_fingerprint(
+            custom_node_repo_url,
+            get_git_head_commit(custom_node_path),
+            hash_file_if_exists(os.path.join(custom_node_path, "requirements.txt")),
+            hash_file_if_exists(os.path.join(custom_node_path, "requirements_post.txt")),
+            hash_file_if_exists(os.path.join(custom_node_path, "install.py")),
+            get_venv_python_version(project_folder_path),
+        )
+        if is_stage_unchanged(project_folder_path, stage_key, fingerprint):
+            logger.info(f"Custom node {custom_node_name} is unchanged, skipping install")
+            continue
 
         pip_requirements_path = os.path.join(custom_node_path, "requirements.txt")
         if os.path.exists(pip_requirements_path):
@@ -320,6 +425,8 @@ def setup_custom_nodes_from_snapshot(project_folder_path, launcher_json):
             clipseg_custom_node_file_path = os.path.join(custom_node_path, "custom_nodes", "clipseg.py")
             shutil.copy(clipseg_custom_node_file_path, os.path.join(project_folder_path, "comfyui", "custom_nodes", "clipseg.py"))
 
+        record_stage_fingerprint(project_folder_path, stage_key, fingerprint)
+
 def compute_sha256_checksum(file_path):
     buf_size = 1024
     sha256 = hashlib.sha256()
@@ -346,6 +453,7 @@ def set_config(config):
     with open(CONFIG_FILEPATH, "w") as f:
         json.dump(config, f)
 
+@uses_resource("network")
 def download_with_retry(url, temp_path, dest_path, sha256_checksum=None, headers=None, max_retries=3):
     """Загрузка файла с повторными попытками и улучшенной обработкой ошибок"""
     if not url or not isinstance(url, str):
@@ -372,6 +480,7 @@ def download_with_retry(url, temp_path, dest_path, sha256_checksum=None, headers
 
     for attempt in range(max_retries):
         current_temp_path = f"{temp_path}.{attempt}"
+        downloaded_size = 0
         try:
             # Получаем размер файла
             try:
@@ -388,6 +497,7 @@ def download_with_retry(url, temp_path, dest_path, sha256_checksum=None, headers
 
             # Загружаем файл
             logger.info(f"Downloading: {filename}")
+            report_progress(file=filename, file_bytes_total=total_size or None)
             response = requests.get(url, headers=headers, stream=True, timeout=30)
             response.raise_for_status()
 
@@ -413,6 +523,7 @@ def download_with_retry(url, temp_path, dest_path, sha256_checksum=None, headers
                             chunk_size = len(chunk)
                             downloaded_size += chunk_size
                             pbar.update(chunk_size)
+                            add_progress("bytes_downloaded", chunk_size)
 
                             current_time = time.time()
                             if current_time - last_update_time >= 1:
@@ -461,6 +572,8 @@ def download_with_retry(url, temp_path, dest_path, sha256_checksum=None, headers
 
         except Exception as e:
             logger.error(f"Attempt {attempt + 1} failed: {str(e)}")
+            # Байты неудачной попытки не считаем
+            add_progress("bytes_downloaded", -downloaded_size)
             if os.path.exists(current_temp_path):
                 try:
                     os.remove(current_temp_path)
@@ -493,6 +606,7 @@ def setup_files_from_launcher_json(project_folder_path, launcher_json):
 
         logger.info(f"Total files to download: {total_files}")
         processed_files = 0
+        report_progress(files_done=0, files_total=total_files, force=True)
 
         # Создаем временную директорию для загрузок
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -528,6 +642,7 @@ def setup_files_from_launcher_json(project_folder_path, launcher_json):
                             downloaded_file = True
                             processed_files += 1
                             logger.info(f"Progress: {processed_files}/{total_files} files ({(processed_files/total_files*100):.0f}%)")
+                            report_progress(files_done=processed_files)
                             break
                         else:
                             logger.info(f"File exists but needs update: {dest_path}")
@@ -583,6 +698,7 @@ def setup_files_from_launcher_json(project_folder_path, launcher_json):
                             downloaded_file = True
                             processed_files += 1
                             logger.info(f"Progress: {processed_files}/{total_files} files ({(processed_files/total_files*100):.0f}%)")
+                            report_progress(files_done=processed_files)
                             break
 
                 if not downloaded_file and current_file:
@@ -590,6 +706,7 @@ def setup_files_from_launcher_json(project_folder_path, launcher_json):
                     missing_download_files.add(current_file)
                     processed_files += 1
                     logger.info(f"Progress: {processed_files}/{total_files} files ({(processed_files/total_files*100):.0f}%)")
+                    report_progress(files_done=processed_files)
 
         logger.info(f"Download completed. Success: {total_files - len(missing_download_files)}, Failed: {len(missing_download_files)}")
         if missing_download_files:
@@ -728,9 +845,12 @@ def set_default_workflow_from_launcher_json(project_folder_path, launcher_json):
         )
         os.makedirs(os.path.dirname(default_graph_path), exist_ok=True)
         
-        with open(default_graph_path, "w", encoding='utf-8') as f:
+        # Пишем через временный файл: в форкнутом проекте целевой файл может быть жесткой ссылкой
+        default_graph_tmp_path = default_graph_path + ".tmp"
+        with open(default_graph_tmp_path, "w", encoding='utf-8') as f:
             f.write("window.resetWorkflowHistory = true;\n")
             f.write(f"export const defaultGraph = {json.dumps(workflow_json, indent=2, ensure_ascii=False)};")
+        os.replace(default_graph_tmp_path, default_graph_path)
         logger.info(f"Сохранен defaultGraph.js с {len(workflow_json.get('nodes', []))} узлами")
 
         # Сохраняем в current_graph.json
@@ -739,8 +859,10 @@ def set_default_workflow_from_launcher_json(project_folder_path, launcher_json):
         )
         os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
         
-        with open(workflow_path, "w", encoding='utf-8') as f:
+        workflow_tmp_path = workflow_path + ".tmp"
+        with open(workflow_tmp_path, "w", encoding='utf-8') as f:
             json.dump(workflow_json, f, indent=2, ensure_ascii=False)
+        os.replace(workflow_tmp_path, workflow_path)
         logger.info(f"Сохранен current_graph.json")
 
     except Exception as e:
@@ -749,34 +871,234 @@ def set_default_workflow_from_launcher_json(project_folder_path, launcher_json):
         raise
 
 
-def get_launcher_state(project_folder_path):
-    state = {}
-    launcher_folder_path = os.path.join(project_folder_path, ".launcher")
-    os.makedirs(launcher_folder_path, exist_ok=True)
+_launcher_state_listeners = []
+
 
-    state_path = os.path.join(launcher_folder_path, "state.json")
+def on_launcher_state_change(listener):
+    """
+    Регистрирует listener(project_folder_path, data), вызываемый после каждой записи состояния
+    в этом процессе (data - записанные поля)
+    """
+    _launcher_state_listeners.append(listener)
 
-    if os.path.exists(state_path):
-        with open(state_path, "r") as f:
-            state = json.load(f)
 
-    return state, state_path
+def get_launcher_state(project_folder_path):
+    # Состояние хранится в базе лаунчера (см. state_store)
+    return load_project_state(project_folder_path)
 
 
 def set_launcher_state_data(project_folder_path, data: dict):
+    # Каталог .launcher нужен остальным файлам установки (stages.json, fingerprints.json, ...)
+    os.makedirs(os.path.join(project_folder_path, ".launcher"), exist_ok=True)
+    update_project_state(project_folder_path, data)
+
+    for listener in _launcher_state_listeners:
+        try:
+            listener(project_folder_path, data)
+        except Exception as e:
+            logger.warning(f"Launcher state listener failed: {e}")
+
+
+def claim_launcher_state(project_folder_path, from_states, data: dict):
+    """Как set_launcher_state_data, но только из состояний from_states; True, если состояние изменено этим вызовом"""
+    if not claim_project_state(project_folder_path, from_states, data):
+        return False
+    for listener in _launcher_state_listeners:
+        try:
+            listener(project_folder_path, data)
+        except Exception as e:
+            logger.warning(f"Launcher state listener failed: {e}")
+    return True
+
+
+def write_json_atomic(path, data):
+    """Атомарная запись JSON: пишем во временный файл и подменяем целевой"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def hash_file_if_exists(file_path):
+    if not os.path.exists(file_path):
+        return None
+    return compute_sha256_checksum(file_path)
+
+
+def get_venv_python_version(project_folder_path):
+    """Версия Python виртуального окружения проекта (из pyvenv.cfg, без запуска интерпретатора)"""
+    pyvenv_cfg_path = os.path.join(project_folder_path, "venv", "pyvenv.cfg")
+    if not os.path.exists(pyvenv_cfg_path):
+        return None
+    with open(pyvenv_cfg_path, "r") as f:
+        for line in f:
+            key, _, value = line.partition("=")
+            if key.strip() in ("version_info", "version"):
+                return value.strip()
+    return None
+
+
+def get_git_head_commit(repo_path):
+    if not os.path.exists(os.path.join(repo_path, ".git")):
+        return None
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=repo_path, universal_newlines=True
+        ).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compute_stage_fingerprint(*inputs):
+    """Отпечаток входных данных шага установки (хеши файлов, коммиты, версия Python и т.д.)"""
+    canonical = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_stage_fingerprints(project_folder_path):
+    fingerprints_path = os.path.join(project_folder_path, ".launcher", "fingerprints.json")
+    if not os.path.exists(fingerprints_path):
+        return {}
+    try:
+        with open(fingerprints_path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def is_stage_unchanged(project_folder_path, stage_key, fingerprint):
+    return get_stage_fingerprints(project_folder_path).get(stage_key) == fingerprint
+
+
+def record_stage_fingerprint(project_folder_path, stage_key, fingerprint):
     launcher_folder_path = os.path.join(project_folder_path, ".launcher")
     os.makedirs(launcher_folder_path, exist_ok=True)
+    fingerprints = get_stage_fingerprints(project_folder_path)
+    fingerprints[stage_key] = fingerprint
+    write_json_atomic(os.path.join(launcher_folder_path, "fingerprints.json"), fingerprints)
+
+
+# Захваченные этим процессом блокировки: путь -> открытый дескриптор файла блокировки
+_held_lock_files = {}
+_held_lock_files_lock = threading.Lock()
+
+
+def _lock_fd(fd):
+    if os.name == "nt":
+        import msvcrt
+
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
-    existing_state, existing_state_path = get_launcher_state(project_folder_path)
-    existing_state.update(data)
 
-    with open(existing_state_path, "w") as f:
-        json.dump(existing_state, f)
+def _unlock_fd(fd):
+    if os.name == "nt":
+        import msvcrt
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def try_acquire_lock_file(lock_path):
+    """
+    Межпроцессная блокировка без ожидания: flock (на Windows - msvcrt.locking) на открытом файле.
+    Блокировку держит дескриптор, поэтому блокировка умершего процесса снимается системой, а файл
+    не удаляется: иначе другой процесс мог бы захватить уже удаленный файл одновременно с новым.
+    """
+    lock_path = os.path.abspath(lock_path)
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        _lock_fd(fd)
+    except OSError:
+        os.close(fd)
+        return False
+    # PID владельца - только для диагностики
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    with _held_lock_files_lock:
+        _held_lock_files[lock_path] = fd
+    return True
+
+
+def release_lock_file(lock_path):
+    with _held_lock_files_lock:
+        fd = _held_lock_files.pop(os.path.abspath(lock_path), None)
+    if fd is None:
+        return
+    try:
+        _unlock_fd(fd)
+    finally:
+        os.close(fd)
+
+
+@uses_resource("network")
+def clone_or_checkout_repo(repo_url, repo_path, commit_hash=None, recursive=False):
+    """
+    Клонирует репозиторий, либо, если он уже есть на диске, только переключает его на нужный коммит.
+    Без commit_hash существующий репозиторий остается как есть.
+    """
+    if not os.path.exists(os.path.join(repo_path, ".git")):
+        if os.path.exists(repo_path):
+            shutil.rmtree(repo_path, ignore_errors=True)
+        clone_cmd = ["git", "clone", repo_url, repo_path]
+        if recursive:
+            clone_cmd.append("--recursive")
+        run_command(clone_cmd)
+        if commit_hash:
+            run_command(["git", "checkout", commit_hash], cwd=repo_path)
+        return
+
+    if not commit_hash:
+        logger.info(f"Repository already exists, keeping it: {repo_path}")
+        return
+
+    head_commit = get_git_head_commit(repo_path)
+    if head_commit and head_commit.startswith(commit_hash):
+        logger.info(f"Repository already at commit {commit_hash}: {repo_path}")
+        return
+
+    logger.info(f"Checking out {commit_hash} in existing repository: {repo_path}")
+    try:
+        run_command(["git", "checkout", "-f", commit_hash], cwd=repo_path)
+    except subprocess.CalledProcessError:
+        # Коммита еще нет локально
+        run_command(["git", "fetch", "--all", "--tags"], cwd=repo_path)
+        run_command(["git", "checkout", "-f", commit_hash], cwd=repo_path)
+    if recursive:
+        run_command(["git", "submodule", "update", "--init", "--recursive"], cwd=repo_path)
+
+
+def install_requirements_file(project_folder_path, requirements_path, stage_key):
+    """pip install -r, пропускается, если файл и версия Python не изменились с прошлой установки"""
+    if not os.path.exists(requirements_path):
+        return
+    fingerprint = compute_stage_fingerprint(
+        compute_sha256_checksum(requirements_path),
+        get_venv_python_version(project_folder_path),
+    )
+    if is_stage_unchanged(project_folder_path, stage_key, fingerprint):
+        logger.info(f"Requirements are unchanged, skipping install: {requirements_path}")
+        return
+    run_command_in_project_venv(project_folder_path, f"pip install -r {requirements_path}")
+    record_stage_fingerprint(project_folder_path, stage_key, fingerprint)
+
 
 def install_pip_reqs(project_folder_path, pip_reqs):
     """Установка pip зависимостей"""
     if not pip_reqs:
         return
+
+    fingerprint = compute_stage_fingerprint(pip_reqs, get_venv_python_version(project_folder_path))
+    if is_stage_unchanged(project_folder_path, "pip_requirements", fingerprint):
+        logger.info("Pip requirements are unchanged, skipping install")
+        return
     
     logger.info("Installing pip requirements...")
     
@@ -828,28 +1150,13 @@ def install_pip_reqs(project_folder_path, pip_reqs):
         if os.path.exists(requirements_path):
             os.remove(requirements_path)
 
-def get_project_port(id):
-    project_path = os.path.join(PROJECTS_DIR, id)
-    if os.path.exists(os.path.join(project_path, "port.txt")):
-        with open(os.path.join(project_path, "port.txt"), "r") as f:
-            return int(f.read().strip())
-    return find_free_port(PROJECT_MIN_PORT, PROJECT_MAX_PORT)
+    record_stage_fingerprint(project_folder_path, "pip_requirements", fingerprint)
 
 def is_port_in_use(port: int) -> bool:
     import socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         return s.connect_ex(('localhost', port)) == 0
     
-def find_free_port(start_port, end_port):
-    for port in range(start_port, end_port + 1):
-        with socket.socket() as s:
-            try:
-                s.bind(('', port))
-                return port
-            except OSError:
-                pass  # Port is already in use, try the next one
-    return None  # No free port found in the range
-
 def create_symlink(source, target):
     try:
         source = os.path.abspath(source)
@@ -891,7 +1198,110 @@ def create_symlink(source, target):
             logger.error(f"Error copying directory: {copy_error}")
             raise
 
-def create_virtualenv(venv_path):
+# Файлы меньше этого размера при клонировании окружения копируются, а не связываются:
+# среди них конфиги, которые программы перезаписывают на месте
+HARDLINK_MIN_FILE_SIZE = 1024 * 1024
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+FICLONE = 0x40049409
+
+
+def _reflink_file(src, dst):
+    import fcntl
+    with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def link_or_copy_file(src, dst):
+    """
+    Копирование файла с минимальными затратами: reflink (copy-on-write) там, где ФС его поддерживает,
+    иначе жесткая ссылка для больших файлов, иначе обычное копирование
+    """
+    if os.name != "nt":
+        try:
+            _reflink_file(src, dst)
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    if os.path.getsize(src) >= HARDLINK_MIN_FILE_SIZE:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+@uses_resource("disk")
+def link_tree(source, target, ignore=None):
+    """Клонирует дерево каталогов через link_or_copy_file, симлинки сохраняются как есть"""
+    logger.info(f"Linking tree: {source} -> {target}")
+    shutil.copytree(source, target, symlinks=True, ignore=ignore, copy_function=link_or_copy_file)
+
+
+def set_tree_read_only(path, read_only, dirs_only=False):
+    """
+    Снимает (или возвращает владельцу) право на запись у каталога и его содержимого; симлинки не трогает.
+    dirs_only - только у каталогов: права файлов, жестко связанных с другим деревом, общие с ним.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return
+
+    def chmod(entry_path):
+        mode = stat.S_IMODE(os.lstat(entry_path).st_mode)
+        os.chmod(entry_path, mode & ~WRITE_BITS if read_only else mode | stat.S_IWUSR)
+
+    chmod(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs if dirs_only else dirs + files:
+            entry_path = os.path.join(root, name)
+            if not os.path.islink(entry_path):
+                chmod(entry_path)
+
+
+def relocate_virtualenv(venv_path, old_venv_path):
+    """
+    Переписывает абсолютные пути в скопированном/перенесенном окружении
+    (activate-скрипты, шебанги, .pth файлы) со старого расположения на новое
+    """
+    venv_path = os.path.abspath(venv_path)
+    old_venv_path = os.path.abspath(old_venv_path)
+    if venv_path == old_venv_path:
+        return
+
+    candidate_files = []
+    scripts_dir = os.path.join(venv_path, "Scripts" if os.name == "nt" else "bin")
+    if os.path.isdir(scripts_dir):
+        for entry in os.scandir(scripts_dir):
+            if entry.is_file(follow_symlinks=False):
+                candidate_files.append(entry.path)
+    for root, dirs, files in os.walk(venv_path):
+        if os.path.basename(root) == "site-packages":
+            candidate_files.extend(os.path.join(root, f) for f in files if f.endswith(".pth"))
+            dirs.clear()
+
+    old_path_bytes = old_venv_path.encode("utf-8")
+    new_path_bytes = venv_path.encode("utf-8")
+    relocated_count = 0
+    for file_path in candidate_files:
+        with open(file_path, "rb") as f:
+            content = f.read()
+        # Бинарные файлы (exe-лаунчеры, сам интерпретатор) не трогаем
+        if b"\0" in content or old_path_bytes not in content:
+            continue
+        tmp_path = file_path + ".relocate.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content.replace(old_path_bytes, new_path_bytes))
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        relocated_count += 1
+    logger.info(f"Relocated {relocated_count} files in virtual environment: {old_venv_path} -> {venv_path}")
+
+
+@uses_resource("pip")
+def create_virtualenv(venv_path, torch_variant=None):
     """Создание виртуального окружения с корректной обработкой отмены"""
     cleanup_needed = False
     try:
@@ -948,8 +1358,10 @@ def create_virtualenv(venv_path):
             logger.warning(f"Pip upgrade warning: {e}")
             # Продолжаем, так как это некритичная ошибка
 
-        # Устанавливаем PyTorch
-        logger.info("Installing PyTorch...")
+        # Устанавливаем PyTorch под оборудование машины (или явно заданный вариант)
+        torch_variant = resolve_torch_variant(torch_variant)
+        torch_index_url = get_torch_index_url(torch_variant)
+        logger.info(f"Installing PyTorch ({torch_variant})...")
         try:
             subprocess.run([
                 pip_path,
@@ -958,8 +1370,7 @@ def create_virtualenv(venv_path):
                 'torch',
                 'torchvision',
                 'torchaudio',
-                '--index-url', 'https://download.pytorch.org/whl/cu121'
-            ], check=True)
+            ] + (['--index-url', torch_index_url] if torch_index_url else []), check=True)
         except KeyboardInterrupt:
             logger.info("Operation cancelled by user during PyTorch installation")
             raise
@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import time
+import uuid
+import logging
+from settings import MODELS_DIR, SHARED_RUNTIMES, WARM_POOL_COMFYUI_COMMITS, WARM_POOL_DIR, WARM_POOL_SIZE
+from provisioning import GENERIC_PROVISIONING_STAGES, ProvisioningContext, run_provisioning_stages
+from hardware import resolve_torch_variant
+from state_store import delete_project_state
+from utils import (
+    get_git_head_commit,
+    relocate_virtualenv,
+    release_lock_file,
+    slugify,
+    try_acquire_lock_file,
+    write_json_atomic,
+)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Теплый пул: заранее собранные окружения (ComfyUI + venv + torch + стандартные custom nodes),
+# не привязанные к проекту. Раскладка: WARM_POOL_DIR/<commit>-<torch variant>/<entry id>/
+# Собираемые записи имеют суффикс .building и становятся видимыми только после переименования.
+
+LATEST_COMFYUI_COMMIT = "latest"
+BUILDING_SUFFIX = ".building"
+
+
+def get_warm_pool_key(comfyui_commit, torch_variant):
+    return slugify(f"{comfyui_commit or LATEST_COMFYUI_COMMIT}-{torch_variant}")
+
+
+def get_warm_pool_keys():
+    """(коммит ComfyUI, вариант torch) для всех поддерживаемых в пуле окружений"""
+    commits = [None] + WARM_POOL_COMFYUI_COMMITS
+    torch_variant = resolve_torch_variant()
+    return [(commit, torch_variant) for commit in commits]
+
+
+def list_warm_pool_entries(key, include_building=False):
+    key_dir = os.path.join(WARM_POOL_DIR, key)
+    if not os.path.isdir(key_dir):
+        return []
+    entries = []
+    for entry_name in sorted(os.listdir(key_dir)):
+        if entry_name.endswith(BUILDING_SUFFIX) and not include_building:
+            continue
+        entries.append(os.path.join(key_dir, entry_name))
+    return entries
+
+
+def build_warm_pool_entry(comfyui_commit, torch_variant):
+    key = get_warm_pool_key(comfyui_commit, torch_variant)
+    entry_id = uuid.uuid4().hex[:12]
+    building_path = os.path.abspath(os.path.join(WARM_POOL_DIR, key, entry_id + BUILDING_SUFFIX))
+    os.makedirs(building_path)
+    logger.info(f"Building warm pool entry {entry_id} for {key}")
+
+    launcher_json = None
+    if comfyui_commit:
+        launcher_json = {
+            "snapshot_json": {"comfyui": comfyui_commit, "git_custom_nodes": {}},
+            "workflow_json": {},
+            "files": [],
+            "pip_requirements": [],
+        }
+
+    try:
+        ctx = ProvisioningContext(building_path, MODELS_DIR, launcher_json=launcher_json, torch_variant=torch_variant)
+        run_provisioning_stages(ctx, only_stages=GENERIC_PROVISIONING_STAGES)
+        write_json_atomic(
+            os.path.join(building_path, ".launcher", "warm_pool.json"),
+            {
+                "comfyui_commit": comfyui_commit,
+                "resolved_comfyui_commit": get_git_head_commit(os.path.join(building_path, "comfyui")),
+                "torch_variant": torch_variant,
+                "built_at": time.time(),
+            },
+        )
+        entry_path = building_path[: -len(BUILDING_SUFFIX)]
+        os.rename(building_path, entry_path)
+        # Состояние сборки в базе привязано к ее пути и проекту, забравшему запись, не нужно
+        delete_project_state(building_path)
+        relocate_virtualenv(os.path.join(entry_path, "venv"), os.path.join(building_path, "venv"))
+        logger.info(f"Warm pool entry ready: {entry_path}")
+        return entry_path
+    except Exception:
+        logger.error(f"Failed to build warm pool entry {entry_id}", exc_info=True)
+        shutil.rmtree(building_path, ignore_errors=True)
+        delete_project_state(building_path)
+        raise
+
+
+def refill_warm_pool():
+    """Достраивает пул до WARM_POOL_SIZE записей на каждый ключ. Одновременно работает только один процесс."""
+    if WARM_POOL_SIZE <= 0:
+        return
+    os.makedirs(WARM_POOL_DIR, exist_ok=True)
+    lock_path = os.path.join(WARM_POOL_DIR, "refill.lock")
+    if not try_acquire_lock_file(lock_path):
+        logger.info("Warm pool refill is already running")
+        return
+
+    try:
+        for comfyui_commit, torch_variant in get_warm_pool_keys():
+            key = get_warm_pool_key(comfyui_commit, torch_variant)
+            # Недостроенные записи остались от прерванного пополнения (блокировка у нас)
+            for entry_path in list_warm_pool_entries(key, include_building=True):
+                if entry_path.endswith(BUILDING_SUFFIX):
+                    logger.info(f"Removing interrupted warm pool entry: {entry_path}")
+                    shutil.rmtree(entry_path, ignore_errors=True)
+
+            while len(list_warm_pool_entries(key)) < WARM_POOL_SIZE:
+                build_warm_pool_entry(comfyui_commit, torch_variant)
+    finally:
+        release_lock_file(lock_path)
+
+
+def claim_warm_pool_entry(project_path, launcher_json=None, torch_variant=None):
+    """
+    Забирает готовую запись пула под проект (атомарным переименованием в project_path).
+    Возвращает True, если запись найдена: общие шаги установки для проекта уже выполнены.
+    """
+    # С общими сборками проекту не нужно собственное окружение
+    if WARM_POOL_SIZE <= 0 or SHARED_RUNTIMES:
+        return False
+
+    comfyui_commit = None
+    if launcher_json and launcher_json.get("snapshot_json"):
+        comfyui_commit = launcher_json["snapshot_json"].get("comfyui")
+    key = get_warm_pool_key(comfyui_commit, resolve_torch_variant(torch_variant))
+
+    for entry_path in list_warm_pool_entries(key):
+        try:
+            with open(os.path.join(entry_path, ".launcher", "warm_pool.json"), "r") as f:
+                entry_info = json.load(f)
+            os.rename(entry_path, project_path)
+        except FileNotFoundError:
+            # Запись уже забрал другой процесс
+            continue
+        except OSError as e:
+            logger.warning(f"Failed to claim warm pool entry {entry_path}: {e}")
+            continue
+
+        relocate_virtualenv(os.path.join(project_path, "venv"), os.path.join(entry_path, "venv"))
+        os.remove(os.path.join(project_path, ".launcher", "warm_pool.json"))
+        logger.info(f"Claimed warm pool entry {entry_path} (ComfyUI {entry_info.get('resolved_comfyui_commit')}) for {project_path}")
+        return True
+
+    return False
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+# Модули сервера импортируются как в server/ (from settings import ...). Каталоги из settings
+# (проекты, модели, база лаунчера, кеш) указывают во временный каталог, общий для всей сессии тестов.
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+sys.path.insert(0, SERVER_DIR)
+
+TEST_ROOT = tempfile.mkdtemp(prefix="launcher-tests-")
+for name, folder in (
+    ("PROJECTS_DIR", "projects"),
+    ("MODELS_DIR", "models"),
+    ("TEMPLATES_DIR", "templates"),
+    ("CELERY_DIR", "celery"),
+    ("RUNTIMES_DIR", "runtimes"),
+    ("WARM_POOL_DIR", "warm_pool"),
+    ("PROMPT_CACHE_DIR", "prompt_cache"),
+):
+    os.environ[name] = os.path.join(TEST_ROOT, folder)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def launcher_db():
+    """Общая база лаунчера; таблицы очищаются после теста"""
+    from launcher_db import get_launcher_db
+
+    yield get_launcher_db
+    with get_launcher_db(write=True) as conn:
+        tables = [
+            row["name"]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        ]
+        for table in tables:
+            conn.execute(f"DELETE FROM {table}")
+
+
+@pytest.fixture
+def make_project(launcher_db):
+    """Создает папку проекта в PROJECTS_DIR; папки удаляются после теста"""
+    from settings import PROJECTS_DIR
+
+    created = []
+
+    def make(project_id):
+        project_folder_path = os.path.join(PROJECTS_DIR, project_id)
+        os.makedirs(project_folder_path, exist_ok=True)
+        created.append(project_folder_path)
+        return project_folder_path
+
+    yield make
+    for project_folder_path in created:
+        shutil.rmtree(project_folder_path, ignore_errors=True)
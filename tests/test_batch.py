@@ -0,0 +1,131 @@
+import pytest
+import batch
+from batch import BatchJobError, apply_params, expand_sweep, find_targets, workflow_to_prompt
+
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [["a.safetensors", "b.safetensors"]]}}},
+    "CLIPTextEncode": {"input": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}}},
+    "KSampler": {
+        "input": {
+            "required": {
+                "model": ["MODEL"],
+                "seed": ["INT", {"default": 0}],
+                "steps": ["INT", {"default": 20}],
+                "positive": ["CONDITIONING"],
+            }
+        }
+    },
+}
+
+
+def make_workflow(sampler_mode=0):
+    return {
+        "nodes": [
+            {"id": 1, "type": "CheckpointLoaderSimple", "widgets_values": ["a.safetensors"], "outputs": []},
+            {
+                "id": 2,
+                "type": "CLIPTextEncode",
+                "inputs": [{"name": "clip", "type": "CLIP", "link": 2}],
+                "widgets_values": ["a cat"],
+            },
+            {"id": 3, "type": "Reroute", "inputs": [{"name": "", "type": "*", "link": 1}], "outputs": [{"type": "MODEL"}]},
+            {
+                "id": 4,
+                "type": "KSampler",
+                "mode": sampler_mode,
+                "inputs": [
+                    {"name": "model", "type": "MODEL", "link": 3},
+                    {"name": "positive", "type": "CONDITIONING", "link": 4},
+                ],
+                # seed, "control_after_generate", steps
+                "widgets_values": [42, "randomize", 30],
+            },
+            {"id": 5, "type": "Note", "widgets_values": ["comment"]},
+        ],
+        # [id связи, из узла, выход, в узел, вход, тип]
+        "links": [
+            [1, 1, 0, 3, 0, "MODEL"],
+            [2, 1, 1, 2, 0, "CLIP"],
+            [3, 3, 0, 4, 0, "MODEL"],
+            [4, 2, 0, 4, 1, "CONDITIONING"],
+        ],
+    }
+
+
+def test_expand_sweep_is_cartesian_product():
+    items = expand_sweep({"seeds": {"start": 10, "count": 2}, "prompts": ["a", "b", "c"]})
+    assert len(items) == 6
+    assert items[0] == {"seed": 10, "prompt": "a"}
+    assert items[-1] == {"seed": 11, "prompt": "c"}
+    assert {(item["seed"], item["prompt"]) for item in items} == {(s, p) for s in (10, 11) for p in "abc"}
+
+
+def test_expand_sweep_csv_rows_skip_empty_values():
+    items = expand_sweep({"seeds": [1], "csv": "4.steps,cfg\n10,\n20,7.5\n"})
+    assert items == [{"seed": 1, "4.steps": "10"}, {"seed": 1, "4.steps": "20", "cfg": "7.5"}]
+
+
+def test_expand_sweep_rejects_empty_sweep():
+    with pytest.raises(BatchJobError):
+        expand_sweep({})
+
+
+def test_expand_sweep_caps_number_of_items(monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_JOB_MAX_ITEMS", 6)
+    assert len(expand_sweep({"seeds": [1, 2], "prompts": ["a", "b", "c"]})) == 6
+    with pytest.raises(BatchJobError, match="limit is 6"):
+        expand_sweep({"seeds": [1, 2, 3], "prompts": ["a", "b", "c"]})
+
+
+def test_workflow_to_prompt_maps_widgets_and_links():
+    prompt = workflow_to_prompt(make_workflow(), OBJECT_INFO)
+    assert set(prompt) == {"1", "2", "4"}
+    assert prompt["1"] == {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}}
+    assert prompt["2"]["inputs"] == {"text": "a cat", "clip": ["1", 1]}
+    # Reroute пропускается, служебный виджет control_after_generate не сдвигает steps
+    assert prompt["4"]["inputs"] == {"model": ["1", 0], "seed": 42, "steps": 30, "positive": ["2", 0]}
+
+
+def test_workflow_to_prompt_skips_muted_nodes():
+    assert "4" not in workflow_to_prompt(make_workflow(sampler_mode=batch.NODE_MODE_MUTED), OBJECT_INFO)
+
+
+def test_workflow_to_prompt_rejects_unknown_node_type():
+    with pytest.raises(BatchJobError, match="Unknown node type"):
+        workflow_to_prompt(make_workflow(), {})
+
+
+def test_apply_params_sets_default_targets_without_mutating_prompt():
+    prompt = workflow_to_prompt(make_workflow(), OBJECT_INFO)
+    targets = find_targets(prompt)
+    assert targets == {"seed": ["4.seed"], "prompt": ["2.text"]}
+
+    applied = apply_params(prompt, targets, {"seed": 7, "prompt": "a dog", "4.steps": "12"})
+    assert applied["4"]["inputs"]["seed"] == 7
+    assert applied["2"]["inputs"]["text"] == "a dog"
+    # Значения из CSV приводятся к типу входа
+    assert applied["4"]["inputs"]["steps"] == 12
+    assert prompt["4"]["inputs"]["seed"] == 42
+
+
+def test_find_targets_rejects_missing_node():
+    prompt = workflow_to_prompt(make_workflow(), OBJECT_INFO)
+    with pytest.raises(BatchJobError, match="missing node"):
+        find_targets(prompt, {"cfg": ["99.cfg"]})
+
+
+def test_deleted_project_jobs_are_cancelled_and_finish_quietly(launcher_db, make_project):
+    make_project("batch-project")
+    spec = {"workflow": workflow_to_prompt(make_workflow(), OBJECT_INFO), "sweep": {"seeds": [1, 2]}}
+    queued_job_id = batch.create_batch_job("batch-project", spec)
+    running_job_id = batch.create_batch_job("batch-project", spec)
+    with launcher_db(write=True) as conn:
+        conn.execute("UPDATE batch_jobs SET state = ? WHERE id = ?", (batch.JOB_RUNNING, running_job_id))
+
+    batch.cancel_project_batch_jobs("batch-project")
+    assert batch.get_batch_job(queued_job_id)["state"] == batch.JOB_CANCELLED
+    assert batch.get_batch_job(running_job_id)["state"] == batch.JOB_CANCELLING
+
+    batch.delete_project_batch_jobs("batch-project")
+    batch._finish_batch_job(running_job_id)
+    assert batch.get_batch_job(running_job_id) is None
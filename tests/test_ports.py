@@ -0,0 +1,104 @@
+import shutil
+import pytest
+import ports
+from ports import (
+    EXTERNAL_OWNER,
+    PortLeaseError,
+    acquire_project_port,
+    get_port_owner,
+    get_project_port,
+    get_replica_owner_id,
+    release_project_port,
+)
+from state_store import set_pinned_project_port
+
+
+@pytest.fixture
+def port_range(monkeypatch, launcher_db):
+    """Диапазон 5001-5003; занятые сторонними процессами порты задаются множеством used_ports"""
+    used_ports = set()
+    monkeypatch.setattr(ports, "PROJECT_MIN_PORT", 5001)
+    monkeypatch.setattr(ports, "PROJECT_MAX_PORT", 5003)
+    monkeypatch.setattr(ports, "is_port_in_use", lambda port: port in used_ports)
+    return used_ports
+
+
+def test_lease_is_reused_and_released(port_range, make_project):
+    make_project("a")
+    make_project("b")
+    assert acquire_project_port("a") == 5001
+    assert acquire_project_port("a") == 5001
+    assert acquire_project_port("b") == 5002
+    assert get_project_port("a") == 5001 and get_port_owner(5002) == "b"
+
+    release_project_port("a")
+    assert get_project_port("a") is None
+    # Освобожденный порт снова выдается первым
+    make_project("c")
+    assert acquire_project_port("c") == 5001
+
+
+def test_range_exhaustion(port_range, make_project):
+    for project_id in ("a", "b", "c"):
+        make_project(project_id)
+        acquire_project_port(project_id)
+    make_project("d")
+    with pytest.raises(PortLeaseError, match="No free port"):
+        acquire_project_port("d")
+
+
+def test_port_used_by_another_process_is_skipped(port_range, make_project):
+    port_range.add(5001)
+    make_project("a")
+    assert acquire_project_port("a") == 5002
+    assert get_port_owner(5001) is None
+
+
+def test_orphaned_leases_are_reclaimed(port_range, make_project):
+    for project_id in ("a", "b", "c"):
+        make_project(project_id)
+        acquire_project_port(project_id)
+    # Папка проекта удалена в обход API: его порт возвращается в список, когда свободных не осталось
+    shutil.rmtree(make_project("b"))
+    make_project("d")
+    assert acquire_project_port("d") == 5002
+
+
+def test_pinned_port_stays_with_project(port_range, make_project):
+    set_pinned_project_port(make_project("a"), 5003)
+    assert acquire_project_port("a") == 5003
+    release_project_port("a")
+    assert get_port_owner(5003) == "a"
+    make_project("b")
+    make_project("c")
+    assert {acquire_project_port("b"), acquire_project_port("c")} == {5001, 5002}
+
+    release_project_port("a", keep_pinned=False)
+    assert get_port_owner(5003) is None
+
+
+def test_pinned_port_held_by_another_project_is_refused(port_range, make_project):
+    make_project("a")
+    assert acquire_project_port("a") == 5001
+    set_pinned_project_port(make_project("b"), 5001)
+    with pytest.raises(PortLeaseError, match="leased by project a"):
+        acquire_project_port("b")
+
+
+def test_pinned_port_held_by_replica_of_existing_project_is_refused(port_range, make_project, launcher_db):
+    make_project("a")
+    with launcher_db(write=True) as conn:
+        ports._sync_free_ports(conn)
+        ports._lease(conn, 5002, get_replica_owner_id("a", 1))
+    set_pinned_project_port(make_project("b"), 5002)
+    with pytest.raises(PortLeaseError):
+        acquire_project_port("b")
+
+
+def test_pinned_port_of_external_lease_is_taken_over(port_range, make_project, launcher_db):
+    with launcher_db(write=True) as conn:
+        ports._sync_free_ports(conn)
+        ports._lease(conn, 5002, EXTERNAL_OWNER)
+    set_pinned_project_port(make_project("a"), 5002)
+    assert acquire_project_port("a") == 5002
+    assert get_port_owner(5002) == "a"
@@ -0,0 +1,75 @@
+import os
+import pytest
+from prompt_cache import canonicalize_prompt, compute_prompt_cache_key, get_input_digests, get_model_signatures
+
+
+@pytest.fixture
+def project(make_project, tmp_path):
+    """Проект с comfyui/input и comfyui/models - симлинком на общую папку моделей, как после установки"""
+    project_folder_path = make_project("cache-project")
+    os.makedirs(os.path.join(project_folder_path, "comfyui", "input"))
+    models_path = tmp_path / "models"
+    (models_path / "checkpoints" / "sd").mkdir(parents=True)
+    (models_path / "loras").mkdir()
+    os.symlink(str(models_path), os.path.join(project_folder_path, "comfyui", "models"))
+    write_file(project_folder_path, "input", "cat.png", b"cat")
+    write_file(project_folder_path, "models", "checkpoints/sd/base.safetensors", b"weights")
+    return project_folder_path
+
+
+def write_file(project_folder_path, folder, name, content):
+    with open(os.path.join(project_folder_path, "comfyui", folder, name), "wb") as f:
+        f.write(content)
+
+
+def make_prompt():
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd/base.safetensors"}},
+        "2": {"class_type": "LoadImage", "inputs": {"image": "cat.png [input]", "upload": "image"}},
+        "3": {
+            "class_type": "KSampler",
+            "inputs": {"seed": 1, "steps": 20, "model": ["1", 0]},
+            "_meta": {"title": "KSampler"},
+        },
+    }
+
+
+def test_key_ignores_key_order_and_meta(project):
+    key = compute_prompt_cache_key(project, make_prompt())
+
+    reordered = {node_id: make_prompt()[node_id] for node_id in ("3", "1", "2")}
+    reordered["3"] = {"inputs": {"model": ["1", 0], "steps": 20, "seed": 1}, "class_type": "KSampler"}
+    assert canonicalize_prompt(reordered) == canonicalize_prompt(make_prompt())
+    assert compute_prompt_cache_key(project, reordered) == key
+
+    prompt = make_prompt()
+    prompt["3"]["_meta"] = {"title": "Renamed"}
+    assert compute_prompt_cache_key(project, prompt) == key
+
+
+def test_key_changes_with_prompt(project):
+    prompt = make_prompt()
+    prompt["3"]["inputs"]["seed"] = 2
+    assert compute_prompt_cache_key(project, prompt) != compute_prompt_cache_key(project, make_prompt())
+
+
+def test_key_changes_with_input_file(project):
+    key = compute_prompt_cache_key(project, make_prompt())
+    assert get_input_digests(project, make_prompt()).keys() == {"cat.png"}
+    write_file(project, "input", "cat.png", b"dog")
+    assert compute_prompt_cache_key(project, make_prompt()) != key
+
+
+def test_key_changes_with_model_file(project):
+    key = compute_prompt_cache_key(project, make_prompt())
+    assert get_model_signatures(project, make_prompt()).keys() == {"sd/base.safetensors"}
+    # Модель заменена под тем же именем
+    write_file(project, "models", "checkpoints/sd/base.safetensors", b"new weights")
+    assert compute_prompt_cache_key(project, make_prompt()) != key
+
+
+def test_files_outside_project_folders_are_ignored(project, tmp_path):
+    (tmp_path / "secret.txt").write_text("secret")
+    prompt = {"1": {"class_type": "LoadImage", "inputs": {"image": "../../../secret.txt", "lora": "../../secret.txt"}}}
+    assert get_input_digests(project, prompt) == {}
+    assert get_model_signatures(project, prompt) == {}
@@ -0,0 +1,98 @@
+import os
+import pytest
+from registry import ProjectRegistry, compute_listing_etag, decode_cursor, paginate_projects, sort_projects
+from state_store import update_project_state
+
+
+def make_projects(*items):
+    return sort_projects([{"id": project_id, "last_modified": last_modified} for project_id, last_modified in items])
+
+
+def page_ids(page):
+    return [p["id"] for p in page]
+
+
+def test_paginate_without_limit_returns_everything():
+    projects = make_projects(("a", 3), ("b", 2))
+    assert paginate_projects(projects) == (projects, None)
+    assert paginate_projects(projects, limit=2) == (projects, None)
+
+
+def test_cursor_pages_cover_all_projects_once():
+    projects = make_projects(("a", 5), ("b", 4), ("c", 4), ("d", 2), ("e", 1))
+    seen, cursor = [], None
+    while True:
+        page, cursor = paginate_projects(projects, limit=2, cursor=cursor)
+        seen += page_ids(page)
+        if cursor is None:
+            break
+    assert seen == ["a", "b", "c", "d", "e"]
+
+
+def test_cursor_is_stable_across_inserts_and_deletes():
+    projects = make_projects(("a", 5), ("b", 4), ("c", 3), ("d", 2), ("e", 1))
+    page, cursor = paginate_projects(projects, limit=2)
+    assert page_ids(page) == ["a", "b"]
+    assert decode_cursor(cursor) == (4.0, "b")
+
+    # Новый проект попадает в начало списка, удаленный - пропадает: следующая страница не повторяет
+    # и не пропускает оставшиеся проекты
+    projects = make_projects(("new", 9), ("a", 5), ("b", 4), ("d", 2), ("e", 1), ("older", 1.5))
+    page, cursor = paginate_projects(projects, limit=2, cursor=cursor)
+    assert page_ids(page) == ["d", "older"]
+    page, cursor = paginate_projects(projects, limit=2, cursor=cursor)
+    assert page_ids(page) == ["e"] and cursor is None
+
+
+def test_cursor_of_deleted_project_still_works():
+    projects = make_projects(("a", 3), ("b", 2), ("c", 1))
+    _, cursor = paginate_projects(projects, limit=1)
+    page, _ = paginate_projects(make_projects(("b", 2), ("c", 1)), limit=5, cursor=cursor)
+    assert page_ids(page) == ["b", "c"]
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises((ValueError, TypeError)):
+        paginate_projects(make_projects(("a", 1)), limit=1, cursor="not-a-cursor")
+
+
+def test_etag_depends_on_registry_version_query_and_queue():
+    projects = [{"id": "a"}, {"id": "b", "queue_position": 1, "estimated_start": 100.4}]
+    etag = compute_listing_etag("r-1", "limit=2", projects)
+    assert compute_listing_etag("r-1", "limit=2", [dict(p) for p in projects]) == etag
+    # Оценка округляется до секунды
+    assert compute_listing_etag("r-1", "limit=2", [projects[0], {**projects[1], "estimated_start": 100.9}]) == etag
+    assert compute_listing_etag("r-2", "limit=2", projects) != etag
+    assert compute_listing_etag("r-1", "limit=3", projects) != etag
+    assert compute_listing_etag("r-1", "limit=2", [projects[0], {**projects[1], "queue_position": 2}]) != etag
+
+
+def test_registry_version_changes_only_with_projects(launcher_db, tmp_path):
+    projects_dir = tmp_path / "projects"
+    projects_dir.mkdir()
+    registry = ProjectRegistry(str(projects_dir))
+    assert registry.list() == []
+    empty_tag = registry.get_version_tag()
+
+    project_path = os.path.join(str(projects_dir), "p1")
+    os.makedirs(project_path)
+    update_project_state(project_path, {"state": "ready"})
+    registry.scan()
+    tag = registry.get_version_tag()
+    assert tag != empty_tag
+    assert [p["id"] for p in registry.list()] == ["p1"]
+
+    # Без изменений тег прежний: клиент с этим ETag получит 304
+    registry.scan()
+    assert registry.get_version_tag() == tag
+
+    update_project_state(project_path, {"state": "running"})
+    registry.scan()
+    assert registry.get_version_tag() != tag
+    assert registry.get("p1")["state"]["state"] == "running"
+
+    tag = registry.get_version_tag()
+    os.rmdir(project_path)
+    registry.scan()
+    assert registry.get_version_tag() != tag
+    assert registry.list() == []
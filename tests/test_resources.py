@@ -0,0 +1,38 @@
+from resources import partition_cores
+
+
+def test_no_projects():
+    assert partition_cores([0, 1, 2, 3], []) == {}
+
+
+def test_cores_are_split_evenly_in_start_order():
+    partition = partition_cores(list(range(8)), [("a", None), ("b", None), ("c", None)])
+    assert partition == {"a": [0, 1, 2], "b": [3, 4, 5], "c": [6, 7]}
+
+
+def test_explicit_requests_are_served_first():
+    partition = partition_cores(list(range(8)), [("a", None), ("b", 5), ("c", None)])
+    assert partition["b"] == [2, 3, 4, 5, 6]
+    assert len(partition["a"]) == 2 and len(partition["c"]) == 1
+    assigned = [core for cores in partition.values() for core in cores]
+    assert sorted(assigned) == list(range(8))
+
+
+def test_request_larger_than_machine_is_capped():
+    assert partition_cores([0, 1, 2, 3], [("a", 16)]) == {"a": [0, 1, 2, 3]}
+
+
+def test_oversubscribed_explicit_requests_fall_back_to_even_split():
+    # 3 + 3 ядра не помещаются в 4: каждый проект получает поровну, без пересечений
+    partition = partition_cores([0, 1, 2, 3], [("a", 3), ("b", 3)])
+    assert partition == {"a": [0, 1], "b": [2, 3]}
+
+
+def test_explicit_requests_leaving_no_core_for_auto_projects_fall_back_to_even_split():
+    partition = partition_cores([0, 1, 2, 3], [("a", 4), ("b", None)])
+    assert partition == {"a": [0, 1], "b": [2, 3]}
+
+
+def test_more_projects_than_cores_share_cores_round_robin():
+    partition = partition_cores([0, 1], [("a", None), ("b", 2), ("c", None)])
+    assert partition == {"a": [0], "b": [1], "c": [0]}
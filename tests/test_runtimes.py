@@ -0,0 +1,122 @@
+import copy
+import os
+import shutil
+import pytest
+from runtimes import (
+    RUNTIMES_DIR,
+    _protect_runtime_venv,
+    compute_environment_fingerprint,
+    get_runtime_path,
+    group_projects_by_runtime,
+    prune_unused_runtimes,
+)
+from state_store import update_project_state
+from utils import WRITE_BITS, release_lock_file, set_tree_read_only, try_acquire_lock_file
+
+LAUNCHER_JSON = {
+    "snapshot_json": {
+        "comfyui": "abc123",
+        "git_custom_nodes": {
+            "https://github.com/example/nodes-a": {"hash": "111", "disabled": False},
+            "https://github.com/example/nodes-b.git": {"hash": "222", "disabled": False},
+        },
+    },
+    "pip_requirements": ["numpy==1.26.0", {"_key": "pillow", "_version": "10.0.0"}],
+}
+
+
+def fingerprint(launcher_json, torch_variant="cpu"):
+    return compute_environment_fingerprint(launcher_json, torch_variant)
+
+
+def test_fingerprint_is_stable_under_order_and_url_spelling():
+    reordered = copy.deepcopy(LAUNCHER_JSON)
+    reordered["snapshot_json"]["git_custom_nodes"] = {
+        "https://github.com/example/nodes-b/": {"hash": "222"},
+        "https://github.com/example/nodes-a.git": {"hash": "111"},
+    }
+    reordered["pip_requirements"] = ["pillow==10.0.0", " numpy==1.26.0"]
+    assert fingerprint(reordered) == fingerprint(LAUNCHER_JSON)
+
+
+def test_fingerprint_ignores_launcher_and_disabled_custom_nodes():
+    launcher_json = copy.deepcopy(LAUNCHER_JSON)
+    git_custom_nodes = launcher_json["snapshot_json"]["git_custom_nodes"]
+    git_custom_nodes["https://github.com/comfyworkflows/ComfyUI-ComfyWorkflows"] = {"hash": "333"}
+    git_custom_nodes["https://github.com/ltdrdata/ComfyUI-Manager"] = {"hash": "444"}
+    git_custom_nodes["https://github.com/example/nodes-c"] = {"hash": "555", "disabled": True}
+    assert fingerprint(launcher_json) == fingerprint(LAUNCHER_JSON)
+
+
+def test_fingerprint_changes_with_environment():
+    base = fingerprint(LAUNCHER_JSON)
+    assert fingerprint(LAUNCHER_JSON, "cu121") != base
+
+    launcher_json = copy.deepcopy(LAUNCHER_JSON)
+    launcher_json["snapshot_json"]["comfyui"] = "def456"
+    assert fingerprint(launcher_json) != base
+
+    launcher_json = copy.deepcopy(LAUNCHER_JSON)
+    launcher_json["snapshot_json"]["git_custom_nodes"]["https://github.com/example/nodes-a"]["hash"] = "999"
+    assert fingerprint(launcher_json) != base
+
+    launcher_json = copy.deepcopy(LAUNCHER_JSON)
+    launcher_json["pip_requirements"].append("scipy")
+    assert fingerprint(launcher_json) != base
+
+
+def test_fingerprint_of_empty_launcher_json():
+    assert fingerprint(None) == fingerprint({})
+    assert len(fingerprint(None)) == 16
+
+
+def test_group_projects_by_runtime():
+    projects = [
+        {"id": "a", "state": {"runtime": "f1"}},
+        {"id": "b", "state": {"runtime": "f2"}},
+        {"id": "c", "state": {"runtime": "f1"}},
+        {"id": "d", "state": {}},
+    ]
+    assert group_projects_by_runtime(projects) == {"f1": ["a", "c"], "f2": ["b"]}
+
+
+def make_runtime(fingerprint):
+    runtime_path = get_runtime_path(fingerprint)
+    site_packages = os.path.join(runtime_path, "venv", "lib", "site-packages")
+    os.makedirs(site_packages)
+    with open(os.path.join(site_packages, "module.py"), "w") as f:
+        f.write("")
+    return runtime_path
+
+
+@pytest.fixture
+def runtimes_dir():
+    yield RUNTIMES_DIR
+    set_tree_read_only(RUNTIMES_DIR, False)
+    shutil.rmtree(RUNTIMES_DIR, ignore_errors=True)
+
+
+def test_runtime_venv_is_made_read_only(runtimes_dir):
+    runtime_path = make_runtime("f1")
+    _protect_runtime_venv(runtime_path)
+    module_path = os.path.join(runtime_path, "venv", "lib", "site-packages", "module.py")
+    assert not os.stat(module_path).st_mode & WRITE_BITS
+    assert not os.stat(os.path.dirname(module_path)).st_mode & WRITE_BITS
+
+
+def test_unreferenced_runtimes_are_pruned(runtimes_dir, make_project):
+    for fingerprint in ("used", "unused", "building"):
+        _protect_runtime_venv(make_runtime(fingerprint))
+    update_project_state(make_project("runtime-project"), {"state": "ready", "runtime": "used"})
+
+    building_lock_path = get_runtime_path("building") + ".lock"
+    assert try_acquire_lock_file(building_lock_path)
+    try:
+        assert prune_unused_runtimes() == ["unused"]
+    finally:
+        release_lock_file(building_lock_path)
+    assert os.path.isdir(get_runtime_path("used"))
+    assert not os.path.exists(get_runtime_path("unused"))
+    assert os.path.isdir(get_runtime_path("building"))
+
+    assert prune_unused_runtimes() == ["building"]
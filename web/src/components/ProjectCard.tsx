@@ -23,7 +23,7 @@ type ProjectCardProps = {
     settings: Settings
 }
 
-const getProjectURL = (port: number, settings: Settings) => {
+const getProjectURL = (id: string, port: number, settings: Settings) => {
     // get the window location
     const { location } = window
 
@@ -38,7 +38,7 @@ const getProjectURL = (port: number, settings: Settings) => {
     }
 
     if (settings.PROXY_MODE) {
-        return `/comfy/${port}/`; // proxy mode
+        return `/comfy/${id}/`; // proxy mode
     }
 
     // otherwise, replace the port in the current origin with the new port number
@@ -195,11 +195,11 @@ function ProjectCard({ item, settings }: ProjectCardProps) {
                         </p>
                     </div>
                     {item.state.status_message && item.state.status_message.length > 0 && <div className="flex flex-row items-center space-x-2">
-                        {item.state.state !== "ready" && <Loader2Icon className="animate-spin h-4 w-4 text-gray-500" />}
+                        {item.state.state !== "ready" && item.state.state !== "failed" && item.state.state !== "idle" && <Loader2Icon className="animate-spin h-4 w-4 text-gray-500" />}
                         <p className='text-sm italic text-neutral-500'>{item.state.status_message}</p>
                     </div>}
                     <div className="flex flex-row space-x-2">
-                        {item.state.state === 'ready' && (
+                        {(item.state.state === 'ready' || item.state.state === 'failed' || item.state.state === 'idle') && (
                             <Button
                                 onClick={(e) => {
                                     e.preventDefault()
@@ -214,14 +214,14 @@ function ProjectCard({ item, settings }: ProjectCardProps) {
                             !!item.state.port && (
                                 <Button variant="default" asChild>
                                     <a
-                                        href={getProjectURL(item.state.port, settings)}
+                                        href={getProjectURL(item.id, item.state.port, settings)}
                                         target="_blank"
                                     >
                                         Open
                                     </a>
                                 </Button>
                             )}
-                        {item.state.state === 'running' && (
+                        {(item.state.state === 'running' || item.state.state === 'starting') && (
                             <Button
                                 onClick={(e) => {
                                     e.preventDefault()
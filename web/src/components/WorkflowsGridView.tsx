@@ -1,11 +1,41 @@
 'use client'
 
 import { Project, Settings } from '@/lib/types'
-import { useQuery } from '@tanstack/react-query'
+import { useQuery, useQueryClient } from '@tanstack/react-query'
+import { useEffect } from 'react'
 import { Masonry } from 'masonic'
 import ProjectCard from './ProjectCard'
 
+type ProjectStateEvent = {
+    id: string
+    delta: Partial<Project['state']>
+}
+
 function WorkflowsGridView() {
+    const queryClient = useQueryClient()
+
+    // State changes are pushed over /api/events; the browser reconnects with Last-Event-ID on its own
+    useEffect(() => {
+        const eventSource = new EventSource('/api/events')
+        const refetchProjects = () => queryClient.invalidateQueries({ queryKey: ['projects'] })
+
+        eventSource.addEventListener('project_state', (event) => {
+            const { id, delta } = JSON.parse((event as MessageEvent).data) as ProjectStateEvent
+            const projects = queryClient.getQueryData<Project[]>(['projects'])
+            if (!projects || !projects.some((p) => p.id === id)) {
+                refetchProjects()
+                return
+            }
+            queryClient.setQueryData<Project[]>(['projects'], (old) =>
+                old?.map((p) => (p.id === id ? { ...p, state: { ...p.state, ...delta } } : p))
+            )
+        })
+        eventSource.addEventListener('project_deleted', refetchProjects)
+        eventSource.addEventListener('reset', refetchProjects)
+
+        return () => eventSource.close()
+    }, [queryClient])
+
     const getProjectsQuery = useQuery({
         queryKey: ['projects'],
         queryFn: async () => {
@@ -13,7 +43,7 @@ function WorkflowsGridView() {
             const data = (await response.json()) as Project[]
             return data
         },
-        refetchInterval: 10_000, // refetch every 10 seconds
+        refetchInterval: 60_000, // fallback in case the event stream is unavailable
     })
 
     const getSettingsQuery = useQuery({
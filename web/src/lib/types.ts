@@ -41,7 +41,11 @@ export type ProjectState = {
         | 'download_files'
         | 'ready'
         | 'download_comfyui'
+        | 'starting'
         | 'running'
+        | 'stopping'
+        | 'failed'
+        | 'idle'
     status_message: string
     port?: number | null
     pid?: number | null